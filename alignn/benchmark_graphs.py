@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""Benchmark graph construction in alignn.graphs.
+
+Times and memory-profiles the neighbor strategies on synthetic crystals,
+with and without the line graph, and reports the results as JSON on
+stdout or in --output, with progress on stderr, e.g.
+`python alignn/benchmark_graphs.py --sizes 2,128,1024 --output bench.json`
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from jarvis.core.atoms import Atoms
+from alignn.graphs import Graph
+
+STRATEGIES = [
+    "k-nearest",
+    "radius_graph",
+    "radius_graph_cell_list",
+    "radius_graph_jarvis",
+]
+SIZES = [2, 16, 128, 1024, 10000]
+
+
+def synthetic_crystal(num_atoms=2, spacing=2.5, jitter=0.1, seed=123):
+    """Make a cubic crystal with num_atoms on a jittered grid."""
+    side = int(np.ceil(num_atoms ** (1 / 3)))
+    grid = np.stack(
+        np.meshgrid(*[np.arange(side)] * 3, indexing="ij"), axis=-1
+    ).reshape(-1, 3)[:num_atoms]
+    rng = np.random.default_rng(seed)
+    coords = (grid + 0.5) * spacing
+    coords += rng.uniform(-jitter, jitter, size=coords.shape)
+    return Atoms(
+        lattice_mat=np.eye(3) * side * spacing,
+        coords=coords,
+        elements=["Si"] * num_atoms,
+        cartesian=True,
+    )
+
+
+def peak_rss_mb():
+    """Get the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def benchmark_graph(
+    num_atoms=2,
+    neighbor_strategy="k-nearest",
+    compute_line_graph=True,
+    cutoff=8.0,
+    max_neighbors=12,
+    repeats=3,
+):
+    """Time graph construction for one synthetic crystal.
+
+    Anything printed while building, like jarvis feature warnings, goes
+    to stderr so stdout only carries the JSON results.
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        return _benchmark_graph(
+            num_atoms=num_atoms,
+            neighbor_strategy=neighbor_strategy,
+            compute_line_graph=compute_line_graph,
+            cutoff=cutoff,
+            max_neighbors=max_neighbors,
+            repeats=repeats,
+        )
+
+
+def _benchmark_graph(
+    num_atoms=2,
+    neighbor_strategy="k-nearest",
+    compute_line_graph=True,
+    cutoff=8.0,
+    max_neighbors=12,
+    repeats=3,
+):
+    atoms = synthetic_crystal(num_atoms)
+    result = {
+        "num_atoms": num_atoms,
+        "neighbor_strategy": neighbor_strategy,
+        "compute_line_graph": compute_line_graph,
+    }
+    rss_before = peak_rss_mb()
+    times = []
+    try:
+        for i in range(repeats):
+            t1 = time.time()
+            g = Graph.atom_dgl_multigraph(
+                atoms,
+                neighbor_strategy=neighbor_strategy,
+                cutoff=cutoff,
+                max_neighbors=max_neighbors,
+                compute_line_graph=compute_line_graph,
+            )
+            times.append(time.time() - t1)
+    except Exception as exp:
+        result["error"] = repr(exp)
+        return result
+    if compute_line_graph:
+        g, lg = g
+        result["line_graph_nodes"] = lg.num_nodes()
+        result["line_graph_edges"] = lg.num_edges()
+    result["num_edges"] = g.num_edges()
+    result["time"] = min(times)
+    result["edges_per_sec"] = g.num_edges() / max(min(times), 1e-9)
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["peak_rss_increase_mb"] = result["peak_rss_mb"] - rss_before
+    return result
+
+
+def run_benchmark(
+    sizes=SIZES,
+    strategies=STRATEGIES,
+    line_graph=[False, True],
+    cutoff=8.0,
+    max_neighbors=12,
+    repeats=3,
+    isolate=True,
+):
+    """Benchmark every combination of size, strategy and line graph.
+
+    With isolate, each case runs in a fresh process so that the
+    peak RSS belongs to that case alone.
+    """
+    results = []
+    for num_atoms in sizes:
+        for neighbor_strategy in strategies:
+            for compute_line_graph in line_graph:
+                kwargs = dict(
+                    num_atoms=num_atoms,
+                    neighbor_strategy=neighbor_strategy,
+                    compute_line_graph=compute_line_graph,
+                    cutoff=cutoff,
+                    max_neighbors=max_neighbors,
+                    repeats=repeats,
+                )
+                if isolate:
+                    try:
+                        with ProcessPoolExecutor(
+                            max_workers=1,
+                            mp_context=multiprocessing.get_context("spawn"),
+                        ) as executor:
+                            result = executor.submit(
+                                benchmark_graph, **kwargs
+                            ).result()
+                    except Exception as exp:
+                        # e.g. the worker was killed for running out of memory
+                        result = dict(
+                            num_atoms=num_atoms,
+                            neighbor_strategy=neighbor_strategy,
+                            compute_line_graph=compute_line_graph,
+                            error=repr(exp),
+                        )
+                else:
+                    result = benchmark_graph(**kwargs)
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    return results
+
+
+parser = argparse.ArgumentParser(
+    description="Benchmark ALIGNN graph construction."
+)
+parser.add_argument(
+    "--sizes",
+    default=",".join(str(i) for i in SIZES),
+    help="Comma separated numbers of atoms.",
+)
+parser.add_argument(
+    "--strategies",
+    default=",".join(STRATEGIES),
+    help="Comma separated neighbor strategies.",
+)
+parser.add_argument(
+    "--line_graph",
+    default="both",
+    help="Build the line graph: yes/no/both.",
+)
+parser.add_argument("--cutoff", default=8.0, help="Neighbor cutoff.")
+parser.add_argument("--max_neighbors", default=12, help="Max neighbors.")
+parser.add_argument("--repeats", default=3, help="Timed repeats per case.")
+parser.add_argument(
+    "--output", default=None, help="JSON file, defaults to stdout."
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args(sys.argv[1:])
+    line_graph = {"yes": [True], "no": [False], "both": [False, True]}
+    results = run_benchmark(
+        sizes=[int(i) for i in args.sizes.split(",")],
+        strategies=args.strategies.split(","),
+        line_graph=line_graph[args.line_graph],
+        cutoff=float(args.cutoff),
+        max_neighbors=int(args.max_neighbors),
+        repeats=int(args.repeats),
+    )
+    if args.output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
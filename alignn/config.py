@@ -155,7 +155,11 @@ class TrainingConfig(BaseSettings):
     target: TARGET_ENUM = "exfoliation_energy"
     atom_features: Literal["basic", "atomic_number", "cfid", "cgcnn"] = "cgcnn"
     neighbor_strategy: Literal[
-        "k-nearest", "voronoi", "radius_graph", "radius_graph_jarvis"
+        "k-nearest",
+        "voronoi",
+        "radius_graph",
+        "radius_graph_cell_list",
+        "radius_graph_jarvis",
     ] = "k-nearest"
     id_tag: Literal["jid", "id", "_oqmd_entry_id"] = "jid"
 
@@ -201,6 +205,18 @@ class TrainingConfig(BaseSettings):
     n_early_stopping: Optional[int] = None  # typically 50
     output_dir: str = os.path.abspath(".")
     use_lmdb: bool = True
+    compact_graphs: bool = False
+    store_r: bool = True
+    store_line_graph: bool = True
+    lmdb_readahead: bool = True
+    lmdb_max_readers: int = 126
+    batch_budget: Optional[int] = None
+    batch_budget_key: Literal["atoms", "edges", "line_graph_edges"] = "edges"
+    preprocess_workers: int = 0
+    label_store: bool = False
+    stream_data: bool = False
+    graph_cache_dir: Optional[str] = None
+    graph_cache_size: float = 10.0  # GB
     # alignn_layers: int = 4
     # gcn_layers: int =4
     # edge_input_features: int= 80
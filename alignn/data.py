@@ -1,6 +1,7 @@
 """ALIGNN data loaders and DGLGraph utilities."""
 
 import random
+import heapq
 from typing import Optional
 from torch.utils.data.distributed import DistributedSampler
 import os
@@ -54,6 +55,47 @@ def mean_absolute_deviation(data, axis=None):
     return np.mean(np.absolute(data - np.mean(data, axis)), axis)
 
 
+def filter_targets(
+    samples=[],
+    target="",
+    classification_threshold=None,
+    target_multiplication_factor=None,
+    all_targets=None,
+):
+    """Iterate samples with a valid target, appending targets to all_targets.
+
+    Targets are scaled by target_multiplication_factor and converted to
+    0/1 with classification_threshold.
+    """
+    for i in samples:
+        if isinstance(i[target], list):  # multioutput target
+            if all_targets is not None:
+                all_targets.append(torch.tensor(i[target]))
+            yield i
+
+        elif (
+            i[target] is not None
+            and i[target] != "na"
+            and not math.isnan(i[target])
+        ):
+            if target_multiplication_factor is not None:
+                i[target] = i[target] * target_multiplication_factor
+            if classification_threshold is not None:
+                if i[target] <= classification_threshold:
+                    i[target] = 0
+                elif i[target] > classification_threshold:
+                    i[target] = 1
+                else:
+                    raise ValueError(
+                        "Check classification data type.",
+                        i[target],
+                        type(i[target]),
+                    )
+            if all_targets is not None:
+                all_targets.append(i[target])
+            yield i
+
+
 def get_id_train_val_test(
     total_size=1000,
     split_seed=123,
@@ -115,6 +157,68 @@ def get_id_train_val_test(
     return id_train, id_val, id_test
 
 
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler filling batches up to a budget of graph size.
+
+    sizes holds the cost of every sample, e.g. its number of atoms, edges
+    or line graph edges. Each epoch the samples are spread over a fixed
+    number of batches, ceil(sum(sizes) / budget), largest first into the
+    least filled batch, so batches have about equal cost. Sizes are
+    jittered so batch contents change between epochs, and the batch order
+    is shuffled. With num_replicas > 1 each rank gets every
+    num_replicas-th batch.
+    """
+
+    def __init__(
+        self,
+        sizes=[],
+        budget=1000,
+        num_replicas=1,
+        rank=0,
+        seed=123,
+        jitter=0.1,
+    ):
+        """Initialize with per-sample sizes and batch budget."""
+        self.sizes = np.asarray(sizes, dtype=np.float64)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.jitter = jitter
+        self.epoch = 0
+        num_batches = max(int(math.ceil(self.sizes.sum() / budget)), 1)
+        num_batches = min(num_batches, len(self.sizes))
+        # same number of batches on every rank
+        self.num_batches = num_replicas * int(
+            math.ceil(num_batches / num_replicas)
+        )
+
+    def __len__(self):
+        """Get number of batches per epoch on this rank."""
+        return self.num_batches // self.num_replicas
+
+    def set_epoch(self, epoch):
+        """Set the epoch used to seed the shuffling."""
+        self.epoch = epoch
+
+    def __iter__(self):
+        """Yield lists of sample indices."""
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        jitter = rng.uniform(
+            1 - self.jitter, 1 + self.jitter, size=len(self.sizes)
+        )
+        order = np.argsort(-self.sizes * jitter, kind="stable")
+        batches = [[] for i in range(self.num_batches)]
+        loads = [(0.0, i) for i in range(self.num_batches)]
+        for idx in order:
+            load, i = heapq.heappop(loads)
+            batches[i].append(int(idx))
+            heapq.heappush(loads, (load + self.sizes[idx], i))
+        batch_order = rng.permutation(self.num_batches)
+        for i in batch_order[self.rank :: self.num_replicas]:  # noqa:E203
+            yield batches[i]
+
+
 def get_train_val_loaders(
     dataset: str = "dft_3d",
     dataset_array=None,
@@ -155,11 +259,57 @@ def get_train_val_loaders(
     rank=0,
     use_lmdb: bool = True,
     dtype="float32",
+    compact_graphs: bool = False,
+    store_r: bool = True,
+    store_line_graph: bool = True,
+    lmdb_readahead: bool = True,
+    lmdb_max_readers: int = 126,
+    preprocess_workers: int = 0,
+    label_store: bool = False,
+    graph_cache_dir: Optional[str] = None,
+    graph_cache_size: float = 10.0,
+    batch_budget: Optional[int] = None,
+    batch_budget_key: str = "edges",
+    dataset_stream=None,
 ):
-    """Help function to set up JARVIS train and val dataloaders."""
+    """Help function to set up JARVIS train and val dataloaders.
+
+    With batch_budget, LMDB training batches are filled up to about
+    batch_budget atoms, edges or line_graph_edges (batch_budget_key)
+    instead of batch_size samples.
+    dataset_stream is an optional callable dataset_stream(select)
+    returning a new iterator over the samples whose id passes
+    select(id), used instead of dataset and dataset_array. The samples
+    are split by `hash_split` of their ids and written to LMDB as they
+    are read, one pass per split, so the dataset is never held in memory.
+    Testing the id first lets the stream skip parsing the structures of
+    the other splits.
+    """
+    if batch_budget is not None:
+        if not use_lmdb:
+            raise ValueError("batch_budget needs use_lmdb.")
+        if batch_budget_key not in ["atoms", "edges", "line_graph_edges"]:
+            raise ValueError("Unknown batch_budget_key", batch_budget_key)
+    storage_kwargs = {}
     if use_lmdb:
         print("Using LMDB dataset.")
         from alignn.lmdb_dataset import get_torch_dataset
+
+        storage_kwargs = {
+            "compact_graphs": compact_graphs,
+            "store_r": store_r,
+            "store_line_graph": store_line_graph,
+            "readahead": lmdb_readahead,
+            "max_readers": lmdb_max_readers,
+            "workers": preprocess_workers,
+            "label_store": label_store,
+        }
+        if graph_cache_dir is not None:
+            from alignn.graph_cache import GraphCache
+
+            storage_kwargs["graph_cache"] = GraphCache(
+                graph_cache_dir, max_size=int(graph_cache_size * 1024**3)
+            )
     else:
         print("Not using LMDB dataset, memory footprint maybe high.")
         print("WARNING: not using LMDB might result errors.")
@@ -202,12 +352,6 @@ def get_train_val_loaders(
         # print("val", len(val_loader.dataset))
         # print("test", len(test_loader.dataset))
     else:
-        d = jdata(dataset) if dataset_array is None else dataset_array
-
-        # for ii, i in enumerate(pc_y):
-        #    d[ii][target] = pc_y[ii].tolist()
-
-        dat = []
         if classification_threshold is not None:
             print(
                 "Using ",
@@ -218,80 +362,102 @@ def get_train_val_loaders(
             )
             print("Converting target data into 1 and 0.")
         all_targets = []
+        if dataset_stream is None:
+            d = jdata(dataset) if dataset_array is None else dataset_array
 
-        # TODO:make an all key in qm9_dgl
-        if dataset == "qm9_dgl" and target == "all":
-            print("Making all qm9_dgl")
-            tmp = []
-            for ii in d:
-                ii["all"] = [
-                    ii["mu"],
-                    ii["alpha"],
-                    ii["homo"],
-                    ii["lumo"],
-                    ii["gap"],
-                    ii["r2"],
-                    ii["zpve"],
-                    ii["U0"],
-                    ii["U"],
-                    ii["H"],
-                    ii["G"],
-                    ii["Cv"],
-                ]
-                tmp.append(ii)
-            print("Made all qm9_dgl")
-            d = tmp
-        for i in d:
-            if isinstance(i[target], list):  # multioutput target
-                all_targets.append(torch.tensor(i[target]))
-                dat.append(i)
+            # for ii, i in enumerate(pc_y):
+            #    d[ii][target] = pc_y[ii].tolist()
+
+            # TODO:make an all key in qm9_dgl
+            if dataset == "qm9_dgl" and target == "all":
+                print("Making all qm9_dgl")
+                tmp = []
+                for ii in d:
+                    ii["all"] = [
+                        ii["mu"],
+                        ii["alpha"],
+                        ii["homo"],
+                        ii["lumo"],
+                        ii["gap"],
+                        ii["r2"],
+                        ii["zpve"],
+                        ii["U0"],
+                        ii["U"],
+                        ii["H"],
+                        ii["G"],
+                        ii["Cv"],
+                    ]
+                    tmp.append(ii)
+                print("Made all qm9_dgl")
+                d = tmp
+            dat = list(
+                filter_targets(
+                    d,
+                    target=target,
+                    classification_threshold=classification_threshold,
+                    target_multiplication_factor=target_multiplication_factor,
+                    all_targets=all_targets,
+                )
+            )
 
-            elif (
-                i[target] is not None
-                and i[target] != "na"
-                and not math.isnan(i[target])
+            # id_test = ids[-test_size:]
+            # if standardize:
+            #    data.setup_standardizer(id_train)
+            id_train, id_val, id_test = get_id_train_val_test(
+                total_size=len(dat),
+                split_seed=split_seed,
+                train_ratio=train_ratio,
+                val_ratio=val_ratio,
+                test_ratio=test_ratio,
+                n_train=n_train,
+                n_test=n_test,
+                n_val=n_val,
+                keep_data_order=keep_data_order,
+            )
+            ids_train_val_test = {}
+            ids_train_val_test["id_train"] = [dat[i][id_tag] for i in id_train]
+            ids_train_val_test["id_val"] = [dat[i][id_tag] for i in id_val]
+            ids_train_val_test["id_test"] = [dat[i][id_tag] for i in id_test]
+            dumpjson(
+                data=ids_train_val_test,
+                filename=os.path.join(output_dir, "ids_train_val_test.json"),
+            )
+            dataset_train = [dat[x] for x in id_train]
+            dataset_val = [dat[x] for x in id_val]
+            dataset_test = [dat[x] for x in id_test]
+        else:
+            if not use_lmdb:
+                raise ValueError("dataset_stream needs use_lmdb.")
+            if (
+                n_train is not None
+                or n_val is not None
+                or n_test is not None
+                or standard_scalar_and_pca
             ):
-                if target_multiplication_factor is not None:
-                    i[target] = i[target] * target_multiplication_factor
-                if classification_threshold is not None:
-                    if i[target] <= classification_threshold:
-                        i[target] = 0
-                    elif i[target] > classification_threshold:
-                        i[target] = 1
-                    else:
-                        raise ValueError(
-                            "Check classification data type.",
-                            i[target],
-                            type(i[target]),
-                        )
-                dat.append(i)
-                all_targets.append(i[target])
+                raise ValueError(
+                    "dataset_stream splits by ratios only and"
+                    + " does not support standard_scalar_and_pca."
+                )
+            from alignn.streaming import split_filter
 
-        # id_test = ids[-test_size:]
-        # if standardize:
-        #    data.setup_standardizer(id_train)
-        id_train, id_val, id_test = get_id_train_val_test(
-            total_size=len(dat),
-            split_seed=split_seed,
-            train_ratio=train_ratio,
-            val_ratio=val_ratio,
-            test_ratio=test_ratio,
-            n_train=n_train,
-            n_test=n_test,
-            n_val=n_val,
-            keep_data_order=keep_data_order,
-        )
-        ids_train_val_test = {}
-        ids_train_val_test["id_train"] = [dat[i][id_tag] for i in id_train]
-        ids_train_val_test["id_val"] = [dat[i][id_tag] for i in id_val]
-        ids_train_val_test["id_test"] = [dat[i][id_tag] for i in id_test]
-        dumpjson(
-            data=ids_train_val_test,
-            filename=os.path.join(output_dir, "ids_train_val_test.json"),
-        )
-        dataset_train = [dat[x] for x in id_train]
-        dataset_val = [dat[x] for x in id_val]
-        dataset_test = [dat[x] for x in id_test]
+            dataset_train, dataset_val, dataset_test = [
+                filter_targets(
+                    dataset_stream(
+                        split_filter(
+                            split,
+                            split_seed=split_seed,
+                            train_ratio=train_ratio,
+                            val_ratio=val_ratio,
+                            test_ratio=test_ratio,
+                        )
+                    ),
+                    target=target,
+                    classification_threshold=classification_threshold,
+                    target_multiplication_factor=target_multiplication_factor,
+                    all_targets=all_targets,
+                )
+                for split in ["train", "val", "test"]
+            ]
 
         if standard_scalar_and_pca:
             y_data = [i[target] for i in dataset_train]
@@ -322,46 +488,17 @@ def get_train_val_loaders(
             # pc.fit(y_data)
             # pk.dump(pc, open("pca.pkl", "wb"))
 
-        if classification_threshold is None:
-            try:
-                from sklearn.metrics import mean_absolute_error
-
-                print("MAX val:", max(all_targets))
-                print("MIN val:", min(all_targets))
-                print("MAD:", mean_absolute_deviation(all_targets))
-                try:
-                    f = open(os.path.join(output_dir, "mad"), "w")
-                    line = "MAX val:" + str(max(all_targets)) + "\n"
-                    line += "MIN val:" + str(min(all_targets)) + "\n"
-                    line += (
-                        "MAD val:"
-                        + str(mean_absolute_deviation(all_targets))
-                        + "\n"
-                    )
-                    f.write(line)
-                    f.close()
-                except Exception as exp:
-                    print("Cannot write mad", exp)
-                    pass
-                # Random model precited value
-                x_bar = np.mean(np.array([i[target] for i in dataset_train]))
-                baseline_mae = mean_absolute_error(
-                    np.array([i[target] for i in dataset_test]),
-                    np.array([x_bar for i in dataset_test]),
-                )
-                print("Baseline MAE:", baseline_mae)
-            except Exception as exp:
-                print("Data error", exp)
-                pass
-
         if world_size > 1:
             use_ddp = True
-            train_sampler = DistributedSampler(
-                dataset_train, num_replicas=world_size, rank=rank
-            )
-            val_sampler = DistributedSampler(
-                dataset_val, num_replicas=world_size, rank=rank
-            )
+            train_sampler = None
+            val_sampler = None
+            if dataset_stream is None:
+                train_sampler = DistributedSampler(
+                    dataset_train, num_replicas=world_size, rank=rank
+                )
+                val_sampler = DistributedSampler(
+                    dataset_val, num_replicas=world_size, rank=rank
+                )
         else:
             use_ddp = False
             train_sampler = None
@@ -388,6 +525,7 @@ def get_train_val_loaders(
             sampler=train_sampler,
             tmp_name=tmp_name,
             dtype=dtype,
+            **storage_kwargs,
             # tmp_name="train_data",
         )
         tmp_name = filename + "val_data"
@@ -413,9 +551,10 @@ def get_train_val_loaders(
                 output_dir=output_dir,
                 tmp_name=tmp_name,
                 dtype=dtype,
+                **storage_kwargs,
                 # tmp_name="val_data",
             )
-            if len(dataset_val) > 0
+            if dataset_stream is not None or len(dataset_val) > 0
             else None
         )
         tmp_name = filename + "test_data"
@@ -440,29 +579,102 @@ def get_train_val_loaders(
                 output_dir=output_dir,
                 tmp_name=tmp_name,
                 dtype=dtype,
+                **storage_kwargs,
                 # tmp_name="test_data",
             )
-            if len(dataset_test) > 0
+            if dataset_stream is not None or len(dataset_test) > 0
             else None
         )
 
+        if dataset_stream is not None:
+            # splits are known once the streams have been read
+            if len(val_data) == 0:
+                val_data = None
+            if len(test_data) == 0:
+                test_data = None
+            dumpjson(
+                data={
+                    "id_train": train_data.ids,
+                    "id_val": val_data.ids if val_data is not None else [],
+                    "id_test": test_data.ids if test_data is not None else [],
+                },
+                filename=os.path.join(output_dir, "ids_train_val_test.json"),
+            )
+        if classification_threshold is None and all_targets:
+            try:
+                from sklearn.metrics import mean_absolute_error
+
+                print("MAX val:", max(all_targets))
+                print("MIN val:", min(all_targets))
+                print("MAD:", mean_absolute_deviation(all_targets))
+                try:
+                    f = open(os.path.join(output_dir, "mad"), "w")
+                    line = "MAX val:" + str(max(all_targets)) + "\n"
+                    line += "MIN val:" + str(min(all_targets)) + "\n"
+                    line += (
+                        "MAD val:"
+                        + str(mean_absolute_deviation(all_targets))
+                        + "\n"
+                    )
+                    f.write(line)
+                    f.close()
+                except Exception as exp:
+                    print("Cannot write mad", exp)
+                    pass
+                # Random model precited value
+                if dataset_stream is None:
+                    x_bar = np.mean(
+                        np.array([i[target] for i in dataset_train])
+                    )
+                    baseline_mae = mean_absolute_error(
+                        np.array([i[target] for i in dataset_test]),
+                        np.array([x_bar for i in dataset_test]),
+                    )
+                    print("Baseline MAE:", baseline_mae)
+            except Exception as exp:
+                print("Data error", exp)
+                pass
+
         collate_fn = train_data.collate
         # print("line_graph,line_dih_graph", line_graph, line_dih_graph)
         if line_graph:
             collate_fn = train_data.collate_line_graph
+        # LMDB datasets open their environment in each worker
+        worker_init_fn = getattr(train_data, "worker_init_fn", None)
 
-        # use a regular pytorch dataloader
-        train_loader = GraphDataLoader(
-            # train_loader = DataLoader(
-            train_data,
-            batch_size=batch_size,
-            shuffle=True,
-            collate_fn=collate_fn,
-            drop_last=True,
-            num_workers=workers,
-            pin_memory=pin_memory,
-            use_ddp=use_ddp,
-        )
+        if batch_budget is not None:
+            size_columns = ["atoms", "edges", "line_graph_edges"]
+            sizes = train_data.get_sizes()[
+                :, size_columns.index(batch_budget_key)
+            ]
+            train_loader = GraphDataLoader(
+                train_data,
+                batch_sampler=BucketBatchSampler(
+                    sizes,
+                    budget=batch_budget,
+                    num_replicas=max(world_size, 1),
+                    rank=rank,
+                    seed=split_seed,
+                ),
+                collate_fn=collate_fn,
+                num_workers=workers,
+                pin_memory=pin_memory,
+                worker_init_fn=worker_init_fn,
+            )
+        else:
+            # use a regular pytorch dataloader
+            train_loader = GraphDataLoader(
+                # train_loader = DataLoader(
+                train_data,
+                batch_size=batch_size,
+                shuffle=True,
+                collate_fn=collate_fn,
+                drop_last=True,
+                num_workers=workers,
+                pin_memory=pin_memory,
+                use_ddp=use_ddp,
+                worker_init_fn=worker_init_fn,
+            )
 
         val_loader = GraphDataLoader(
             # val_loader = DataLoader(
@@ -474,6 +686,7 @@ def get_train_val_loaders(
             num_workers=workers,
             pin_memory=pin_memory,
             use_ddp=use_ddp,
+            worker_init_fn=worker_init_fn,
         )
 
         test_loader = (
@@ -487,8 +700,9 @@ def get_train_val_loaders(
                 num_workers=workers,
                 pin_memory=pin_memory,
                 use_ddp=use_ddp,
+                worker_init_fn=worker_init_fn,
             )
-            if len(dataset_test) > 0
+            if test_data is not None
             else None
         )
 
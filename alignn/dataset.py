@@ -4,11 +4,11 @@ from pathlib import Path
 from typing import Optional
 import os
 import torch
-import dgl
 import numpy as np
 import pandas as pd
 from jarvis.core.atoms import Atoms
 from alignn.graphs import Graph, StructureDataset
+from alignn.graph_cache import GraphCache
 from tqdm import tqdm
 
 tqdm.pandas()
@@ -60,52 +60,46 @@ def load_graphs(
             dtype=dtype,
         )
 
+    # graphs are cached one by one in a GraphCache under cachedir
+    build_graph = Graph.atom_dgl_multigraph
     if cachedir is not None:
-        cachefile = cachedir / f"{name}-{neighbor_strategy}.bin"
-    else:
-        cachefile = None
-
-    if cachefile is not None and cachefile.is_file():
-        graphs, labels = dgl.load_graphs(str(cachefile))
-    else:
-        # print('dataset',dataset,type(dataset))
-        print("Converting to graphs!")
-        graphs = []
-        # columns=dataset.columns
-        for ii, i in tqdm(dataset.iterrows(), total=len(dataset)):
-            # print('iooooo',i)
-            atoms = i["atoms"]
-            structure = (
-                Atoms.from_dict(atoms) if isinstance(atoms, dict) else atoms
-            )
-            g = Graph.atom_dgl_multigraph(
-                structure,
-                cutoff=cutoff,
-                cutoff_extra=cutoff_extra,
-                atom_features="atomic_number",
-                max_neighbors=max_neighbors,
-                compute_line_graph=False,
-                use_canonize=use_canonize,
-                neighbor_strategy=neighbor_strategy,
-                id=i[id_tag],
-                dtype=dtype,
-            )
-            # print ('ii',ii)
-            if "extra_features" in i:
-                natoms = len(atoms["elements"])
-                # if "extra_features" in columns:
-                g.ndata["extra_features"] = torch.tensor(
-                    [i["extra_features"] for n in range(natoms)]
-                ).type(torch.get_default_dtype())
-            graphs.append(g)
+        build_graph = GraphCache(str(cachedir)).get_graph
+    # print('dataset',dataset,type(dataset))
+    print("Converting to graphs!")
+    graphs = []
+    # columns=dataset.columns
+    for ii, i in tqdm(dataset.iterrows(), total=len(dataset)):
+        # print('iooooo',i)
+        atoms = i["atoms"]
+        structure = (
+            Atoms.from_dict(atoms) if isinstance(atoms, dict) else atoms
+        )
+        g = build_graph(
+            structure,
+            cutoff=cutoff,
+            cutoff_extra=cutoff_extra,
+            atom_features="atomic_number",
+            max_neighbors=max_neighbors,
+            compute_line_graph=False,
+            use_canonize=use_canonize,
+            neighbor_strategy=neighbor_strategy,
+            id=i[id_tag],
+            dtype=dtype,
+        )
+        # print ('ii',ii)
+        if "extra_features" in i:
+            natoms = len(atoms["elements"])
+            # if "extra_features" in columns:
+            g.ndata["extra_features"] = torch.tensor(
+                [i["extra_features"] for n in range(natoms)]
+            ).type(torch.get_default_dtype())
+        graphs.append(g)
 
-        # df = pd.DataFrame(dataset)
-        # print ('df',df)
+    # df = pd.DataFrame(dataset)
+    # print ('df',df)
 
-        # graphs = df["atoms"].progress_apply(atoms_to_graph).values
-        # print ('graphs',graphs,graphs[0])
-        if cachefile is not None:
-            dgl.save_graphs(str(cachefile), graphs.tolist())
+    # graphs = df["atoms"].progress_apply(atoms_to_graph).values
+    # print ('graphs',graphs,graphs[0])
 
     return graphs
 
@@ -7,8 +7,14 @@ import requests
 import ase.calculators.calculator
 from ase.stress import full_3x3_to_voigt_6_stress
 from jarvis.db.jsonutils import loadjson
-from alignn.graphs import Graph
+from alignn.graphs import Graph, radius_graph_cutoff, triplet_line_graph
+from alignn.graph_cache import GRAPH_PARAMS
 from alignn.models.alignn_atomwise import ALIGNNAtomWise, ALIGNNAtomWiseConfig
+from alignn.models.alignn_atomwise_torch import (
+    ALIGNNAtomWiseTorch,
+    check_torch_config,
+    graph_inputs,
+)
 from alignn.models.ealignn_atomwise import (
     eALIGNNAtomWise,
     eALIGNNAtomWiseConfig,
@@ -19,6 +25,7 @@ import zipfile
 import numpy as np
 from tqdm import tqdm
 import torch
+import dgl
 
 # Reference: https://doi.org/10.1039/D2DD00096B
 
@@ -191,8 +198,18 @@ class AlignnAtomwiseCalculator(ase.calculators.calculator.Calculator):
         force_mult_batchsize=True,
         force_multiplier=1,
         stress_wt=0.05,
+        skin=None,
+        backend="dgl",
     ):
-        """Initialize class."""
+        """Initialize class.
+
+        skin: Verlet skin in Angstrom. If set, radius graph neighbor lists
+        are reused across calls until atom moves or cell strain could
+        bring a bond from outside the list within cutoff, only bond
+        vectors are recomputed in between.
+        backend: "torch" runs alignn_atomwise models with
+        ALIGNNAtomWiseTorch, without DGL message passing.
+        """
         super(AlignnAtomwiseCalculator, self).__init__(
             restart, ignore_bad_restart_file, label, atoms, directory
         )  # , **kwargs
@@ -205,6 +222,9 @@ class AlignnAtomwiseCalculator(ase.calculators.calculator.Calculator):
         self.force_mult_natoms = force_mult_natoms
         self.force_mult_batchsize = force_mult_batchsize
         self.force_multiplier = force_multiplier
+        self.skin = skin
+        self.backend = backend
+        self.neighbor_cache = None
         self.trained_stress = False
         if path is None and model is None:
             path = default_path()
@@ -244,6 +264,14 @@ class AlignnAtomwiseCalculator(ase.calculators.calculator.Calculator):
             self.device = torch.device(
                 "cuda" if torch.cuda.is_available() else "cpu"
             )
+        if self.backend == "torch":
+            # before loading weights that couldn't be used
+            if self.config["model"]["name"] != "alignn_atomwise":
+                raise ValueError(
+                    "torch backend needs an alignn_atomwise model",
+                    self.config["model"]["name"],
+                )
+            check_torch_config(ALIGNNAtomWiseConfig(**self.config["model"]))
         if self.model is None:
 
             if self.config["model"]["name"] == "alignn_atomwise":
@@ -276,21 +304,140 @@ class AlignnAtomwiseCalculator(ase.calculators.calculator.Calculator):
             self.model = model
         else:
             model = self.model
+        if self.backend == "torch":
+            torch_model = ALIGNNAtomWiseTorch(
+                ALIGNNAtomWiseConfig(**self.config["model"])
+            )
+            torch_model.load_state_dict(model.state_dict())
+            torch_model.to(self.device)
+            torch_model.eval()
+            self.model = torch_model
+
+    def get_graph(self, atoms):
+        """Get graph and line graph, reusing the neighbor list within skin.
+
+        Only radius graph strategies reuse the list: neighbors are searched
+        out to skin beyond the cutoff a fresh build would extend to, and
+        the bonds within that cutoff are kept, so the graph matches a
+        fresh build while no bond outside the list can have come within
+        it. Bond vectors are recomputed from the current fractional
+        coordinates and cell, so cell changes (NPT, cell relaxations)
+        reuse the list too. Other strategies rebuild on every call.
+        """
+        j_atoms = ase_to_atoms(atoms)
+        neighbor_strategy = self.config["neighbor_strategy"]
+        cutoff = self.config["cutoff"]
+        # k-nearest bonds can change rank and radius_graph_jarvis edge
+        # data can't be shifted, always rebuild
+        if self.skin is None or neighbor_strategy not in [
+            "radius_graph",
+            "radius_graph_cell_list",
+        ]:
+            return Graph.atom_dgl_multigraph(
+                j_atoms,
+                neighbor_strategy=neighbor_strategy,
+                cutoff=cutoff,
+                max_neighbors=self.config["max_neighbors"],
+                atom_features=self.config["atom_features"],
+                use_canonize=self.config["use_canonize"],
+            )
+        cutoff_extra = GRAPH_PARAMS["cutoff_extra"]
+        lattice = np.array(j_atoms.lattice_mat)
+        frac_coords = np.array(j_atoms.frac_coords)
+        cache = self.neighbor_cache
+        rebuild = cache is None or not np.array_equal(
+            atoms.numbers, cache["numbers"]
+        )
+        if not rebuild:
+            # undo wrapping of atoms into the cell since the last build
+            frac_coords = frac_coords - np.rint(
+                frac_coords - cache["frac_coords"]
+            )
+            disp = (frac_coords - cache["frac_coords"]) @ cache["lattice"]
+            max_disp = np.max(np.linalg.norm(disp, axis=1))
+            # smallest stretch of any vector by the cell change
+            strain = np.linalg.svd(
+                np.linalg.solve(cache["lattice"], lattice), compute_uv=False
+            ).min()
+            # bonds missing from the list were longer than its cutoff
+            safe_cutoff = (cache["cutoff"] - 2 * max_disp) * strain
+            r = self.bond_vectors(cache["graph"], frac_coords, lattice)
+            # fresh builds extend cutoff until the last atom has a bond
+            last = cache["graph"].edges()[0] == len(frac_coords) - 1
+            d = torch.norm(r[last], dim=1)
+            d = d[d <= safe_cutoff]
+            rebuild = len(d) == 0
+            if not rebuild:
+                graph_cutoff = cutoff
+                while not d.min() <= graph_cutoff:
+                    graph_cutoff += cutoff_extra
+                rebuild = graph_cutoff > safe_cutoff
+        if rebuild:
+            graph_cutoff = radius_graph_cutoff(
+                j_atoms, cutoff=cutoff, cutoff_extra=cutoff_extra
+            )
+            g = Graph.atom_dgl_multigraph(
+                j_atoms,
+                neighbor_strategy=neighbor_strategy,
+                cutoff=graph_cutoff + self.skin,
+                max_neighbors=self.config["max_neighbors"],
+                atom_features=self.config["atom_features"],
+                use_canonize=self.config["use_canonize"],
+                cutoff_extra=cutoff_extra,
+                compute_line_graph=False,
+            )
+            frac_coords = np.array(j_atoms.frac_coords)
+            cache = {
+                "numbers": np.array(atoms.numbers),
+                "lattice": lattice,
+                "frac_coords": frac_coords,
+                "cutoff": graph_cutoff + self.skin,
+                "graph": g,
+            }
+            self.neighbor_cache = cache
+            r = self.bond_vectors(g, frac_coords, lattice)
+
+        cached_g = cache["graph"]
+        u, v = cached_g.edges()
+        keep = torch.norm(r, dim=1) <= graph_cutoff
+        g = dgl.graph((u[keep], v[keep]), num_nodes=cached_g.num_nodes())
+        for key, value in cached_g.ndata.items():
+            g.ndata[key] = value
+        # unwrapped like the cached ones, to match the images
+        g.ndata["frac_coords"] = torch.tensor(frac_coords).type(
+            cached_g.ndata["frac_coords"].dtype
+        )
+        g.ndata["V"] = torch.full_like(
+            cached_g.ndata["V"], abs(np.linalg.det(lattice))
+        )
+        for key, value in cached_g.edata.items():
+            g.edata[key] = value[keep]
+        g.edata["r"] = r[keep]
+        return g, triplet_line_graph(g)
+
+    @staticmethod
+    def bond_vectors(g=None, frac_coords=[], lattice=[]):
+        """Get the bond vectors of g for fractional coordinates and cell."""
+        u, v = g.edges()
+        images = g.edata["images"].numpy().astype(np.float64)
+        r = (frac_coords[v] + images - frac_coords[u]) @ lattice
+        return torch.tensor(r).type(g.edata["r"].dtype)
 
     def calculate(self, atoms, properties=None, system_changes=None):
         """Calculate properties."""
         j_atoms = ase_to_atoms(atoms)
         num_atoms = j_atoms.num_atoms
-        g, lg = Graph.atom_dgl_multigraph(
-            j_atoms,
-            neighbor_strategy=self.config["neighbor_strategy"],
-            cutoff=self.config["cutoff"],
-            max_neighbors=self.config["max_neighbors"],
-            atom_features=self.config["atom_features"],
-            use_canonize=self.config["use_canonize"],
-        )
+        g, lg = self.get_graph(atoms)
 
-        if self.config["model"]["alignn_layers"] > 0:
+        if self.backend == "torch":
+            result = self.model(
+                **graph_inputs(
+                    g.to(self.device),
+                    lg.to(self.device),
+                    dtype=torch.get_default_dtype(),
+                )
+            )
+        elif self.config["model"]["alignn_layers"] > 0:
             result = self.model(
                 (
                     g.to(self.device),
@@ -287,6 +287,7 @@ class ForceField(object):
         force_multiplier=1.0,
         force_mult_natoms=False,
         batch_stress=True,
+        skin=None,
     ):
         """Intialize class."""
         self.jarvis_atoms = jarvis_atoms
@@ -303,6 +304,7 @@ class ForceField(object):
         self.batch_stress = batch_stress
         self.force_multiplier = force_multiplier
         self.force_mult_natoms = force_mult_natoms
+        self.skin = skin
         if self.timestep is None:
             self.timestep = 0.01
         # Convert in appropriate units
@@ -331,6 +333,7 @@ class ForceField(object):
                 stress_wt=self.stress_wt,
                 force_mult_natoms=self.force_mult_natoms,
                 batch_stress=self.batch_stress,
+                skin=self.skin,
                 # device="cuda" if torch.cuda.is_available() else "cpu",
             )
         )
@@ -0,0 +1,156 @@
+"""Module for an on-disk cache of crystal graphs."""
+
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import numpy as np
+import torch
+from alignn.graphs import (
+    GRAPH_VERSION,
+    Graph,
+    compact_graph,
+    expand_graph,
+    triplet_line_graph,
+)
+from alignn.lmdb_dataset import (
+    RECORD_VERSION,
+    deserialize_graphs,
+    serialize_graphs,
+)
+
+# graph construction parameters of Graph.atom_dgl_multigraph and defaults
+GRAPH_PARAMS = {
+    k: v.default
+    for k, v in inspect.signature(Graph.atom_dgl_multigraph).parameters.items()
+    if k not in ["atoms", "id", "compute_line_graph"]
+}
+
+
+def structure_hash(atoms=None, **params):
+    """Get a hash of the structure and graph construction parameters.
+
+    Parameters not given take the atom_dgl_multigraph defaults, so equal
+    graphs get equal keys however they were requested. The key also
+    covers the default dtype and the graph and record versions.
+    """
+    params = {**GRAPH_PARAMS, **params}
+    params["default_dtype"] = str(torch.get_default_dtype())
+    params["graph_version"] = GRAPH_VERSION
+    params["record_version"] = RECORD_VERSION
+    h = hashlib.sha256()
+    for arr in [atoms.lattice_mat, atoms.frac_coords]:
+        # round off float noise and -0.0 before hashing the bytes
+        arr = np.round(np.array(arr, dtype=np.float64), 8) + 0.0
+        h.update(arr.tobytes())
+    h.update(" ".join(atoms.elements).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class GraphCache(object):
+    """Size bounded LRU cache of crystal graphs on disk.
+
+    Graphs are stored with `compact_graph` in the binary record format
+    of the LMDB datasets, one file per key under cache_dir, so the cache
+    can be shared by dataset splits, experiments and processes. Reading
+    a graph refreshes its mtime. The cache size is checked every
+    max_size / 10 bytes written by this process and the least recently
+    used graphs are then evicted if it is beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir="graph_cache", max_size=10 * 1024**3):
+        """Initialize with cache directory and size limit in bytes."""
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # bytes written since the cache size was last checked
+        self.written = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key=""):
+        """Get the file of a key."""
+        return os.path.join(self.cache_dir, key[:2], key + ".bin")
+
+    def files(self):
+        """Get (mtime, size, path) of every cached graph."""
+        files = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".bin"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        # evicted by another process
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get(self, key=""):
+        """Get a cached graph, None if missing."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                buf = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return deserialize_graphs(buf)[0]
+
+    def put(self, key="", record={}):
+        """Store a `compact_graph` record."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buf = serialize_graphs(
+            record, None, torch.tensor(record["lattice_mat"])
+        )
+        # write then rename, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(buf)
+        os.replace(tmp_path, path)
+        self.written += len(buf)
+        if self.written > 0.1 * self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used graphs down to 90% of max_size."""
+        files = sorted(self.files())
+        size = sum(i[1] for i in files)
+        for mtime, file_size, path in files:
+            if size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self.written = 0
+
+    def get_graph(
+        self, atoms=None, compute_line_graph=True, id=None, **params
+    ):
+        """Get graph (and line graph) of atoms, building it if not cached.
+
+        params are passed to Graph.atom_dgl_multigraph.
+        """
+        key = structure_hash(atoms, **params)
+        g = self.get(key)
+        if g is None:
+            g = Graph.atom_dgl_multigraph(
+                atoms, compute_line_graph=False, id=id, **params
+            )
+            record = compact_graph(
+                g,
+                atomic_numbers=atoms.atomic_numbers,
+                lattice_mat=atoms.lattice_mat,
+                atom_features=params.get(
+                    "atom_features", GRAPH_PARAMS["atom_features"]
+                ),
+            )
+            self.put(key, record)
+            g = expand_graph(record)
+        if compute_line_graph:
+            return g, triplet_line_graph(g)
+        return g
@@ -9,16 +9,148 @@ from collections import OrderedDict
 from jarvis.analysis.structure.neighbors import NeighborsAnalysis
 from jarvis.core.specie import chem_data, get_node_attributes
 import math
+import functools
 from collections import defaultdict
 from typing import List, Tuple, Sequence, Optional
 from dgl.data import DGLDataset
 import torch
 import dgl
-from tqdm import tqdm
-from jarvis.core.atoms import Atoms
 
 # import matgl
 
+# version of the graph builders, bump it when the graphs they build
+# change so cached graphs (alignn.graph_cache) are rebuilt
+GRAPH_VERSION = 1
+
+# number of structures whose cutoff had to be extended, per strategy
+cutoff_extensions = defaultdict(int)
+
+
+def periodic_distances(atoms=None, site_ids=[], cutoff=5, bond_tol=0.5):
+    """Get distances from selected sites to all periodic atom images.
+
+    Returns a (len(site_ids), num_images * num_atoms) tensor, the images
+    cover at least every point within cutoff of the sites.
+    """
+    cart_coords = torch.tensor(atoms.cart_coords).type(
+        torch.get_default_dtype()
+    )
+    frac_coords = torch.tensor(atoms.frac_coords).type(
+        torch.get_default_dtype()
+    )
+    lattice_mat = torch.tensor(atoms.lattice_mat).type(
+        torch.get_default_dtype()
+    )
+    recp = 2 * math.pi * torch.linalg.inv(lattice_mat).T
+    recp_len = torch.sqrt(torch.sum(recp**2, dim=1))
+    maxr = torch.ceil((cutoff + bond_tol) * recp_len / (2 * math.pi))
+    nmin = torch.floor(torch.min(frac_coords, dim=0)[0]) - maxr
+    nmax = torch.ceil(torch.max(frac_coords, dim=0)[0]) + maxr
+    all_ranges = [
+        torch.arange(x, y, dtype=torch.get_default_dtype())
+        for x, y in zip(nmin, nmax)
+    ]
+    cell_images = torch.cartesian_prod(*all_ranges)
+    X_dst = ((cell_images @ lattice_mat)[:, None, :] + cart_coords).reshape(
+        -1, 3
+    )
+    return torch.cdist(
+        cart_coords[site_ids],
+        X_dst,
+        compute_mode="donot_use_mm_for_euclid_dist",
+    )
+
+
+def lattice_image_cutoff(lattice_mat=[], k=1):
+    """Get an upper bound on the distance to the k-th periodic self image."""
+    m = 1
+    while (2 * m + 1) ** 3 - 1 < k:
+        m += 1
+    n = np.arange(-m, m + 1)
+    n = np.array(np.meshgrid(n, n, n)).reshape(3, -1).T
+    lengths = np.linalg.norm(n @ np.array(lattice_mat), axis=1)
+    return np.sort(lengths[np.any(n != 0, axis=1)])[k - 1]
+
+
+def extend_cutoff(
+    cutoff=5, min_dist=None, cutoff_extra=0.5, neighbor_strategy=None
+):
+    """Step cutoff by cutoff_extra until it reaches min_dist.
+
+    Gives the cutoff the retry loops of the graph builders would end
+    up with, without building a graph for every step.
+    """
+    steps = 0
+    while not min_dist <= cutoff:
+        cutoff += cutoff_extra
+        steps += 1
+    if steps > 0:
+        cutoff_extensions[neighbor_strategy] += 1
+    return cutoff, steps
+
+
+def nearest_neighbor_cutoff(
+    atoms=None, cutoff=8, max_neighbors=12, site_ids=[], bond_tol=0.15
+):
+    """Get the cutoff the k-NN builders would extend to in one step.
+
+    Follows their cutoff schedule (longest lattice length, then doubling)
+    until site_ids all have max_neighbors neighbors, using the k-th
+    neighbor distance of each site.
+    """
+    dist = periodic_distances(
+        atoms,
+        site_ids,
+        cutoff=lattice_image_cutoff(atoms.lattice_mat, k=max_neighbors),
+    )
+    # get_all_neighbors skips neighbors closer than bond_tol
+    dist[dist <= bond_tol] = float("inf")
+    max_dist = torch.kthvalue(dist, max_neighbors, dim=1)[0].max()
+    lat = atoms.lattice
+    r_cut = cutoff
+    while True:
+        if r_cut < max(lat.a, lat.b, lat.c):
+            r_cut = max(lat.a, lat.b, lat.c)
+        else:
+            r_cut = 2 * r_cut
+        if max_dist <= r_cut:
+            break
+    cutoff_extensions["k-nearest"] += 1
+    return r_cut
+
+
+@functools.lru_cache(maxsize=None)
+def get_attribute_lookup(atom_features="cgcnn"):
+    """Build a node feature lookup table indexed by atomic number.
+
+    Built once per process for each atom_features mode. The table is
+    shared, callers must not modify it in place.
+    """
+    max_z = max(v["Z"] for v in chem_data.values())
+
+    # get feature shape (referencing Carbon)
+    template = get_node_attributes("C", atom_features)
+
+    features = np.zeros((1 + max_z, len(template)))
+
+    for element, v in chem_data.items():
+        z = v["Z"]
+        x = get_node_attributes(element, atom_features)
+
+        if x is not None:
+            features[z, :] = x
+
+    return torch.tensor(features)
+
+
+def get_atom_features(elements=[], atom_features="cgcnn"):
+    """Get node features for a list of elements from the lookup table."""
+    species, species_ids = np.unique(elements, return_inverse=True)
+    z = torch.tensor([chem_data[s]["Z"] for s in species], dtype=torch.long)
+    return get_attribute_lookup(atom_features)[
+        z[torch.tensor(species_ids.reshape(-1), dtype=torch.long)]
+    ]
+
 
 def temp_graph(
     atoms=None, cutoff=4.0, atom_features="atomic_number", dtype="float32"
@@ -31,37 +163,57 @@ def temp_graph(
         "bfloat": torch.bfloat16,
     }
     dtype = TORCH_DTYPES[dtype]
-    u, v, r, d, images, atom_feats = [], [], [], [], [], []
     elements = atoms.elements
 
-    # Loop over each atom in the structure
-    for ii, i in enumerate(atoms.cart_coords):
-        # Get neighbors within the cutoff distance
-        neighs = atoms.lattice.get_points_in_sphere(
-            atoms.frac_coords, i, cutoff, distance_vector=True
-        )
-
-        # Filter out self-loops (exclude cases where atom is bonded to itself)
-        valid_indices = neighs[2] != ii
-
-        u.extend([ii] * np.sum(valid_indices))
-        d.extend(neighs[1][valid_indices])
-        v.extend(neighs[2][valid_indices])
-        images.extend(neighs[3][valid_indices])
-        r.extend(neighs[4][valid_indices])
-
-        feat = list(
-            get_node_attributes(elements[ii], atom_features=atom_features)
-        )
-        atom_feats.append(feat)
+    # periodic images lattice.get_points_in_sphere would search,
+    # taken over all atoms at once
+    recp_len = np.array(atoms.lattice.reciprocal_lattice().lat_lengths()) / (
+        2 * np.pi
+    )
+    nmax = float(cutoff) * recp_len + 0.01
+    pcoords = atoms.lattice.frac_coords(atoms.cart_coords)
+    mins = np.floor(np.min(pcoords, axis=0) - nmax)
+    maxes = np.ceil(np.max(pcoords, axis=0) + nmax)
+    all_ranges = [
+        np.arange(start=x, stop=y, dtype="int") for x, y in zip(mins, maxes)
+    ]
+    cell_images = np.stack(
+        np.meshgrid(*all_ranges, indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    num_images = len(cell_images)
+
+    # neighbors are the atoms wrapped into the cell and their images,
+    # index into X_dst is atom * num_images + image
+    cart_coords = atoms.lattice.cart_coords(np.array(atoms.frac_coords) % 1)
+    cart_images = atoms.lattice.cart_coords(cell_images)
+    X_dst = (cart_coords[:, None, :] + cart_images[None, :, :]).reshape(-1, 3)
+    X_src = np.array(atoms.cart_coords)
+    u, v = cell_list_neighbors(
+        torch.tensor(X_src), torch.tensor(X_dst), cutoff=cutoff, atol=0
+    )
+    u, v = u.numpy(), v.numpy()
+    r = X_dst[v] - X_src[u]
+    d = np.sqrt(np.sum(r**2, axis=1))
+    # get_points_in_sphere squares its distance vectors in place,
+    # keep r as it was so existing models see the same edge data
+    r = r**2
+    images = cell_images[v % num_images]
+    v = v // num_images
+
+    # Filter out self-loops (exclude cases where atom is bonded to itself)
+    valid_indices = v != u
+    u, v = u[valid_indices], v[valid_indices]
+    r, images = r[valid_indices], images[valid_indices]
+    d = d[valid_indices]
+
+    atom_feats = get_atom_features(elements, atom_features=atom_features)
 
     # Create DGL graph
-    g = dgl.graph((np.array(u), np.array(v)))
-    atom_feats = np.array(atom_feats)
+    g = dgl.graph((u, v))
     # Add data to the graph with the specified dtype
     # print('atom_feats',atom_feats,atom_feats.shape)
-    g.ndata["atom_features"] = torch.tensor(atom_feats, dtype=dtype)
-    g.ndata["Z"] = torch.tensor(atom_feats, dtype=torch.int64)
+    g.ndata["atom_features"] = atom_feats.type(dtype)
+    g.ndata["Z"] = atom_feats.type(torch.int64)
     g.edata["r"] = torch.tensor(np.array(r), dtype=dtype)
     g.edata["d"] = torch.tensor(d, dtype=dtype)
     # g.edata["pbc_offset"] = torch.tensor(images, dtype=dtype)
@@ -93,6 +245,21 @@ def radius_graph_jarvis(
 ):
     """Construct radius graph with jarvis tools."""
     count = 0
+    if atoms.num_atoms > 1:
+        # the last atom needs a neighbor other than its own images,
+        # any atom has one within half the sum of the lattice lengths
+        last = atoms.num_atoms - 1
+        dist = periodic_distances(
+            atoms,
+            [last],
+            cutoff=0.5 * sum(atoms.lattice.abc),
+        ).reshape(-1, atoms.num_atoms)
+        cutoff, count = extend_cutoff(
+            cutoff,
+            dist[:, :last].min(),
+            cutoff_extra,
+            neighbor_strategy="radius_graph_jarvis",
+        )
     while count <= max_attempts:
         # try:
         # Attempt to create the graph
@@ -118,8 +285,7 @@ def radius_graph_jarvis(
         raise ValueError("Failed after", max_attempts, atoms)
     # Optional: Create a line graph if requested
     if line_graph:
-        lg = g.line_graph(shared=True)
-        lg.apply_edges(compute_bond_cosines)
+        lg = triplet_line_graph(g)
         return g, lg
 
     return g
@@ -170,11 +336,16 @@ def nearest_neighbor_edges(
     # print ('cutoff=',all_neighbors)
     if min_nbrs < max_neighbors:
         # print("extending cutoff radius!", attempt, cutoff, id)
-        lat = atoms.lattice
-        if cutoff < max(lat.a, lat.b, lat.c):
-            r_cut = max(lat.a, lat.b, lat.c)
-        else:
-            r_cut = 2 * cutoff
+        r_cut = nearest_neighbor_cutoff(
+            atoms=atoms,
+            cutoff=cutoff,
+            max_neighbors=max_neighbors,
+            site_ids=[
+                ii
+                for ii, neighborlist in enumerate(all_neighbors)
+                if len(neighborlist) < max_neighbors
+            ],
+        )
         attempt += 1
 
         return nearest_neighbor_edges(
@@ -264,6 +435,222 @@ def build_undirected_edgedata(
     return u, v, r, all_images
 
 
+def nearest_neighbor_edge_arrays(
+    atoms=None,
+    cutoff=8,
+    max_neighbors=12,
+    id=None,
+    use_canonize=False,
+):
+    """Construct k-NN edge list with whole-array operations.
+
+    Vectorized version of `nearest_neighbor_edges`. Returns the unique
+    directed edges as (src_ids, dst_ids, dst_images) arrays, ordered the
+    way `build_undirected_edgedata` iterates the edge dictionary.
+    """
+    all_neighbors = atoms.get_all_neighbors(r=cutoff)
+    counts = np.array([len(neighborlist) for neighborlist in all_neighbors])
+
+    # if a site has too few neighbors, increase the cutoff radius
+    if counts.min() < max_neighbors:
+        r_cut = nearest_neighbor_cutoff(
+            atoms=atoms,
+            cutoff=cutoff,
+            max_neighbors=max_neighbors,
+            site_ids=np.flatnonzero(counts < max_neighbors),
+        )
+        return nearest_neighbor_edge_arrays(
+            atoms=atoms,
+            use_canonize=use_canonize,
+            cutoff=r_cut,
+            max_neighbors=max_neighbors,
+            id=id,
+        )
+
+    # flatten [site, neighbor, distance, image] records
+    flat = [nbr for neighborlist in all_neighbors for nbr in neighborlist]
+    sites = np.repeat(np.arange(len(all_neighbors)), counts)
+    ids = np.array([nbr[1] for nbr in flat], dtype=np.int64)
+    distances = np.array([nbr[2] for nbr in flat], dtype=float)
+    images = np.array([nbr[3] for nbr in flat], dtype=float).reshape(-1, 3)
+
+    # stable sort on distance within each site
+    order = np.lexsort((distances, sites))
+    sites, ids = sites[order], ids[order]
+    distances, images = distances[order], images[order]
+
+    # keep all edges out to the neighbor shell of the k-th neighbor
+    starts = np.cumsum(counts) - counts
+    max_dist = distances[starts + max_neighbors - 1]
+    keep = distances <= max_dist[sites]
+    sites, ids, images = sites[keep], ids[keep], images[keep]
+
+    if use_canonize:
+        # store directed edges src_id <= dst_id
+        # with src shifted into the (0,0,0) image
+        swap = ids < sites
+        src_ids = np.where(swap, ids, sites)
+        dst_ids = np.where(swap, sites, ids)
+        images = np.where(swap[:, None], np.subtract(0, images), images)
+    else:
+        src_ids, dst_ids = sites, ids
+
+    # drop duplicate (src, dst, image) edges, keep first appearance
+    keys = np.column_stack(
+        [src_ids, dst_ids, np.rint(images).astype(np.int64)]
+    )
+    _, first = np.unique(keys, axis=0, return_index=True)
+    first = np.sort(first)
+    src_ids, dst_ids, images = src_ids[first], dst_ids[first], images[first]
+
+    # group edges by (src, dst) in order of first appearance
+    _, pair_first, pair_inv = np.unique(
+        np.column_stack([src_ids, dst_ids]),
+        axis=0,
+        return_index=True,
+        return_inverse=True,
+    )
+    group = pair_first[pair_inv.reshape(-1)]
+    order = np.argsort(group, kind="stable")
+    src_ids, dst_ids = src_ids[order], dst_ids[order]
+    images, group = images[order], group[order]
+
+    # images of one (src, dst) pair used to live in a python set:
+    # replay its iteration order so graphs are unchanged bit-for-bit
+    bounds = np.flatnonzero(np.diff(group)) + 1
+    group_starts = np.concatenate([[0], bounds])
+    group_ends = np.concatenate([bounds, [len(group)]])
+    multi = np.flatnonzero(group_ends - group_starts > 1)
+    if len(multi) > 0:
+        perm = np.arange(len(group))
+        image_tuples = [tuple(x) for x in images.tolist()]
+        for gid in multi:
+            s, e = group_starts[gid], group_ends[gid]
+            members = {image_tuples[i]: i for i in range(s, e)}
+            perm[s:e] = [members[x] for x in set(image_tuples[s:e])]
+        src_ids, dst_ids, images = src_ids[perm], dst_ids[perm], images[perm]
+
+    return src_ids, dst_ids, images
+
+
+def build_undirected_edge_arrays(
+    atoms=None,
+    src_ids=[],
+    dst_ids=[],
+    dst_images=[],
+):
+    """Build undirected graph data from edge arrays.
+
+    Vectorized version of `build_undirected_edgedata`,
+    emits both directions of every edge.
+    r: cartesian displacement vector from src -> dst
+    """
+    frac_coords = np.array(atoms.frac_coords)
+    src_ids = np.asarray(src_ids, dtype=np.int64)
+    dst_ids = np.asarray(dst_ids, dtype=np.int64)
+    dst_images = np.asarray(dst_images, dtype=float).reshape(-1, 3)
+    # fractional coordinate for periodic image of dst
+    dst_coord = frac_coords[dst_ids] + dst_images
+    # cartesian displacement vector pointing from src -> dst
+    d = np.array(
+        atoms.lattice.cart_coords(dst_coord - frac_coords[src_ids])
+    ).reshape(-1, 3)
+    # add edges for both directions
+    u = np.stack([src_ids, dst_ids], axis=1).reshape(-1)
+    v = np.stack([dst_ids, src_ids], axis=1).reshape(-1)
+    r = np.stack([d, -d], axis=1).reshape(-1, 3)
+    all_images = np.repeat(dst_images, 2, axis=0)
+    u = torch.tensor(u)
+    v = torch.tensor(v)
+    r = torch.tensor(r).type(torch.get_default_dtype())
+    all_images = torch.tensor(all_images).type(torch.get_default_dtype())
+
+    return u, v, r, all_images
+
+
+def cell_list_neighbors(X_src, X_dst, cutoff=5, atol=1e-5):
+    """Find (src, dst) index pairs within cutoff with a linked-cell search.
+
+    X_dst is binned on a cubic grid with spacing >= cutoff, so every
+    X_src point only needs distances to points in its 27 surrounding bins.
+    Time and memory are O(N) instead of the dense O(N * M) distance matrix.
+    Pairs are returned in the same row-major order as
+    `torch.where(dist <= cutoff)` on the dense matrix.
+    """
+    num_src = X_src.shape[0]
+    num_dst = X_dst.shape[0]
+    bin_size = max(float(cutoff), atol)
+    origin = torch.min(X_dst, dim=0)[0]
+    dst_bins = torch.floor((X_dst - origin) / bin_size).long()
+    src_bins = torch.floor((X_src - origin) / bin_size).long()
+    n_bins = torch.max(dst_bins, dim=0)[0] + 1
+
+    def linear_bin(b):
+        return (b[:, 0] * n_bins[1] + b[:, 1]) * n_bins[2] + b[:, 2]
+
+    # sort dst points by bin, CSR offsets into the sorted order
+    dst_order = torch.argsort(linear_bin(dst_bins))
+    bin_counts = torch.bincount(
+        linear_bin(dst_bins), minlength=int(torch.prod(n_bins))
+    )
+    bin_starts = torch.cumsum(bin_counts, dim=0) - bin_counts
+
+    # (src, neighboring bin) pairs that fall inside the grid
+    offsets = torch.cartesian_prod(*[torch.arange(-1, 2)] * 3)
+    nbr_bins = src_bins[:, None, :] + offsets[None, :, :]
+    in_grid = torch.all((nbr_bins >= 0) & (nbr_bins < n_bins), dim=-1)
+    src_idx = torch.arange(num_src)[:, None].expand(-1, len(offsets))
+    src_idx = src_idx[in_grid]
+    nbr_ids = linear_bin(nbr_bins[in_grid])
+
+    # expand every (src, bin) pair into its candidate dst points
+    counts = bin_counts[nbr_ids]
+    src_idx = torch.repeat_interleave(src_idx, counts)
+    first = torch.repeat_interleave(bin_starts[nbr_ids], counts)
+    local = torch.arange(int(counts.sum())) - torch.repeat_interleave(
+        torch.cumsum(counts, dim=0) - counts, counts
+    )
+    dst_idx = dst_order[first + local]
+
+    dist = torch.norm(X_dst[dst_idx] - X_src[src_idx], dim=1)
+    neighbor_mask = torch.bitwise_and(
+        dist <= cutoff,
+        ~torch.isclose(
+            dist,
+            torch.tensor([0]).type(dist.dtype),
+            atol=atol,
+        ),
+    )
+    u = src_idx[neighbor_mask]
+    v = dst_idx[neighbor_mask]
+    perm = torch.argsort(u * num_dst + v)
+    return u[perm], v[perm]
+
+
+def radius_graph_cutoff(
+    atoms=None, cutoff=5, cutoff_extra=0.5, bond_tol=0.5, atol=1e-5
+):
+    """Get the cutoff `radius_graph` extends cutoff to for atoms."""
+    # the graph has all nodes once the last atom has a neighbor,
+    # any atom has one within its shortest lattice vector
+    last = atoms.num_atoms - 1
+    dist = periodic_distances(
+        atoms,
+        [last],
+        cutoff=lattice_image_cutoff(atoms.lattice_mat, k=1),
+        bond_tol=bond_tol,
+    )
+    dist = dist[
+        ~torch.isclose(
+            dist, torch.tensor([0]).type(torch.get_default_dtype()), atol=atol
+        )
+    ]
+    cutoff, _ = extend_cutoff(
+        cutoff, dist.min(), cutoff_extra, neighbor_strategy="radius_graph"
+    )
+    return cutoff
+
+
 def radius_graph(
     atoms=None,
     cutoff=5,
@@ -271,8 +658,13 @@ def radius_graph(
     id=None,
     atol=1e-5,
     cutoff_extra=0.5,
+    use_cell_list=False,
 ):
-    """Construct edge list for radius graph."""
+    """Construct edge list for radius graph.
+
+    use_cell_list: find neighbors with `cell_list_neighbors` instead of a
+    dense distance matrix, recommended for large supercells.
+    """
 
     def temp_graph(cutoff=5):
         """Construct edge list for radius graph."""
@@ -310,24 +702,27 @@ def radius_graph(
         # cell_images = cell_images[:,None,:]+cell_images
         # print('cell_images',cell_images,cell_images.shape)
         X_dst = X_dst.reshape(-1, 3)
-        # pairwise distances between atoms in (0,0,0) cell
-        # and atoms in all periodic image
-        dist = torch.cdist(
-            X_src, X_dst, compute_mode="donot_use_mm_for_euclid_dist"
-        )
-        # u, v = torch.nonzero(dist <= cutoff, as_tuple=True)
-        # print("u1v1", u, v, u.shape, v.shape)
-        neighbor_mask = torch.bitwise_and(
-            dist <= cutoff,
-            ~torch.isclose(
-                dist,
-                torch.tensor([0]).type(torch.get_default_dtype()),
-                atol=atol,
-            ),
-        )
+        if use_cell_list:
+            u, v = cell_list_neighbors(X_src, X_dst, cutoff=cutoff, atol=atol)
+        else:
+            # pairwise distances between atoms in (0,0,0) cell
+            # and atoms in all periodic image
+            dist = torch.cdist(
+                X_src, X_dst, compute_mode="donot_use_mm_for_euclid_dist"
+            )
+            # u, v = torch.nonzero(dist <= cutoff, as_tuple=True)
+            # print("u1v1", u, v, u.shape, v.shape)
+            neighbor_mask = torch.bitwise_and(
+                dist <= cutoff,
+                ~torch.isclose(
+                    dist,
+                    torch.tensor([0]).type(torch.get_default_dtype()),
+                    atol=atol,
+                ),
+            )
 
-        # get node indices for edgelist from neighbor mask
-        u, v = torch.where(neighbor_mask)
+            # get node indices for edgelist from neighbor mask
+            u, v = torch.where(neighbor_mask)
         # cell_images=cell_images[neighbor_mask]
         # u, v = torch.where(neighbor_mask)
         # print("u2v2", u, v, u.shape, v.shape)
@@ -343,7 +738,15 @@ def radius_graph(
         g = dgl.graph((u, v))
         return g, u, v, r, cell_images
 
+    cutoff = radius_graph_cutoff(
+        atoms,
+        cutoff=cutoff,
+        cutoff_extra=cutoff_extra,
+        bond_tol=bond_tol,
+        atol=atol,
+    )
     # g, u, v, r, cell_images = temp_graph(cutoff)
+    # only repeats if rounding put the neighbor just outside the cutoff
     while True:  # (g.num_nodes()) != len(atoms.elements):
         # try:
         g, u, v, r, cell_images = temp_graph(cutoff)
@@ -364,6 +767,286 @@ def radius_graph(
     return u, v, r, cell_images
 
 
+def radius_graph_batch(
+    atoms_list=[],
+    cutoff=5,
+    bond_tol=0.5,
+    atol=1e-5,
+    cutoff_extra=0.5,
+):
+    """Construct radius graph edge lists for many structures at once.
+
+    Structures are padded to a common number of atoms and periodic
+    images, so all pairwise distances come from one batched torch.cdist.
+    Meant for many small cells; use chunks of the list for large ones.
+    Returns a list of per-structure (u, v, r, images) like `radius_graph`.
+    """
+    dtype = torch.get_default_dtype()
+    num_structs = len(atoms_list)
+    num_atoms = [atoms.num_atoms for atoms in atoms_list]
+    n_max = max(num_atoms)
+    lattice_mat = torch.tensor(
+        np.array([atoms.lattice_mat for atoms in atoms_list])
+    ).type(dtype)
+    # determine how many supercells are needed for the cutoff radius
+    recp = 2 * math.pi * torch.linalg.inv(lattice_mat).transpose(1, 2)
+    recp_len = torch.sqrt(torch.sum(recp**2, dim=2))
+    maxr = torch.ceil((cutoff + bond_tol) * recp_len / (2 * math.pi))
+
+    X_src = torch.zeros(num_structs, n_max, 3, dtype=dtype)
+    atom_mask = torch.zeros(num_structs, n_max, dtype=torch.bool)
+    cell_images = []
+    for ii, atoms in enumerate(atoms_list):
+        frac_coords = torch.tensor(atoms.frac_coords).type(dtype)
+        X_src[ii, : num_atoms[ii]] = torch.tensor(atoms.cart_coords).type(
+            dtype
+        )
+        atom_mask[ii, : num_atoms[ii]] = True
+        nmin = torch.floor(torch.min(frac_coords, dim=0)[0]) - maxr[ii]
+        nmax = torch.ceil(torch.max(frac_coords, dim=0)[0]) + maxr[ii]
+        all_ranges = [
+            torch.arange(x, y, dtype=dtype) for x, y in zip(nmin, nmax)
+        ]
+        cell_images.append(torch.cartesian_prod(*all_ranges))
+    k_max = max(len(images) for images in cell_images)
+    padded_images = torch.zeros(num_structs, k_max, 3, dtype=dtype)
+    image_mask = torch.zeros(num_structs, k_max, dtype=torch.bool)
+    for ii, images in enumerate(cell_images):
+        padded_images[ii, : len(images)] = images
+        image_mask[ii, : len(images)] = True
+
+    # tile periodic images into X_dst, index (image * n_max + atom)
+    X_dst = (padded_images @ lattice_mat)[:, :, None, :] + X_src[:, None]
+    X_dst = X_dst.reshape(num_structs, -1, 3)
+    dst_mask = (image_mask[:, :, None] & atom_mask[:, None, :]).reshape(
+        num_structs, 1, -1
+    )
+    dist = torch.cdist(
+        X_src, X_dst, compute_mode="donot_use_mm_for_euclid_dist"
+    )
+    neighbor_mask = (
+        (dist <= cutoff)
+        & ~torch.isclose(dist, torch.tensor([0]).type(dtype), atol=atol)
+        & atom_mask[:, :, None]
+        & dst_mask
+    )
+    b, u, v = torch.where(neighbor_mask)
+    r = (X_dst[b, v] - X_src[b, u]).float()
+    images = padded_images[b, v // n_max]
+    v = v % n_max
+
+    counts = torch.bincount(b, minlength=num_structs).tolist()
+    edge_data = []
+    for ii, (uu, vv, rr, im) in enumerate(
+        zip(
+            torch.split(u, counts),
+            torch.split(v, counts),
+            torch.split(r, counts),
+            torch.split(images, counts),
+        )
+    ):
+        if len(uu) == 0 or int(max(uu.max(), vv.max())) + 1 < num_atoms[ii]:
+            # radius_graph extends the cutoff for this structure
+            edge_data.append(
+                radius_graph(
+                    atoms_list[ii],
+                    cutoff=cutoff,
+                    bond_tol=bond_tol,
+                    atol=atol,
+                    cutoff_extra=cutoff_extra,
+                )
+            )
+        else:
+            edge_data.append((uu, vv, rr, im))
+    return edge_data
+
+
+def compute_triplets(u, v, num_nodes=None, backtracking=True):
+    """Get the bond pairs (triplets) of a graph from its edge list.
+
+    Edge e1 = (a -> b) is paired with every edge e2 = (b -> c) leaving b,
+    using a CSR index of outgoing edges. Pairs and their order are the
+    same as `g.line_graph`, which never pairs an edge with itself.
+    backtracking=False also drops pairs with c == a.
+    Returns (src_edge, dst_edge) int32 tensors.
+    """
+    u = torch.as_tensor(u, dtype=torch.long)
+    v = torch.as_tensor(v, dtype=torch.long)
+    if num_nodes is None:
+        num_nodes = int(max(u.max(), v.max())) + 1 if len(u) > 0 else 0
+    # CSR index of outgoing edges, sorted by edge id within each node
+    out_edges = torch.argsort(u, stable=True)
+    out_counts = torch.bincount(u, minlength=num_nodes)
+    out_starts = torch.cumsum(out_counts, dim=0) - out_counts
+
+    counts = out_counts[v]
+    src_edge = torch.repeat_interleave(
+        torch.arange(len(u), device=u.device), counts
+    )
+    local = torch.arange(int(counts.sum()), device=u.device)
+    local -= torch.repeat_interleave(
+        torch.cumsum(counts, dim=0) - counts, counts
+    )
+    dst_edge = out_edges[
+        torch.repeat_interleave(out_starts[v], counts) + local
+    ]
+
+    mask = src_edge != dst_edge
+    if not backtracking:
+        mask &= v[dst_edge] != u[src_edge]
+    return src_edge[mask].int(), dst_edge[mask].int()
+
+
+def triplet_line_graph(g: dgl.DGLGraph, r=None, backtracking=True):
+    """Construct the line graph of g from its triplet indices.
+
+    Drop-in for `g.line_graph(shared=True)` followed by
+    `lg.apply_edges(compute_bond_cosines)`, without DGL's generic line
+    graph. The line graph uses int32 ids and shares g.edata as its ndata,
+    r overrides the bond vectors used for the angle cosines.
+    Batched graphs keep their batch boundaries.
+    """
+    u, v = g.edges()
+    src_edge, dst_edge = compute_triplets(
+        u, v, num_nodes=g.num_nodes(), backtracking=backtracking
+    )
+    lg = dgl.graph(
+        (src_edge, dst_edge), num_nodes=g.num_edges(), idtype=torch.int32
+    )
+    for key, value in g.edata.items():
+        lg.ndata[key] = value
+    if r is not None:
+        lg.ndata["r"] = r
+    lg.apply_edges(compute_bond_cosines)
+    if g.batch_size > 1:
+        # bond pairs come out ordered by first bond, so contiguous per graph
+        edge_graph_ids = torch.repeat_interleave(
+            torch.arange(g.batch_size, device=g.device), g.batch_num_edges()
+        )
+        lg.set_batch_num_nodes(g.batch_num_edges().int())
+        lg.set_batch_num_edges(
+            torch.bincount(
+                edge_graph_ids[src_edge.long()], minlength=g.batch_size
+            ).int()
+        )
+    return lg
+
+
+def triplet_line_graphs(graphs=[], chunk_size=256, backtracking=True):
+    """Construct the line graphs of many graphs, chunk_size at a time.
+
+    Each chunk is batched and its line graph built in one
+    `triplet_line_graph` call, then split back per graph. Line graphs
+    share g.edata as their ndata, like `triplet_line_graph(g)`.
+    """
+    line_graphs = []
+    for start in range(0, len(graphs), chunk_size):
+        chunk = graphs[start : start + chunk_size]  # noqa:E203
+        bg = dgl.batch(
+            [dgl.graph(g.edges(), num_nodes=g.num_nodes()) for g in chunk]
+        )
+        bg.edata["r"] = torch.cat([g.edata["r"] for g in chunk])
+        lgs = dgl.unbatch(triplet_line_graph(bg, backtracking=backtracking))
+        for g, lg in zip(chunk, lgs):
+            for key, value in g.edata.items():
+                lg.ndata[key] = value
+            line_graphs.append(lg)
+    return line_graphs
+
+
+def compact_graph(
+    g: dgl.DGLGraph,
+    atomic_numbers=[],
+    lattice_mat=[],
+    atom_features="cgcnn",
+    graph_data={},
+    store_r=True,
+):
+    """Pack a crystal graph into a dict of compact numpy arrays.
+
+    Edge indices are stored as int32, integral images as int8, atom
+    features as atomic numbers and V once per graph. graph_data holds
+    per-graph arrays (stress, extra_features, ...) that `expand_graph`
+    broadcasts to the nodes. With store_r=False, r is replaced by int8
+    lattice shifts and recomputed from frac_coords on expansion.
+    """
+    u, v = g.edges()
+    dtype = g.ndata["atom_features"].dtype
+    lattice_mat = np.array(lattice_mat, dtype=np.float64)
+    record = {
+        "u": u.numpy().astype(np.int32),
+        "v": v.numpy().astype(np.int32),
+        "Z": np.array(atomic_numbers, dtype=np.uint8),
+        "lattice_mat": lattice_mat,
+        "atom_features": atom_features,
+        "dtype": str(dtype).split(".")[-1],
+        "ndata": {},
+        "edata": {},
+        "graph_data": {k: np.array(val) for k, val in graph_data.items()},
+    }
+    for key, value in g.ndata.items():
+        if key == "atom_features":
+            continue
+        if key == "V":
+            record["V"] = float(value[0]) if len(value) > 0 else 0.0
+            continue
+        record["ndata"][key] = value.numpy()
+    for key, value in g.edata.items():
+        value = value.numpy()
+        if key == "images" and np.array_equal(value, np.rint(value)):
+            if np.abs(value).max(initial=0) <= 127:
+                value = value.astype(np.int8)
+        record["edata"][key] = value
+    if not store_r and "frac_coords" in g.ndata:
+        frac_coords = g.ndata["frac_coords"].numpy().astype(np.float64)
+        r = record["edata"]["r"].astype(np.float64)
+        dist = frac_coords[v.numpy()] - frac_coords[u.numpy()]
+        shifts = np.rint(r.dot(np.linalg.inv(lattice_mat)) - dist)
+        # keep r when it is not a plain bond vector (radius_graph_jarvis)
+        if np.allclose((dist + shifts).dot(lattice_mat), r, atol=1e-4):
+            record["edata"].pop("r")
+            record["shifts"] = shifts.astype(np.int8)
+    return record
+
+
+def expand_graph(record={}):
+    """Rebuild the crystal graph packed by `compact_graph`."""
+    dtype = getattr(torch, record["dtype"])
+    num_nodes = len(record["Z"])
+    g = dgl.graph(
+        (
+            torch.tensor(record["u"], dtype=torch.long),
+            torch.tensor(record["v"], dtype=torch.long),
+        ),
+        num_nodes=num_nodes,
+    )
+    g.ndata["atom_features"] = get_attribute_lookup(record["atom_features"])[
+        torch.tensor(record["Z"], dtype=torch.long)
+    ].type(dtype)
+    for key, value in record["ndata"].items():
+        g.ndata[key] = torch.tensor(value)
+    if "V" in record:
+        g.ndata["V"] = torch.full((num_nodes,), record["V"], dtype=dtype)
+    for key, value in record["edata"].items():
+        if key == "images":
+            g.edata[key] = torch.tensor(value).type(dtype)
+        else:
+            g.edata[key] = torch.tensor(value)
+    if "shifts" in record:
+        frac_coords = record["ndata"]["frac_coords"].astype(np.float64)
+        r = (
+            frac_coords[record["v"]]
+            - frac_coords[record["u"]]
+            + record["shifts"]
+        ).dot(record["lattice_mat"])
+        g.edata["r"] = torch.tensor(r).type(dtype)
+    for key, value in record["graph_data"].items():
+        g.ndata[key] = (
+            torch.tensor(value).type(dtype).expand(num_nodes, *value.shape)
+        ).contiguous()
+    return g
+
+
 ###
 def radius_graph_old(
     atoms=None,
@@ -488,14 +1171,16 @@ class Graph(object):
         # print('id',id)
         # print('stratgery', neighbor_strategy)
         if neighbor_strategy == "k-nearest":
-            edges, images = nearest_neighbor_edges(
+            src_ids, dst_ids, dst_images = nearest_neighbor_edge_arrays(
                 atoms=atoms,
                 cutoff=cutoff,
                 max_neighbors=max_neighbors,
                 id=id,
                 use_canonize=use_canonize,
             )
-            u, v, r, images = build_undirected_edgedata(atoms, edges)
+            u, v, r, images = build_undirected_edge_arrays(
+                atoms, src_ids, dst_ids, dst_images
+            )
         elif neighbor_strategy == "radius_graph":
             # print('HERE')
             # import sys
@@ -503,15 +1188,21 @@ class Graph(object):
             u, v, r, images = radius_graph(
                 atoms, cutoff=cutoff, cutoff_extra=cutoff_extra
             )
+        elif neighbor_strategy == "radius_graph_cell_list":
+            u, v, r, images = radius_graph(
+                atoms,
+                cutoff=cutoff,
+                cutoff_extra=cutoff_extra,
+                use_cell_list=True,
+            )
         elif neighbor_strategy == "radius_graph_jarvis":
-            g, lg = radius_graph_jarvis(
+            return radius_graph_jarvis(
                 atoms,
                 cutoff=cutoff,
                 atom_features=atom_features,
                 line_graph=compute_line_graph,
                 dtype=dtype,
             )
-            return g, lg
         else:
             raise ValueError("Not implemented yet", neighbor_strategy)
         # elif neighbor_strategy == "voronoi":
@@ -527,18 +1218,9 @@ class Graph(object):
         #    if ii not in comp_dict:
         #        comp_dict[ii] = c_ind
         #        c_ind += 1
-        sps_features = []
-        # node_types = []
-        for ii, s in enumerate(atoms.elements):
-            feat = list(get_node_attributes(s, atom_features=atom_features))
-            # if include_prdf_angles:
-            #    feat=feat+list(prdf[ii])+list(adf[ii])
-            sps_features.append(feat)
-            # node_types.append(comp_dict[s])
-        sps_features = np.array(sps_features)
-        node_features = torch.tensor(sps_features).type(
-            torch.get_default_dtype()
-        )
+        node_features = get_atom_features(
+            atoms.elements, atom_features=atom_features
+        ).type(torch.get_default_dtype())
         # print("u", u)
         # print("v", v)
         g = dgl.graph((u, v))
@@ -585,12 +1267,128 @@ class Graph(object):
             # construct atomistic line graph
             # (nodes are bonds, edges are bond pairs)
             # and add bond angle cosines as edge features
-            lg = g.line_graph(shared=True)
-            lg.apply_edges(compute_bond_cosines)
+            lg = triplet_line_graph(g)
             return g, lg
         else:
             return g
 
+    @staticmethod
+    def atom_dgl_multigraph_batch(
+        atoms_list=[],
+        neighbor_strategy="k-nearest",
+        cutoff=8.0,
+        max_neighbors=12,
+        atom_features="cgcnn",
+        compute_line_graph: bool = True,
+        use_canonize: bool = True,
+        use_lattice_prop: bool = False,
+        cutoff_extra=3.5,
+        dtype="float32",
+    ):
+        """Obtain a batched DGLGraph for a list of Atoms objects.
+
+        Equivalent to dgl.batch over atom_dgl_multigraph calls, but the
+        radius search for "radius_graph" runs once for the whole list and
+        the graph and line graph are assembled in a single pass.
+        """
+        if neighbor_strategy == "radius_graph_jarvis":
+            graphs = [
+                radius_graph_jarvis(
+                    atoms,
+                    cutoff=cutoff,
+                    atom_features=atom_features,
+                    line_graph=False,
+                    dtype=dtype,
+                )
+                for atoms in atoms_list
+            ]
+            g = dgl.batch(graphs)
+            if compute_line_graph:
+                return g, triplet_line_graph(g)
+            return g
+        if neighbor_strategy == "radius_graph":
+            edge_data = radius_graph_batch(
+                atoms_list, cutoff=cutoff, cutoff_extra=cutoff_extra
+            )
+        elif neighbor_strategy == "radius_graph_cell_list":
+            edge_data = [
+                radius_graph(
+                    atoms,
+                    cutoff=cutoff,
+                    cutoff_extra=cutoff_extra,
+                    use_cell_list=True,
+                )
+                for atoms in atoms_list
+            ]
+        elif neighbor_strategy == "k-nearest":
+            edge_data = []
+            for atoms in atoms_list:
+                src_ids, dst_ids, dst_images = nearest_neighbor_edge_arrays(
+                    atoms=atoms,
+                    cutoff=cutoff,
+                    max_neighbors=max_neighbors,
+                    use_canonize=use_canonize,
+                )
+                edge_data.append(
+                    build_undirected_edge_arrays(
+                        atoms, src_ids, dst_ids, dst_images
+                    )
+                )
+        else:
+            raise ValueError("Not implemented yet", neighbor_strategy)
+
+        num_atoms = [atoms.num_atoms for atoms in atoms_list]
+        num_edges = [len(u) for u, v, r, images in edge_data]
+        offsets = torch.repeat_interleave(
+            torch.cumsum(torch.tensor([0] + num_atoms[:-1]), dim=0),
+            torch.tensor(num_edges),
+        )
+        u = torch.cat([e[0] for e in edge_data]) + offsets
+        v = torch.cat([e[1] for e in edge_data]) + offsets
+        g = dgl.graph((u, v), num_nodes=sum(num_atoms))
+        g.set_batch_num_nodes(torch.tensor(num_atoms))
+        g.set_batch_num_edges(torch.tensor(num_edges))
+
+        g.ndata["atom_features"] = get_atom_features(
+            [s for atoms in atoms_list for s in atoms.elements],
+            atom_features=atom_features,
+        ).type(torch.get_default_dtype())
+        g.edata["r"] = torch.cat(
+            [torch.as_tensor(e[2]) for e in edge_data]
+        ).type(torch.get_default_dtype())
+        g.edata["images"] = torch.cat(
+            [torch.as_tensor(e[3]) for e in edge_data]
+        ).type(torch.get_default_dtype())
+        g.ndata["V"] = torch.repeat_interleave(
+            torch.tensor([atoms.volume for atoms in atoms_list]),
+            torch.tensor(num_atoms),
+        )
+        g.ndata["frac_coords"] = torch.tensor(
+            np.concatenate([atoms.frac_coords for atoms in atoms_list])
+        ).type(torch.get_default_dtype())
+        if use_lattice_prop:
+            lattice_prop = np.array(
+                [
+                    np.array(
+                        [
+                            atoms.lattice.lat_lengths(),
+                            atoms.lattice.lat_angles(),
+                        ]
+                    ).flatten()
+                    for atoms in atoms_list
+                ]
+            )
+            g.ndata["extra_features"] = torch.repeat_interleave(
+                torch.tensor(lattice_prop).type(torch.get_default_dtype()),
+                torch.tensor(num_atoms),
+                dim=0,
+            )
+
+        if compute_line_graph:
+            return g, triplet_line_graph(g)
+        else:
+            return g
+
     @staticmethod
     def from_atoms(
         atoms=None,
@@ -901,71 +1699,54 @@ class StructureDataset(DGLDataset):
         self.line_graph = line_graph
         print("df", df)
         self.lattices = lattices
-        self.labels = self.df[target]
-
+        default_dtype = torch.get_default_dtype()
+        # read the per-sample columns once instead of iterating rows
         if (
             self.target_atomwise is not None and self.target_atomwise != ""
         ):  # and "" not in self.target_atomwise:
-            # self.labels_atomwise = df[self.target_atomwise]
-            self.labels_atomwise = []
-            for ii, i in df.iterrows():
-                self.labels_atomwise.append(
-                    torch.tensor(np.array(i[self.target_atomwise])).type(
-                        torch.get_default_dtype()
-                    )
-                )
+            self.labels_atomwise = [
+                torch.tensor(np.array(i)).type(default_dtype)
+                for i in df[self.target_atomwise].values
+            ]
 
         if (
             self.target_grad is not None and self.target_grad != ""
         ):  # and "" not in  self.target_grad :
-            # self.labels_atomwise = df[self.target_atomwise]
-            self.labels_grad = []
-            for ii, i in df.iterrows():
-                self.labels_grad.append(
-                    torch.tensor(np.array(i[self.target_grad])).type(
-                        torch.get_default_dtype()
-                    )
-                )
-            # print (self.labels_atomwise)
+            self.labels_grad = [
+                torch.tensor(np.array(i)).type(default_dtype)
+                for i in df[self.target_grad].values
+            ]
         if (
             self.target_stress is not None and self.target_stress != ""
         ):  # and "" not in  self.target_stress :
-            # self.labels_atomwise = df[self.target_atomwise]
-            self.labels_stress = []
-            for ii, i in df.iterrows():
-                self.labels_stress.append(i[self.target_stress])
-                # self.labels_stress.append(
-                #    torch.tensor(np.array(i[self.target_stress])).type(
-                #        torch.get_default_dtype()
-                #    )
-                # )
-            # self.labels_stress = self.df[self.target_stress]
+            self.labels_stress = [
+                torch.tensor(np.array(i)).type(default_dtype)
+                for i in df[self.target_stress].values
+            ]
 
         self.ids = self.df[id_tag]
-        self.labels = torch.tensor(self.df[target]).type(
-            torch.get_default_dtype()
-        )
-        self.lattices = []
-        for ii, i in df.iterrows():
-            self.lattices.append(Atoms.from_dict(i["atoms"]).lattice_mat)
-
-        self.lattices = torch.tensor(self.lattices).type(
-            torch.get_default_dtype()
+        self.labels = torch.tensor(self.df[target]).type(default_dtype)
+        if self.lattices is None:
+            # lattice_mat straight from the atoms dicts
+            self.lattices = np.array(
+                [i["lattice_mat"] for i in df["atoms"].values]
+            )
+        self.lattices = torch.tensor(np.array(self.lattices)).type(
+            default_dtype
         )
         self.transform = transform
 
-        features = self._get_attribute_lookup(atom_features)
+        features = torch.tensor(
+            self._get_attribute_lookup(atom_features)
+        ).type(torch.FloatTensor)
 
         # load selected node representation
         # assume graphs contain atomic number in g.ndata["atom_features"]
         for i, g in enumerate(graphs):
             z = g.ndata.pop("atom_features")
             g.ndata["atomic_number"] = z
-            z = z.type(torch.IntTensor).squeeze()
-            f = torch.tensor(features[z]).type(torch.FloatTensor)
-            if g.num_nodes() == 1:
-                f = f.unsqueeze(0)
-            g.ndata["atom_features"] = f
+            z = z.type(torch.IntTensor).view(-1).long()
+            g.ndata["atom_features"] = features[z]
             if (
                 self.target_atomwise is not None and self.target_atomwise != ""
             ):  # and "" not in self.target_atomwise:
@@ -981,20 +1762,17 @@ class StructureDataset(DGLDataset):
                 #    "self.labels_stress[i]",
                 #    [self.labels_stress[i] for ii in range(len(z))],
                 # )
-                g.ndata[self.target_stress] = torch.tensor(
-                    [self.labels_stress[i] for ii in range(len(z))]
-                ).type(torch.get_default_dtype())
+                stress = self.labels_stress[i]
+                g.ndata[self.target_stress] = stress.expand(
+                    len(z), *stress.shape
+                ).clone()
 
         self.prepare_batch = prepare_dgl_batch
         if line_graph:
             self.prepare_batch = prepare_line_graph_batch
 
             print("building line graphs")
-            self.line_graphs = []
-            for g in tqdm(graphs):
-                lg = g.line_graph(shared=True)
-                lg.apply_edges(compute_bond_cosines)
-                self.line_graphs.append(lg)
+            self.line_graphs = triplet_line_graphs(graphs)
 
         if classification:
             self.labels = self.labels.view(-1).long()
@@ -1003,21 +1781,8 @@ class StructureDataset(DGLDataset):
     @staticmethod
     def _get_attribute_lookup(atom_features: str = "cgcnn"):
         """Build a lookup array indexed by atomic number."""
-        max_z = max(v["Z"] for v in chem_data.values())
-
-        # get feature shape (referencing Carbon)
-        template = get_node_attributes("C", atom_features)
-
-        features = np.zeros((1 + max_z, len(template)))
-
-        for element, v in chem_data.items():
-            z = v["Z"]
-            x = get_node_attributes(element, atom_features)
-
-            if x is not None:
-                features[z, :] = x
-
-        return features
+        # copy, the cached table is shared by the whole process
+        return get_attribute_lookup(atom_features).numpy().copy()
 
     def __len__(self):
         """Get length."""
@@ -0,0 +1,135 @@
+"""Module for memory-mapped label columns of a graph dataset.
+
+Labels are kept out of the graph records, one raw binary column per key
+under a directory: per-graph columns have one row per sample, per-atom
+columns (forces, charges, ...) have one row per atom with shared ragged
+offsets. Columns are memory-mapped and gathered per batch by index.
+"""
+
+import os
+import json
+import numpy as np
+import torch
+
+
+class LabelStoreWriter(object):
+    """Append the labels of samples to the columns of a label store."""
+
+    def __init__(self, path="labels", graph_keys={}, atom_keys={}):
+        """Initialize with directory and {key: numpy dtype} of columns."""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.columns = {}
+        for keys, per_atom in [(graph_keys, False), (atom_keys, True)]:
+            for key, dtype in keys.items():
+                self.columns[key] = {
+                    "dtype": np.dtype(dtype).str,
+                    "shape": None,
+                    "per_atom": per_atom,
+                }
+        self.files = {
+            key: open(os.path.join(path, key + ".bin"), "wb")
+            for key in self.columns
+        }
+        self.offsets = [0]
+
+    def append(self, labels={}, natoms=0):
+        """Write the labels of one sample with natoms atoms."""
+        for key, column in self.columns.items():
+            arr = np.asarray(labels[key], dtype=column["dtype"])
+            if column["per_atom"] and arr.shape[:1] != (natoms,):
+                arr = arr.reshape(natoms, -1)
+            shape = list(arr.shape[1:] if column["per_atom"] else arr.shape)
+            if column["shape"] is None:
+                column["shape"] = shape
+            elif column["shape"] != shape:
+                raise ValueError("Inconsistent label shape", key, shape)
+            self.files[key].write(np.ascontiguousarray(arr).tobytes())
+        self.offsets.append(self.offsets[-1] + natoms)
+
+    def close(self, meta={}):
+        """Finish the columns, meta is stored with them."""
+        for f in self.files.values():
+            f.close()
+        np.save(
+            os.path.join(self.path, "offsets.npy"),
+            np.array(self.offsets, dtype=np.int64),
+        )
+        with open(os.path.join(self.path, "labels.json"), "w") as f:
+            json.dump(
+                {
+                    "num_samples": len(self.offsets) - 1,
+                    "columns": self.columns,
+                    "meta": meta,
+                },
+                f,
+            )
+
+
+class LabelStore(object):
+    """Read only, memory-mapped label columns written by LabelStoreWriter."""
+
+    def __init__(self, path="labels"):
+        """Initialize with directory, columns are mapped lazily."""
+        self.path = path
+        with open(os.path.join(path, "labels.json"), "r") as f:
+            info = json.load(f)
+        self.num_samples = info["num_samples"]
+        self.columns = info["columns"]
+        self.meta = info["meta"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self._arrays = {}
+
+    @staticmethod
+    def read_meta(path="labels"):
+        """Get the meta of a label store, None if there is none."""
+        try:
+            with open(os.path.join(path, "labels.json"), "r") as f:
+                return json.load(f)["meta"]
+        except FileNotFoundError:
+            return None
+
+    def array(self, key=""):
+        """Get the memory-mapped array of a column."""
+        if key not in self._arrays:
+            column = self.columns[key]
+            rows = self.num_samples
+            if column["per_atom"]:
+                rows = int(self.offsets[-1])
+            if rows == 0:
+                self._arrays[key] = np.zeros(0, dtype=column["dtype"])
+            else:
+                shape = tuple([rows] + column["shape"])
+                self._arrays[key] = np.memmap(
+                    os.path.join(self.path, key + ".bin"),
+                    dtype=column["dtype"],
+                    mode="r",
+                    shape=shape,
+                )
+        return self._arrays[key]
+
+    def __getstate__(self):
+        """Pickle without the memory maps, e.g. for spawned workers."""
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def num_atoms(self, idxs=[]):
+        """Get the number of atoms of samples."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        return self.offsets[idxs + 1] - self.offsets[idxs]
+
+    def gather(self, key="", idxs=[]):
+        """Get the labels of samples as one tensor.
+
+        Per-graph columns give one row per sample, per-atom columns the
+        rows of all atoms of the samples in order.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if self.columns[key]["per_atom"]:
+            starts = self.offsets[idxs]
+            lengths = self.offsets[idxs + 1] - starts
+            # row of each atom: its sample start plus its position in it
+            shifts = starts - (np.cumsum(lengths) - lengths)
+            idxs = np.repeat(shifts, lengths) + np.arange(lengths.sum())
+        return torch.from_numpy(np.asarray(self.array(key)[idxs]))
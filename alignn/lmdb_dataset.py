@@ -1,11 +1,23 @@
 """Module to prepare LMDB ALIGNN dataset."""
 
 import os
+import json
+import shutil
+import struct
+import multiprocessing
+from functools import partial
+from itertools import islice
 import numpy as np
 import lmdb
 from jarvis.core.atoms import Atoms
 from jarvis.db.figshare import data
-from alignn.graphs import Graph
+from alignn.graphs import (
+    Graph,
+    compact_graph,
+    expand_graph,
+    triplet_line_graph,
+)
+from alignn.label_store import LabelStore, LabelStoreWriter
 import pickle as pk
 from torch.utils.data import Dataset
 import torch
@@ -35,38 +47,379 @@ def prepare_line_graph_batch(
     return batch
 
 
+# binary LMDB records, see encode_record
+RECORD_MAGIC = b"ALGN"
+RECORD_VERSION = 1
+
+
+def encode_record(arrays={}, meta={}):
+    """Pack named arrays and json metadata into one binary record.
+
+    Layout: magic, uint32 version, uint32 header size, a json header with
+    meta and the name, dtype, shape and offset of every array, then the
+    array data, each array 8-byte aligned.
+    """
+    fields = []
+    chunks = []
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        fields.append([name, arr.dtype.str, list(arr.shape), offset])
+        data = arr.tobytes()
+        chunks.append(data + b"\0" * (-len(data) % 8))
+        offset += len(chunks[-1])
+    header = json.dumps({"meta": meta, "fields": fields}).encode()
+    header += b" " * (-(len(header) + 12) % 8)
+    prefix = RECORD_MAGIC + struct.pack("<II", RECORD_VERSION, len(header))
+    return b"".join([prefix, header] + chunks)
+
+
+def decode_header(buf=b""):
+    """Read the json header of a record from `encode_record`.
+
+    Returns the header and the offset of the array data.
+    """
+    if bytes(buf[:4]) != RECORD_MAGIC:
+        raise ValueError("Not an ALIGNN binary record.")
+    version, size = struct.unpack_from("<II", buf, 4)
+    if version != RECORD_VERSION:
+        raise ValueError("Unsupported record version", version)
+    header = json.loads(bytes(buf[12 : 12 + size]))  # noqa:E203
+    return header, 12 + size
+
+
+def decode_record(buf=b""):
+    """Unpack a record from `encode_record` into (arrays, meta).
+
+    Nothing is copied, the arrays are read-only views into buf, e.g. a
+    buffer of an LMDB transaction opened with buffers=True. Copy what
+    has to outlive buf.
+    """
+    header, start = decode_header(buf)
+    arrays = {}
+    for name, dtype, shape, offset in header["fields"]:
+        arrays[name] = np.frombuffer(
+            buf,
+            dtype=dtype,
+            count=int(np.prod(shape)),
+            offset=start + offset,
+        ).reshape(shape)
+    return arrays, header["meta"]
+
+
+def _graph_arrays(g=None, prefix="g", arrays={}, node_data=True):
+    """Add edges, ndata and edata of g to arrays, get its metadata."""
+    u, v = g.edges()
+    arrays[prefix + "/src"] = u.int().numpy()
+    arrays[prefix + "/dst"] = v.int().numpy()
+    if node_data:
+        for key, value in g.ndata.items():
+            arrays[prefix + "/ndata/" + key] = value.numpy()
+    for key, value in g.edata.items():
+        arrays[prefix + "/edata/" + key] = value.numpy()
+    return {
+        "num_nodes": g.num_nodes(),
+        "idtype": str(g.idtype).split(".")[-1],
+    }
+
+
+def _arrays_graph(arrays={}, prefix="g", meta={}):
+    """Build a graph from the arrays added by `_graph_arrays`."""
+    idtype = getattr(torch, meta["idtype"])
+    g = dgl.graph(
+        (
+            torch.tensor(arrays[prefix + "/src"], dtype=idtype),
+            torch.tensor(arrays[prefix + "/dst"], dtype=idtype),
+        ),
+        num_nodes=meta["num_nodes"],
+        idtype=idtype,
+    )
+    for name, value in arrays.items():
+        keys = name.split("/", 2)
+        if keys[0] == prefix and keys[1] in ["ndata", "edata"]:
+            getattr(g, keys[1])[keys[2]] = torch.tensor(value)
+    return g
+
+
+def serialize_graphs(g=None, lg=None, lattice=None, label=None):
+    """Encode the graphs, lattice and label of a sample as a record.
+
+    g is a DGLGraph or a `compact_graph` record. The line graph shares
+    the bond data of g, so only its edges and edata are stored. label is
+    None for records whose labels are kept in a label store.
+    """
+    arrays = {"lattice": lattice.numpy()}
+    if label is not None:
+        arrays["label"] = label.numpy()
+    meta = {}
+    if isinstance(g, dict):
+        meta["sizes"] = graph_sizes(g["u"], g["v"], len(g["Z"]))
+        meta["compact"] = {}
+        for key, value in g.items():
+            if isinstance(value, dict):
+                for k, val in value.items():
+                    arrays["compact/" + key + "/" + k] = np.asarray(val)
+            elif isinstance(value, np.ndarray):
+                arrays["compact/" + key] = value
+            else:
+                meta["compact"][key] = value
+    else:
+        meta["g"] = _graph_arrays(g, "g", arrays)
+        if lg is not None:
+            meta["sizes"] = [g.num_nodes(), g.num_edges(), lg.num_edges()]
+        else:
+            meta["sizes"] = graph_sizes(
+                arrays["g/src"], arrays["g/dst"], g.num_nodes()
+            )
+    if lg is not None:
+        meta["lg"] = _graph_arrays(lg, "lg", arrays, node_data=False)
+    return encode_record(arrays, meta)
+
+
+def deserialize_graphs(buf=b""):
+    """Decode a record from `serialize_graphs` into (g, lg, lattice, label).
+
+    lg and label are None if they were not stored. Every array is copied
+    once out of buf into its tensor.
+    """
+    arrays, meta = decode_record(buf)
+    if "compact" in meta:
+        record = {"ndata": {}, "edata": {}, "graph_data": {}}
+        record.update(meta["compact"])
+        for name, value in arrays.items():
+            keys = name.split("/", 2)
+            if keys[0] != "compact":
+                continue
+            if len(keys) == 3:
+                record[keys[1]][keys[2]] = value
+            else:
+                record[keys[1]] = value
+        g = expand_graph(record)
+    else:
+        g = _arrays_graph(arrays, "g", meta["g"])
+    lg = None
+    if "lg" in meta:
+        lg = _arrays_graph(arrays, "lg", meta["lg"])
+        for key, value in g.edata.items():
+            lg.ndata[key] = value
+    lattice = torch.tensor(arrays["lattice"])
+    label = None
+    if "label" in arrays:
+        label = torch.tensor(arrays["label"])
+    return g, lg, lattice, label
+
+
+def graph_sizes(u=[], v=[], num_nodes=0):
+    """Get the number of nodes, edges and line graph edges of a graph."""
+    u = np.asarray(u)
+    v = np.asarray(v)
+    # each bond pairs with the bonds leaving its end, except itself
+    out_degree = np.bincount(u, minlength=num_nodes)
+    num_triplets = out_degree[v].sum() - np.sum(u == v)
+    return num_nodes, len(u), int(num_triplets)
+
+
+def record_sizes(buf=b""):
+    """Get the graph sizes of a record from `serialize_graphs`.
+
+    Read from the record header, records written without sizes there
+    are decoded to count them.
+    """
+    meta = decode_header(buf)[0]["meta"]
+    if "sizes" in meta:
+        return tuple(meta["sizes"])
+    arrays, meta = decode_record(buf)
+    if "compact" in meta:
+        sizes = graph_sizes(
+            arrays["compact/u"], arrays["compact/v"], len(arrays["compact/Z"])
+        )
+    else:
+        sizes = graph_sizes(
+            arrays["g/src"], arrays["g/dst"], meta["g"]["num_nodes"]
+        )
+    return sizes
+
+
 class TorchLMDBDataset(Dataset):
     """Dataset of crystal DGLGraphs using LMDB."""
 
-    def __init__(self, lmdb_path="", line_graph=True, ids=[]):
-        """Intitialize with path and ids array."""
+    def __init__(
+        self,
+        lmdb_path="",
+        line_graph=True,
+        ids=[],
+        batch_line_graph=False,
+        readahead=True,
+        max_readers=126,
+        label_store=None,
+    ):
+        """Intitialize with path and ids array.
+
+        With batch_line_graph, line graphs that are not stored are left
+        to `collate_line_graph`, which builds them once per batch.
+        The LMDB environment is opened lazily in each process that reads
+        from it, readahead and max_readers are passed to lmdb.open.
+        label_store is an optional LabelStore with the labels of records
+        stored without them.
+        """
         super(TorchLMDBDataset, self).__init__()
         self.lmdb_path = lmdb_path
         self.ids = ids
         self.line_graph = line_graph
-        self.env = lmdb.open(self.lmdb_path, readonly=True, lock=False)
-        with self.env.begin() as txn:
-            self.length = txn.stat()["entries"]
+        self.batch_line_graph = batch_line_graph
+        self.readahead = readahead
+        self.max_readers = max_readers
+        self.label_store = label_store
+        self._env = None
+        self._pid = None
+        with lmdb.open(self.lmdb_path, readonly=True, lock=False) as env:
+            with env.begin() as txn:
+                self.length = txn.stat()["entries"]
         self.prepare_batch = prepare_line_graph_batch
 
+    @property
+    def env(self):
+        """Get the LMDB environment of this process."""
+        return self.open_env()
+
+    def open_env(self):
+        """Open the LMDB environment of this process if needed.
+
+        Handles inherited over fork are never used, each DataLoader
+        worker opens its own.
+        """
+        if self._env is None or self._pid != os.getpid():
+            self._env = lmdb.open(
+                self.lmdb_path,
+                readonly=True,
+                lock=False,
+                readahead=self.readahead,
+                max_readers=self.max_readers,
+            )
+            self._pid = os.getpid()
+        return self._env
+
+    def __getstate__(self):
+        """Pickle without the LMDB environment, e.g. for spawned workers."""
+        state = self.__dict__.copy()
+        state["_env"] = None
+        state["_pid"] = None
+        return state
+
+    def get_sizes(self):
+        """Get (num_nodes, num_edges, num_line_graph_edges) per sample.
+
+        Read from graph_sizes.npy written with the dataset, or computed
+        from the records for datasets built without it.
+        """
+        path = os.path.join(self.lmdb_path, "graph_sizes.npy")
+        if os.path.exists(path):
+            return np.load(path)
+        sizes = []
+        with self.env.begin(buffers=True) as txn:
+            for idx in range(self.length):
+                serialized_data = txn.get(f"{idx}".encode())
+                if serialized_data[:4] == RECORD_MAGIC:
+                    sizes.append(record_sizes(serialized_data))
+                else:
+                    g = self.decode(serialized_data)[0]
+                    u, v = g.edges()
+                    sizes.append(
+                        graph_sizes(u.numpy(), v.numpy(), g.num_nodes())
+                    )
+        return np.array(sizes, dtype=np.int64)
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        """Open the LMDB environment of a DataLoader worker."""
+        worker_info = torch.utils.data.get_worker_info()
+        worker_info.dataset.open_env()
+
     def __len__(self):
         """Get length."""
         return self.length
 
     def __getitem__(self, idx):
         """Get sample."""
-        with self.env.begin() as txn:
-            serialized_data = txn.get(f"{idx}".encode())
+        if self.label_store is not None:
+            return self.__getitems__([idx])[0]
+        # records are decoded straight from the memory map
+        with self.env.begin(buffers=True) as txn:
+            return self.decode(txn.get(f"{idx}".encode()))
+
+    def __getitems__(self, idxs):
+        """Get the samples of a batch, read in one transaction.
+
+        The keys are read in sorted order so the reads are sequential
+        in the LMDB file, and decoded straight from the memory map.
+        """
+        decoded = {}
+        with self.env.begin(buffers=True) as txn:
+            for idx in sorted(set(idxs)):
+                decoded[idx] = self.decode(txn.get(f"{idx}".encode()))
+        samples = [decoded[idx] for idx in idxs]
+        if self.label_store is not None:
+            samples = self.add_labels(samples, idxs)
+        return samples
+
+    def add_labels(self, samples=[], idxs=[]):
+        """Set the labels of samples, gathered from the label store.
+
+        Per-atom labels go to g.ndata, per-graph labels are broadcast to
+        the nodes of g as views, the "label" column replaces the label.
+        """
+        store = self.label_store
+        labels = store.gather("label", idxs)
+        natoms = store.num_atoms(idxs).tolist()
+        per_atom = {}
+        per_graph = {}
+        for key, column in store.columns.items():
+            if column["per_atom"]:
+                per_atom[key] = store.gather(key, idxs).split(natoms)
+            elif key != "label":
+                per_graph[key] = store.gather(key, idxs)
+        for i, sample in enumerate(samples):
+            g = sample[0]
+            for key, value in per_atom.items():
+                g.ndata[key] = value[i]
+            for key, value in per_graph.items():
+                g.ndata[key] = value[i].expand(natoms[i], *value.shape[1:])
+            samples[i] = sample[:-1] + (labels[i],)
+        return samples
+
+    def decode(self, serialized_data):
+        """Decode a stored sample."""
+        if serialized_data[:4] == RECORD_MAGIC:
+            graph, line_graph, lattice, label = deserialize_graphs(
+                serialized_data
+            )
+            if not self.line_graph:
+                return graph, lattice, label
+            if line_graph is None and not self.batch_line_graph:
+                line_graph = triplet_line_graph(graph)
+            return graph, line_graph, lattice, label
+        # pickled records of caches built by older versions
+        data = pk.loads(serialized_data)
+        if isinstance(data[0], dict):
+            # compact record, line graph is rebuilt rather than stored
+            graph = expand_graph(data[0])
+            lattice, label = data[1:]
+            if self.line_graph:
+                return graph, triplet_line_graph(graph), lattice, label
+            return graph, lattice, label
         if self.line_graph:
-            graph, line_graph, lattice, label = pk.loads(serialized_data)
+            graph, line_graph, lattice, label = data
             return graph, line_graph, lattice, label
         else:
-            graph, lattice, label = pk.loads(serialized_data)
+            graph, lattice, label = data
             return graph, lattice, label
 
     def close(self):
-        """Close connection."""
-        self.env.close()
+        """Close connection, if opened by this process."""
+        if getattr(self, "_env", None) is not None:
+            if self._pid == os.getpid():
+                self._env.close()
+            self._env = None
 
     def __del__(self):
         """Delete connection."""
@@ -88,10 +441,16 @@ class TorchLMDBDataset(Dataset):
     def collate_line_graph(
         samples: List[Tuple[dgl.DGLGraph, dgl.DGLGraph, torch.Tensor]]
     ):
-        """Dataloader helper to batch graphs cross `samples`."""
+        """Dataloader helper to batch graphs cross `samples`.
+
+        Missing line graphs are built from the batched graph.
+        """
         graphs, line_graphs, lattices, labels = map(list, zip(*samples))
         batched_graph = dgl.batch(graphs)
-        batched_line_graph = dgl.batch(line_graphs)
+        if any(lg is None for lg in line_graphs):
+            batched_line_graph = triplet_line_graph(batched_graph)
+        else:
+            batched_line_graph = dgl.batch(line_graphs)
         if len(labels[0].size()) > 0:
             return (
                 batched_graph,
@@ -108,6 +467,173 @@ class TorchLMDBDataset(Dataset):
             )
 
 
+def serialize_sample(
+    d={},
+    target="",
+    target_atomwise="",
+    target_grad="",
+    target_stress="",
+    target_additional_output="",
+    neighbor_strategy="k-nearest",
+    atom_features="cgcnn",
+    use_canonize="",
+    line_graph=True,
+    cutoff=8.0,
+    cutoff_extra=3.0,
+    max_neighbors=12,
+    classification=False,
+    dtype="float32",
+    compact_graphs=False,
+    store_r=True,
+    store_line_graph=True,
+    graph_cache=None,
+    store_labels=True,
+):
+    """Build the graphs of one sample and encode them for LMDB.
+
+    graph_cache is an optional GraphCache to get the graphs from. With
+    store_labels=False the record holds no targets, they are written to
+    a label store instead.
+    """
+    # g, lg = Graph.atom_dgl_multigraph(
+    atoms = Atoms.from_dict(d["atoms"])
+    if not store_labels:
+        target_atomwise = None
+        target_grad = None
+        target_stress = None
+        target_additional_output = None
+    store_lg = line_graph and store_line_graph and not compact_graphs
+    build_graph = Graph.atom_dgl_multigraph
+    if graph_cache is not None:
+        build_graph = graph_cache.get_graph
+    g = build_graph(
+        atoms,
+        cutoff=float(cutoff),
+        max_neighbors=max_neighbors,
+        atom_features=atom_features,
+        compute_line_graph=store_lg,
+        use_canonize=use_canonize,
+        cutoff_extra=cutoff_extra,
+        neighbor_strategy=neighbor_strategy,
+        dtype=dtype,
+    )
+    if store_lg:
+        g, lg = g
+    # per-graph values, broadcast to every node unless compact
+    graph_data = {}
+    lattice = torch.tensor(atoms.lattice_mat).type(torch.get_default_dtype())
+    label = None
+    if store_labels:
+        label = torch.tensor(d[target]).type(torch.get_default_dtype())
+    natoms = len(d["atoms"]["elements"])
+    # print('label',label,label.view(-1).long())
+    if classification and label is not None:
+        label = label.long()
+        # label = label.view(-1).long()
+    if "extra_features" in d:
+        graph_data["extra_features"] = d["extra_features"]
+    if target_atomwise is not None and target_atomwise != "":
+        g.ndata[target_atomwise] = torch.tensor(
+            np.array(d[target_atomwise])
+        ).type(torch.get_default_dtype())
+    if target_grad is not None and target_grad != "":
+        # print('grad', np.array(d[target_grad]))
+        # print('grad shape',np.array(d[target_grad]).shape)
+        arr = np.array(d[target_grad])
+        try:
+            g.ndata[target_grad] = torch.tensor(arr).type(
+                torch.get_default_dtype()
+            )
+        except Exception:
+            arr = arr.reshape(1, -1)
+            g.ndata[target_grad] = torch.tensor(arr).type(
+                torch.get_default_dtype()
+            )
+            # print('arr',arr.shape)
+    if target_stress is not None and target_stress != "":
+        graph_data[target_stress] = d[target_stress]
+    if target_additional_output is not None and target_additional_output != "":
+        graph_data[target_additional_output] = d[target_additional_output]
+
+    # labels.append(label)
+    if compact_graphs:
+        record = compact_graph(
+            g,
+            atomic_numbers=atoms.atomic_numbers,
+            lattice_mat=atoms.lattice_mat,
+            atom_features=atom_features,
+            graph_data=graph_data,
+            store_r=store_r,
+        )
+        return serialize_graphs(record, None, lattice, label)
+    for key, value in graph_data.items():
+        value = np.array(value)
+        g.ndata[key] = torch.tensor(
+            np.array([value for ii in range(natoms)])
+        ).type(torch.get_default_dtype())
+    if store_lg:
+        return serialize_graphs(g, lg, lattice, label)
+    return serialize_graphs(g, None, lattice, label)
+
+
+def get_data_range(vals=[], data_range=None):
+    """Get [max, min] of target values, updating a previous data_range."""
+    vals = [np.max(i) for i in vals] + [np.min(i) for i in vals]
+    if data_range is not None:
+        vals += data_range
+    if not vals:
+        return None
+    return [float(np.max(vals)), float(np.min(vals))]
+
+
+def write_data_range(data_range=None, output_dir=".", tmp_name="dataset"):
+    """Write the target range of a dataset to output_dir."""
+    if data_range is None:
+        return
+    print("data range", data_range[0], data_range[1])
+    f = open(os.path.join(output_dir, tmp_name + "_data_range"), "w")
+    line = "Max=" + str(data_range[0]) + "\n"
+    f.write(line)
+    line = "Min=" + str(data_range[1]) + "\n"
+    f.write(line)
+    f.close()
+
+
+def label_columns(
+    target="",
+    target_atomwise="",
+    target_grad="",
+    target_stress="",
+    target_additional_output="",
+    classification=False,
+):
+    """Get the per-graph and per-atom label columns with their dtypes.
+
+    The graph label is stored as the "label" column.
+    """
+    float_dtype = str(torch.get_default_dtype()).split(".")[-1]
+    graph_keys = {"label": "int64" if classification else float_dtype}
+    atom_keys = {}
+    for keys, names in [
+        (graph_keys, [target_stress, target_additional_output]),
+        (atom_keys, [target_atomwise, target_grad]),
+    ]:
+        for name in names:
+            if name is not None and name != "":
+                keys[name] = float_dtype
+    return graph_keys, atom_keys
+
+
+def sample_labels(d={}, target="", columns={}):
+    """Get the label columns of a sample."""
+    return {key: d[target] if key == "label" else d[key] for key in columns}
+
+
+def _init_worker():
+    """Keep graph building workers from oversubscribing the cores."""
+    torch.set_num_threads(1)
+
+
 def get_torch_dataset(
     dataset=[],
     id_tag="jid",
@@ -131,101 +657,212 @@ def get_torch_dataset(
     map_size=1e12,
     read_existing=True,
     dtype="float32",
+    compact_graphs=False,
+    store_r=True,
+    store_line_graph=True,
+    workers=0,
+    write_batch_size=1000,
+    graph_cache=None,
+    readahead=True,
+    max_readers=126,
+    label_store=False,
 ):
-    """Get Torch Dataset with LMDB."""
-    vals = np.array([ii[target] for ii in dataset])  # df[target].values
-    print("data range", np.max(vals), np.min(vals))
+    """Get Torch Dataset with LMDB.
+
+    compact_graphs stores each graph with `compact_graph` and no line
+    graph, store_r=False also drops the bond vectors r. Line graphs that
+    are not stored (store_line_graph=False or compact_graphs) are built
+    per batch in `collate_line_graph`.
+    With workers > 0, graphs are built by a process pool while this
+    process writes them to LMDB, write_batch_size samples per
+    transaction with one batch in flight. graph_cache is an optional
+    GraphCache shared with other datasets. dataset can be any iterable of
+    samples, e.g. a generator from `alignn.streaming`, it is read once
+    write_batch_size samples at a time. An existing tmp_name is reused
+    only if it was built with the same parameters, without reading
+    dataset. readahead and max_readers configure the LMDB environment
+    of the returned dataset.
+    With label_store, the records hold only graphs, which are reused for
+    any target, and the labels are written to memory-mapped columns by
+    `alignn.label_store`. Changing the targets then rewrites only the
+    labels, in one pass over dataset.
+    """
     print("line_graph", line_graph)
-    f = open(os.path.join(output_dir, tmp_name + "_data_range"), "w")
-    line = "Max=" + str(np.max(vals)) + "\n"
-    f.write(line)
-    line = "Min=" + str(np.min(vals)) + "\n"
-    f.write(line)
-    f.close()
+    label_params = dict(
+        target=target,
+        target_atomwise=target_atomwise,
+        target_grad=target_grad,
+        target_stress=target_stress,
+        target_additional_output=target_additional_output,
+        classification=classification,
+    )
+    params = dict(
+        neighbor_strategy=neighbor_strategy,
+        atom_features=atom_features,
+        use_canonize=use_canonize,
+        line_graph=line_graph,
+        cutoff=cutoff,
+        cutoff_extra=cutoff_extra,
+        max_neighbors=max_neighbors,
+        dtype=dtype,
+        compact_graphs=compact_graphs,
+        store_r=store_r,
+        store_line_graph=store_line_graph,
+    )
+    if label_store:
+        # graphs without labels serve any target
+        params["label_store"] = True
+    else:
+        params.update(label_params)
+    batch_line_graph = compact_graphs or not store_line_graph
+    params_file = os.path.join(tmp_name, "graph_params.json")
+    if os.path.exists(tmp_name) and read_existing:
+        # graph_params.json is written last, without it the LMDB was
+        # not completed, e.g. by a crashed run
+        old_params = None
+        if os.path.exists(params_file):
+            with open(params_file, "r") as f:
+                old_params = json.load(f)
+        if old_params != json.loads(json.dumps(params)):
+            print(
+                "Graph parameters changed or incomplete, rebuilding", tmp_name
+            )
+            shutil.rmtree(tmp_name)
+    info_file = os.path.join(tmp_name, "dataset_info.json")
+    labels_path = os.path.join(tmp_name, "labels")
+    graph_keys, atom_keys = label_columns(**label_params)
     ids = []
     if os.path.exists(tmp_name) and read_existing:
-        for idx, (d) in tqdm(enumerate(dataset), total=len(dataset)):
-            ids.append(d[id_tag])
+        store = None
+        if os.path.exists(info_file):
+            with open(info_file, "r") as f:
+                info = json.load(f)
+            ids = info["ids"]
+            data_range = info["data_range"]
+        else:
+            vals = []
+            for idx, (d) in tqdm(enumerate(dataset)):
+                ids.append(d[id_tag])
+                vals.append(d[target])
+            data_range = get_data_range(vals)
+        if label_store:
+            meta = LabelStore.read_meta(labels_path)
+            if meta is None or meta["params"] != json.loads(
+                json.dumps(label_params)
+            ):
+                print("Label parameters changed, rewriting", labels_path)
+                writer = LabelStoreWriter(labels_path, graph_keys, atom_keys)
+                label_ids = []
+                data_range = None
+                for d in tqdm(dataset):
+                    label_ids.append(d[id_tag])
+                    data_range = get_data_range([d[target]], data_range)
+                    writer.append(
+                        sample_labels(d, target, writer.columns),
+                        natoms=len(d["atoms"]["elements"]),
+                    )
+                if label_ids != ids:
+                    raise ValueError(
+                        "Dataset does not match the graphs of", tmp_name
+                    )
+                writer.close(
+                    {"params": label_params, "data_range": data_range}
+                )
+            else:
+                data_range = meta["data_range"]
+            store = LabelStore(labels_path)
+        write_data_range(data_range, output_dir, tmp_name)
         dat = TorchLMDBDataset(
-            lmdb_path=tmp_name, line_graph=line_graph, ids=ids
+            lmdb_path=tmp_name,
+            line_graph=line_graph,
+            ids=ids,
+            batch_line_graph=batch_line_graph,
+            readahead=readahead,
+            max_readers=max_readers,
+            label_store=store,
         )
         print("Reading dataset", tmp_name)
         return dat
     ids = []
+    build_params = {k: v for k, v in params.items() if k != "label_store"}
+    build_params.update(label_params)
+    build = partial(
+        serialize_sample,
+        graph_cache=graph_cache,
+        store_labels=not label_store,
+        **build_params,
+    )
     env = lmdb.open(tmp_name, map_size=int(map_size))
-    with env.begin(write=True) as txn:
-        for idx, (d) in tqdm(enumerate(dataset), total=len(dataset)):
-            ids.append(d[id_tag])
-            # g, lg = Graph.atom_dgl_multigraph(
-            atoms = Atoms.from_dict(d["atoms"])
-            g = Graph.atom_dgl_multigraph(
-                atoms,
-                cutoff=float(cutoff),
-                max_neighbors=max_neighbors,
-                atom_features=atom_features,
-                compute_line_graph=line_graph,
-                use_canonize=use_canonize,
-                cutoff_extra=cutoff_extra,
-                neighbor_strategy=neighbor_strategy,
-                dtype=dtype,
-            )
-            if line_graph:
-                g, lg = g
-            lattice = torch.tensor(atoms.lattice_mat).type(
-                torch.get_default_dtype()
-            )
-            label = torch.tensor(d[target]).type(torch.get_default_dtype())
-            natoms = len(d["atoms"]["elements"])
-            # print('label',label,label.view(-1).long())
-            if classification:
-                label = label.long()
-                # label = label.view(-1).long()
-            if "extra_features" in d:
-                g.ndata["extra_features"] = torch.tensor(
-                    [d["extra_features"] for n in range(natoms)]
-                ).type(torch.get_default_dtype())
-            if target_atomwise is not None and target_atomwise != "":
-                g.ndata[target_atomwise] = torch.tensor(
-                    np.array(d[target_atomwise])
-                ).type(torch.get_default_dtype())
-            if target_grad is not None and target_grad != "":
-                # print('grad', np.array(d[target_grad]))
-                # print('grad shape',np.array(d[target_grad]).shape)
-                arr = np.array(d[target_grad])
-                try:
-                    g.ndata[target_grad] = torch.tensor(arr).type(
-                        torch.get_default_dtype()
-                    )
-                except Exception:
-                    arr = arr.reshape(1, -1)
-                    g.ndata[target_grad] = torch.tensor(arr).type(
-                        torch.get_default_dtype()
-                    )
-                    # print('arr',arr.shape)
-            if target_stress is not None and target_stress != "":
-                stress = np.array(d[target_stress])
-                g.ndata[target_stress] = torch.tensor(
-                    np.array([stress for ii in range(g.number_of_nodes())])
-                ).type(torch.get_default_dtype())
-            if (
-                target_additional_output is not None
-                and target_additional_output != ""
-            ):
-                additional_output = np.array(d[target_additional_output])
-                g.ndata[target_additional_output] = torch.tensor(
-                    ([additional_output for ii in range(natoms)])
-                ).type(torch.get_default_dtype())
-
-            # labels.append(label)
-            if line_graph:
-                serialized_data = pk.dumps((g, lg, lattice, label))
-            else:
-                serialized_data = pk.dumps((g, lattice, label))
-            txn.put(f"{idx}".encode(), serialized_data)
+    pbar = tqdm(total=len(dataset) if hasattr(dataset, "__len__") else None)
+    writer = None
+    if label_store:
+        writer = LabelStoreWriter(labels_path, graph_keys, atom_keys)
 
+    sizes = []
+    data_range = None
+
+    def read(batch):
+        # keep only ids, labels and the target range of the samples
+        nonlocal data_range
+        ids.extend(d[id_tag] for d in batch)
+        data_range = get_data_range([d[target] for d in batch], data_range)
+        if writer is not None:
+            for d in batch:
+                writer.append(
+                    sample_labels(d, target, writer.columns),
+                    natoms=len(d["atoms"]["elements"]),
+                )
+        return batch
+
+    def write(start, records):
+        with env.begin(write=True) as txn:
+            for idx, serialized_data in enumerate(records, start):
+                txn.put(f"{idx}".encode(), serialized_data)
+                sizes.append(record_sizes(serialized_data))
+        pbar.update(len(records))
+
+    samples = iter(dataset)
+    batches = iter(lambda: read(list(islice(samples, write_batch_size))), [])
+    start = 0
+    if workers > 0:
+        with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+            pending = None
+            for batch in batches:
+                result = pool.map_async(build, batch)
+                if pending is not None:
+                    write(start, pending.get())
+                    start += len(pending.get())
+                pending = result
+            if pending is not None:
+                write(start, pending.get())
+    else:
+        for batch in batches:
+            write(start, [build(d) for d in batch])
+            start += len(batch)
+    pbar.close()
     env.close()
+    # per-sample sizes for size-aware batching
+    np.save(
+        os.path.join(tmp_name, "graph_sizes.npy"),
+        np.array(sizes, dtype=np.int64).reshape(-1, 3),
+    )
+    write_data_range(data_range, output_dir, tmp_name)
+    store = None
+    if writer is not None:
+        writer.close({"params": label_params, "data_range": data_range})
+        store = LabelStore(labels_path)
+    with open(info_file, "w") as f:
+        json.dump({"ids": ids, "data_range": data_range}, f)
+    with open(params_file, "w") as f:
+        json.dump(params, f)
     lmdb_dataset = TorchLMDBDataset(
-        lmdb_path=tmp_name, line_graph=line_graph, ids=ids
+        lmdb_path=tmp_name,
+        line_graph=line_graph,
+        ids=ids,
+        batch_line_graph=batch_line_graph,
+        readahead=readahead,
+        max_readers=max_readers,
+        label_store=store,
     )
     return lmdb_dataset
 
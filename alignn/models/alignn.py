@@ -5,14 +5,17 @@ A prototype crystal line graph network dgl implementation.
 
 from typing import Tuple, Union
 import dgl
-import dgl.function as fn
 import numpy as np
 import torch
 from dgl.nn import AvgPooling
 from typing import Literal
 from torch import nn
 from torch.nn import functional as F
-from alignn.models.utils import RBFExpansion
+from alignn.models.utils import (
+    RBFExpansion,
+    edge_gated_graph_conv,
+    stack_linear,
+)
 from pydantic_settings import BaseSettings
 
 
@@ -85,8 +88,6 @@ class EdgeGatedGraphConv(nn.Module):
 
         h_i^l+1 = ReLU(U h_i + sum_{j->i} eta_{ij} ⊙ V h_j)
         """
-        g = g.local_var()
-
         # instead of concatenating (u || v || e) and applying one weight matrix
         # split the weight matrix into three, apply, then sum
         # see https://docs.dgl.ai/guide/message-efficient.html
@@ -95,19 +96,21 @@ class EdgeGatedGraphConv(nn.Module):
 
         # compute edge updates, equivalent to:
         # Softplus(Linear(u || v || e))
-        g.ndata["e_src"] = self.src_gate(node_feats)
-        g.ndata["e_dst"] = self.dst_gate(node_feats)
-        g.apply_edges(fn.u_add_v("e_src", "e_dst", "e_nodes"))
-        m = g.edata.pop("e_nodes") + self.edge_gate(edge_feats)
-
-        g.edata["sigma"] = torch.sigmoid(m)
-        g.ndata["Bh"] = self.dst_update(node_feats)
-        g.update_all(
-            fn.u_mul_e("Bh", "sigma", "m"), fn.sum("m", "sum_sigma_h")
+        x, m = edge_gated_graph_conv(
+            g,
+            node_feats,
+            edge_feats,
+            *stack_linear(
+                [
+                    self.src_gate,
+                    self.dst_gate,
+                    self.dst_update,
+                    self.src_update,
+                ]
+            ),
+            self.edge_gate.weight,
+            self.edge_gate.bias,
         )
-        g.update_all(fn.copy_e("sigma", "m"), fn.sum("m", "sum_sigma"))
-        g.ndata["h"] = g.ndata["sum_sigma_h"] / (g.ndata["sum_sigma"] + 1e-6)
-        x = self.src_update(node_feats) + g.ndata.pop("h")
 
         # softmax version seems to perform slightly worse
         # that the sigmoid-gated version
@@ -6,7 +6,6 @@ A prototype crystal line graph network dgl implementation.
 from typing import Tuple, Union
 from torch.autograd import grad
 import dgl
-import dgl.function as fn
 import numpy as np
 from dgl.nn import AvgPooling
 import torch
@@ -17,11 +16,15 @@ from torch import nn
 from torch.nn import functional as F
 from alignn.models.utils import (
     RBFExpansion,
+    edge_gated_graph_conv,
+    stack_linear,
+    compute_batch_stress,
     compute_cartesian_coordinates,
     compute_pair_vector_and_distance,
     MLPLayer,
+    reduce_pair_forces,
 )
-from alignn.graphs import compute_bond_cosines
+from alignn.graphs import compute_bond_cosines, triplet_line_graph
 from alignn.utils import BaseSettings
 
 
@@ -164,8 +167,6 @@ class EdgeGatedGraphConv(nn.Module):
 
         h_i^l+1 = ReLU(U h_i + sum_{j->i} eta_{ij} ⊙ V h_j)
         """
-        g = g.local_var()
-
         # instead of concatenating (u || v || e) and applying one weight matrix
         # split the weight matrix into three, apply, then sum
         # see https://docs.dgl.ai/guide/message-efficient.html
@@ -174,19 +175,21 @@ class EdgeGatedGraphConv(nn.Module):
 
         # compute edge updates, equivalent to:
         # Softplus(Linear(u || v || e))
-        g.ndata["e_src"] = self.src_gate(node_feats)
-        g.ndata["e_dst"] = self.dst_gate(node_feats)
-        g.apply_edges(fn.u_add_v("e_src", "e_dst", "e_nodes"))
-        m = g.edata.pop("e_nodes") + self.edge_gate(edge_feats)
-
-        g.edata["sigma"] = torch.sigmoid(m)
-        g.ndata["Bh"] = self.dst_update(node_feats)
-        g.update_all(
-            fn.u_mul_e("Bh", "sigma", "m"), fn.sum("m", "sum_sigma_h")
+        x, m = edge_gated_graph_conv(
+            g,
+            node_feats,
+            edge_feats,
+            *stack_linear(
+                [
+                    self.src_gate,
+                    self.dst_gate,
+                    self.dst_update,
+                    self.src_update,
+                ]
+            ),
+            self.edge_gate.weight,
+            self.edge_gate.bias,
         )
-        g.update_all(fn.copy_e("sigma", "m"), fn.sum("m", "sum_sigma"))
-        g.ndata["h"] = g.ndata["sum_sigma_h"] / (g.ndata["sum_sigma"] + 1e-6)
-        x = self.src_update(node_feats) + g.ndata.pop("h")
 
         # softmax version seems to perform slightly worse
         # that the sigmoid-gated version
@@ -381,9 +384,7 @@ class ALIGNNAtomWise(nn.Module):
                 g.ndata["cart_coords"] = compute_cartesian_coordinates(g, lat)
                 g.ndata["cart_coords"].requires_grad_(True)
                 r, bondlength = compute_pair_vector_and_distance(g)
-                lg = g.line_graph(shared=True)
-                lg.ndata["r"] = r
-                lg.apply_edges(compute_bond_cosines)
+                lg = triplet_line_graph(g, r=r)
                 # print('lg',lg)
                 # angle features (fixed)
         else:
@@ -407,9 +408,7 @@ class ALIGNNAtomWise(nn.Module):
             g.ndata["cart_coords"] = compute_cartesian_coordinates(g, lat)
             g.ndata["cart_coords"].requires_grad_(True)
             r, bondlength = compute_pair_vector_and_distance(g)
-            lg = g.line_graph(shared=True)
-            lg.ndata["r"] = r
-            lg.apply_edges(compute_bond_cosines)
+            lg = triplet_line_graph(g, r=r)
 
             # bondlength = torch.norm(r, dim=1)
             # y = self.edge_embedding(bondlength)
@@ -489,9 +488,7 @@ class ALIGNNAtomWise(nn.Module):
         forces = torch.empty(1)
         # gradient = torch.empty(1)
         stress = torch.empty(1)
-        natoms = torch.tensor([gg.num_nodes() for gg in dgl.unbatch(g)]).to(
-            g.device
-        )
+        natoms = g.batch_num_nodes()
         en_out = out
         if self.config.energy_mult_natoms:
             en_out = out * natoms  # g.num_nodes()
@@ -544,25 +541,12 @@ class ALIGNNAtomWise(nn.Module):
                 # reduce over bonds to get forces on each atom
 
                 # force_i contributions from r_{j->i} (in edges)
-                g.edata["pair_forces"] = pair_forces
-                g.update_all(
-                    fn.copy_e("pair_forces", "m"), fn.sum("m", "forces_ji")
-                )
-                if self.config.add_reverse_forces:
-                    # reduce over reverse edges too!
-                    # force_i contributions from r_{i->j} (out edges)
-                    # aggregate pairwise_force_contribs over reversed edges
-                    rg = dgl.reverse(g, copy_edata=True)
-                    rg.update_all(
-                        fn.copy_e("pair_forces", "m"), fn.sum("m", "forces_ij")
+                # and, reduced over reverse edges, from r_{i->j} (out edges)
+                forces = torch.squeeze(
+                    reduce_pair_forces(
+                        g, pair_forces, self.config.add_reverse_forces
                     )
-
-                    # combine dE / d(r_{j->i}) and dE / d(r_{i->j})
-                    forces = torch.squeeze(
-                        g.ndata["forces_ji"] - rg.ndata["forces_ij"]
-                    )
-                else:
-                    forces = torch.squeeze(g.ndata["forces_ji"])
+                )
 
                 if self.config.stresswise_weight != 0:
                     # print("self.config.batch_stress",self.config.batch_stress)
@@ -612,29 +596,9 @@ class ALIGNNAtomWise(nn.Module):
                     # print("stress1", stress, stress.shape)
                     # print("g.batch_size", g.batch_size)
                     else:
-                        stresses = []
-                        count_edge = 0
-                        count_node = 0
-                        for graph_id in range(g.batch_size):
-                            num_edges = g.batch_num_edges()[graph_id]
-                            num_nodes = 0
-                            st = -1 * (
-                                160.21766208
-                                * torch.matmul(
-                                    r[count_edge : count_edge + num_edges].T,
-                                    pair_forces[
-                                        count_edge : count_edge + num_edges
-                                    ],
-                                )
-                                / g.ndata["V"][count_node + num_nodes]
-                            )
-
-                            count_edge = count_edge + num_edges
-                            num_nodes = g.batch_num_nodes()[graph_id]
-                            count_node = count_node + num_nodes
-                            stresses.append(st)
-                        stress = self.config.stress_multiplier * torch.stack(
-                            stresses
+                        stress = (
+                            self.config.stress_multiplier
+                            * compute_batch_stress(g, r, pair_forces)
                         )
                         # print("stress",stress)
                     # print("stress2", stress, stress.shape)
@@ -0,0 +1,415 @@
+"""DGL-free ALIGNNAtomWise for inference.
+
+The forward pass takes plain tensors (edge index, triplet index, segment
+lengths) instead of DGL graphs and aggregates with index_add, so the
+model can be scripted with torch.jit.script or compiled with
+torch.compile. Parameter names are the same as ALIGNNAtomWise, so its
+state_dicts load unchanged.
+"""
+
+from typing import Dict, List, Optional
+import math
+import torch
+from torch import nn
+from torch.nn import functional as F
+from alignn.models.layers import (
+    MLPLayer,
+    RBFExpansion,
+    cutoff_function_based_edges,
+    edge_gated_graph_conv_index,
+    reduce_pair_forces_index,
+    virial_stress,
+)
+from alignn.segment import segment_first, segment_mean
+
+
+class EdgeGatedGraphConv(nn.Module):
+    """Edge gated graph convolution on edge index tensors."""
+
+    def __init__(
+        self, input_features: int, output_features: int, residual: bool = True
+    ):
+        """Initialize parameters as alignn_atomwise.EdgeGatedGraphConv."""
+        super().__init__()
+        self.residual = residual
+        self.src_gate = nn.Linear(input_features, output_features)
+        self.dst_gate = nn.Linear(input_features, output_features)
+        self.edge_gate = nn.Linear(input_features, output_features)
+        self.bn_edges = nn.LayerNorm(output_features)
+
+        self.src_update = nn.Linear(input_features, output_features)
+        self.dst_update = nn.Linear(input_features, output_features)
+        self.bn_nodes = nn.LayerNorm(output_features)
+
+    def forward(
+        self,
+        src: torch.Tensor,
+        dst: torch.Tensor,
+        node_feats: torch.Tensor,
+        edge_feats: torch.Tensor,
+    ):
+        """Edge-gated graph convolution over edges src -> dst."""
+        # as stack_linear, written out for torch.jit.script
+        layers = [
+            self.src_gate,
+            self.dst_gate,
+            self.dst_update,
+            self.src_update,
+        ]
+        x, m = edge_gated_graph_conv_index(
+            src,
+            dst,
+            node_feats,
+            edge_feats,
+            torch.cat([layer.weight for layer in layers], dim=0),
+            torch.cat([layer.bias for layer in layers], dim=0),
+            self.edge_gate.weight,
+            self.edge_gate.bias,
+        )
+        x = F.silu(self.bn_nodes(x))
+        y = F.silu(self.bn_edges(m))
+
+        if self.residual:
+            x = node_feats + x
+            y = edge_feats + y
+
+        return x, y
+
+
+class ALIGNNConv(nn.Module):
+    """Line graph update on edge and triplet index tensors."""
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+    ):
+        """Set up ALIGNN parameters."""
+        super().__init__()
+        self.node_update = EdgeGatedGraphConv(in_features, out_features)
+        self.edge_update = EdgeGatedGraphConv(out_features, out_features)
+
+    def forward(
+        self,
+        src: torch.Tensor,
+        dst: torch.Tensor,
+        lg_src: torch.Tensor,
+        lg_dst: torch.Tensor,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        z: torch.Tensor,
+    ):
+        """Node and Edge updates for ALIGNN layer.
+
+        x: node input features
+        y: edge input features
+        z: edge pair input features
+        """
+        x, m = self.node_update(src, dst, x, y)
+        y, z = self.edge_update(lg_src, lg_dst, m, z)
+        return x, y, z
+
+
+def bond_cosines(
+    r: torch.Tensor, lg_src: torch.Tensor, lg_dst: torch.Tensor
+) -> torch.Tensor:
+    """Get bond angle cosines of bond pairs (a -> b, b -> c)."""
+    r1 = -r.index_select(0, lg_src)
+    r2 = r.index_select(0, lg_dst)
+    bond_cosine = torch.sum(r1 * r2, dim=1) / (
+        torch.norm(r1, dim=1) * torch.norm(r2, dim=1)
+    )
+    return torch.clamp(bond_cosine, -1, 1)
+
+
+def check_torch_config(config=None):
+    """Raise ValueError for options ALIGNNAtomWiseTorch doesn't support."""
+    if config.include_pos_deriv:
+        raise ValueError(
+            "ALIGNNAtomWiseTorch does not support include_pos_deriv",
+            config.include_pos_deriv,
+        )
+    if config.extra_features != 0:
+        raise ValueError(
+            "ALIGNNAtomWiseTorch does not support extra_features",
+            config.extra_features,
+        )
+
+
+class ALIGNNAtomWiseTorch(nn.Module):
+    """ALIGNNAtomWise forward pass on plain tensors.
+
+    Takes an ALIGNNAtomWiseConfig. Positional derivatives
+    (include_pos_deriv) and extra_features are not supported.
+    """
+
+    def __init__(self, config=None):
+        """Initialize class with number of input features, conv layers."""
+        super().__init__()
+        check_torch_config(config)
+        self.classification = config.classification
+        self.calculate_gradient = (
+            config.calculate_gradient and config.gradwise_weight != 0
+        )
+        self.lg_on_fly = config.lg_on_fly
+        self.use_cutoff_function = config.use_cutoff_function
+        self.multiply_cutoff = config.multiply_cutoff
+        self.inner_cutoff = float(config.inner_cutoff)
+        self.exponent = int(config.exponent)
+        self.use_penalty = config.use_penalty
+        self.penalty_factor = float(config.penalty_factor)
+        self.penalty_threshold = float(config.penalty_threshold)
+        self.energy_mult_natoms = config.energy_mult_natoms
+        self.force_mult_natoms = config.force_mult_natoms
+        self.add_reverse_forces = config.add_reverse_forces
+        self.grad_multiplier = float(config.grad_multiplier)
+        self.stresswise_weight = float(config.stresswise_weight)
+        self.batch_stress = config.batch_stress
+        self.stress_multiplier = float(config.stress_multiplier)
+        self.atomwise_output = (
+            config.atomwise_output_features > 0 and config.atomwise_weight != 0
+        )
+        self.additional_output = config.additional_output_features > 0
+        self.link = config.link
+
+        self.atom_embedding = MLPLayer(
+            config.atom_input_features, config.hidden_features
+        )
+
+        self.edge_embedding = nn.Sequential(
+            RBFExpansion(
+                vmin=0,
+                vmax=8.0,
+                bins=config.edge_input_features,
+            ),
+            MLPLayer(config.edge_input_features, config.embedding_features),
+            MLPLayer(config.embedding_features, config.hidden_features),
+        )
+        self.angle_embedding = nn.Sequential(
+            RBFExpansion(
+                vmin=-1,
+                vmax=1.0,
+                bins=config.triplet_input_features,
+            ),
+            MLPLayer(config.triplet_input_features, config.embedding_features),
+            MLPLayer(config.embedding_features, config.hidden_features),
+        )
+
+        self.alignn_layers = nn.ModuleList(
+            [
+                ALIGNNConv(
+                    config.hidden_features,
+                    config.hidden_features,
+                )
+                for idx in range(config.alignn_layers)
+            ]
+        )
+        self.gcn_layers = nn.ModuleList(
+            [
+                EdgeGatedGraphConv(
+                    config.hidden_features, config.hidden_features
+                )
+                for idx in range(config.gcn_layers)
+            ]
+        )
+
+        if config.atomwise_output_features > 0:
+            self.fc_atomwise = nn.Linear(
+                config.hidden_features, config.atomwise_output_features
+            )
+        else:
+            self.fc_atomwise = nn.Identity()
+
+        if config.additional_output_features:
+            self.fc_additional_output = nn.Linear(
+                config.hidden_features, config.additional_output_features
+            )
+        else:
+            self.fc_additional_output = nn.Identity()
+        if self.classification:
+            self.fc = nn.Linear(config.hidden_features, 1)
+        else:
+            self.fc = nn.Linear(config.hidden_features, config.output_features)
+        if self.link == "log":
+            # as in ALIGNNAtomWise, so its state_dicts match
+            avg_gap = 0.7
+            self.fc.bias.data = torch.tensor(
+                math.log(avg_gap), dtype=torch.float
+            )
+
+    def forward(
+        self,
+        atom_features: torch.Tensor,
+        r: torch.Tensor,
+        src: torch.Tensor,
+        dst: torch.Tensor,
+        lg_src: torch.Tensor,
+        lg_dst: torch.Tensor,
+        num_nodes: torch.Tensor,
+        num_edges: torch.Tensor,
+        volume: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """ALIGNN : start with atom features.
+
+        atom_features: (N, F) input features of the atoms of all graphs
+        r: (E, 3) bond vectors of edges src -> dst
+        lg_src, lg_dst: bond pairs (a -> b, b -> c) as edge ids
+        num_nodes, num_edges: (B,) atoms and bonds of every graph
+        volume: (B,) cell volume of every graph
+        """
+        x = self.atom_embedding(atom_features)
+        if self.calculate_gradient:
+            r.requires_grad_(True)
+        bondlength = torch.norm(r, dim=1)
+
+        z = torch.empty(0)
+        if len(self.alignn_layers) > 0:
+            # without lg_on_fly angles are precomputed, no gradient
+            h = bond_cosines(
+                r if self.lg_on_fly else r.detach(), lg_src, lg_dst
+            )
+            z = self.angle_embedding(h)
+
+        if self.use_cutoff_function:
+            if self.multiply_cutoff:
+                c_off = cutoff_function_based_edges(
+                    bondlength,
+                    inner_cutoff=self.inner_cutoff,
+                    exponent=self.exponent,
+                ).unsqueeze(dim=1)
+                y = self.edge_embedding(bondlength) * c_off
+            else:
+                bondlength = cutoff_function_based_edges(
+                    bondlength,
+                    inner_cutoff=self.inner_cutoff,
+                    exponent=self.exponent,
+                )
+                y = self.edge_embedding(bondlength)
+        else:
+            y = self.edge_embedding(bondlength)
+
+        # ALIGNN updates: update node, edge, triplet features
+        for alignn_layer in self.alignn_layers:
+            x, y, z = alignn_layer(src, dst, lg_src, lg_dst, x, y, z)
+
+        # gated GCN updates: update node, edge features
+        for gcn_layer in self.gcn_layers:
+            x, y = gcn_layer(src, dst, x, y)
+
+        h = segment_mean(x, num_nodes)
+        out = torch.squeeze(self.fc(h))
+        additional_out = torch.empty(1)
+        if self.additional_output:
+            additional_out = self.fc_additional_output(h)
+
+        atomwise_pred = torch.empty(1)
+        if self.atomwise_output:
+            atomwise_pred = self.fc_atomwise(x)
+
+        forces = torch.empty(1)
+        stress = torch.empty(1)
+        en_out = out
+        if self.energy_mult_natoms:
+            en_out = out * num_nodes
+        if self.use_penalty:
+            penalties = torch.where(
+                bondlength < self.penalty_threshold,
+                self.penalty_factor * (self.penalty_threshold - bondlength),
+                torch.zeros_like(bondlength),
+            )
+            en_out = en_out + torch.sum(penalties)
+            if not self.energy_mult_natoms:
+                # as in ALIGNNAtomWise, out is the penalized energy then
+                out = en_out
+
+        if self.calculate_gradient:
+            # autograd gives dE / d{r_{i->j}}
+            grad_outputs: List[Optional[torch.Tensor]] = [
+                torch.ones_like(en_out)
+            ]
+            grads = torch.autograd.grad(
+                [en_out],
+                [r],
+                grad_outputs=grad_outputs,
+                retain_graph=True,
+                create_graph=self.training,
+            )
+            pair_forces = grads[0]
+            assert pair_forces is not None
+            pair_forces = self.grad_multiplier * pair_forces
+            if self.force_mult_natoms:
+                pair_forces = pair_forces * atom_features.shape[0]
+            forces = torch.squeeze(
+                reduce_pair_forces_index(
+                    src,
+                    dst,
+                    pair_forces,
+                    atom_features.shape[0],
+                    self.add_reverse_forces,
+                )
+            )
+            if self.stresswise_weight != 0:
+                if self.batch_stress:
+                    stress = self.stress_multiplier * virial_stress(
+                        r, pair_forces, num_edges, volume
+                    )
+                else:
+                    # uses the given r, see graph_inputs for how this
+                    # differs from ALIGNNAtomWise for periodic bonds
+                    stress = (
+                        -160.21766208
+                        * torch.matmul(r.T, pair_forces)
+                        / (2 * volume[0])
+                    )
+
+        if self.link == "log":
+            out = torch.exp(out)
+        elif self.link == "logit":
+            out = torch.sigmoid(out)
+
+        if self.classification:
+            out = torch.sigmoid(out)
+        result: Dict[str, torch.Tensor] = {}
+        result["out"] = out
+        result["additional"] = additional_out
+        result["grad"] = forces
+        result["stresses"] = stress
+        result["atomwise_pred"] = atomwise_pred
+        return result
+
+
+def graph_inputs(g=None, lg=None, dtype=None):
+    """Get the ALIGNNAtomWiseTorch inputs of a (batched) DGL graph.
+
+    lg is the line graph of g, e.g. from alignn.graphs.triplet_line_graph,
+    it is only needed with alignn_layers. With dtype=None the features
+    keep the dtype of the graph data, the volume gets the dtype of r.
+
+    The bond vectors are g.edata["r"] as stored in the graph. For the
+    non batch_stress virial ALIGNNAtomWise instead recomputes r from
+    cart_coords and the integer image offsets in g.edata["images"],
+    which only matches g.edata["r"] for bonds within the cell (zero
+    images), so its stress differs for periodic bonds.
+    """
+    src, dst = g.edges()
+    if lg is None:
+        lg_src = lg_dst = torch.zeros(0, dtype=src.dtype, device=src.device)
+    else:
+        lg_src, lg_dst = lg.edges()
+    atom_features = g.ndata["atom_features"]
+    r = g.edata["r"]
+    if dtype is not None:
+        atom_features = atom_features.to(dtype)
+        r = r.to(dtype)
+    num_nodes = g.batch_num_nodes()
+    return {
+        "atom_features": atom_features,
+        "r": r,
+        "src": src,
+        "dst": dst,
+        "lg_src": lg_src,
+        "lg_dst": lg_dst,
+        "num_nodes": num_nodes,
+        "num_edges": g.batch_num_edges(),
+        "volume": segment_first(g.ndata["V"], num_nodes).to(r.dtype),
+    }
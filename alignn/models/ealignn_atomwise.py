@@ -6,7 +6,6 @@ A prototype crystal line graph network dgl implementation.
 from typing import Tuple, Union
 from torch.autograd import grad
 import dgl
-import dgl.function as fn
 
 # import numpy as np
 from dgl.nn import AvgPooling
@@ -18,13 +17,17 @@ from torch import nn
 from torch.nn import functional as F
 from alignn.models.utils import (
     RBFExpansion,
+    edge_gated_graph_conv,
+    stack_linear,
+    compute_batch_stress,
     compute_cartesian_coordinates,
     compute_pair_vector_and_distance,
     MLPLayer,
+    reduce_pair_forces,
     lightweight_line_graph,
     remove_net_torque,
 )
-from alignn.graphs import compute_bond_cosines
+from alignn.graphs import triplet_line_graph
 from alignn.utils import BaseSettings
 
 
@@ -107,21 +110,21 @@ class EdgeGatedGraphConv(nn.Module):
 
         h_i^l+1 = ReLU(U h_i + sum_{j->i} eta_{ij} ⊙ V h_j)
         """
-        g = g.local_var()
-
-        g.ndata["e_src"] = self.src_gate(node_feats)
-        g.ndata["e_dst"] = self.dst_gate(node_feats)
-        g.apply_edges(fn.u_add_v("e_src", "e_dst", "e_nodes"))
-        m = g.edata.pop("e_nodes") + self.edge_gate(edge_feats)
-
-        g.edata["sigma"] = torch.sigmoid(m)
-        g.ndata["Bh"] = self.dst_update(node_feats)
-        g.update_all(
-            fn.u_mul_e("Bh", "sigma", "m"), fn.sum("m", "sum_sigma_h")
+        x, m = edge_gated_graph_conv(
+            g,
+            node_feats,
+            edge_feats,
+            *stack_linear(
+                [
+                    self.src_gate,
+                    self.dst_gate,
+                    self.dst_update,
+                    self.src_update,
+                ]
+            ),
+            self.edge_gate.weight,
+            self.edge_gate.bias,
         )
-        g.update_all(fn.copy_e("sigma", "m"), fn.sum("m", "sum_sigma"))
-        g.ndata["h"] = g.ndata["sum_sigma_h"] / (g.ndata["sum_sigma"] + 1e-6)
-        x = self.src_update(node_feats) + g.ndata.pop("h")
 
         x = F.silu(self.bn_nodes(x))
         y = F.silu(self.bn_edges(m))
@@ -316,9 +319,7 @@ class eALIGNNAtomWise(nn.Module):
                 ),
             )
             r, bondlength = compute_pair_vector_and_distance(g)
-            lg = g.line_graph(shared=True)
-            lg.ndata["r"] = r  # overwrites precomputed r values
-            lg.apply_edges(compute_bond_cosines)  # overwrites precomputed h
+            lg = triplet_line_graph(g, r=r)
             z = self.angle_embedding(lg.edata.pop("h"))
 
         y = self.edge_embedding(bondlength)
@@ -358,9 +359,7 @@ class eALIGNNAtomWise(nn.Module):
         forces = torch.empty(1)
         # gradient = torch.empty(1)
         stress = torch.empty(1)
-        natoms = torch.tensor([gg.num_nodes() for gg in dgl.unbatch(g)]).to(
-            g.device
-        )
+        natoms = g.batch_num_nodes()
         en_out = out
         if self.config.energy_mult_natoms:
             en_out = out * natoms  # g.num_nodes()
@@ -393,19 +392,8 @@ class eALIGNNAtomWise(nn.Module):
             )
             pair_forces *= g.num_nodes()
 
-            g.edata["pair_forces"] = pair_forces
-            g.update_all(
-                fn.copy_e("pair_forces", "m"), fn.sum("m", "forces_ji")
-            )
-            rg = dgl.reverse(g, copy_edata=True)
-            rg.update_all(
-                fn.copy_e("pair_forces", "m"), fn.sum("m", "forces_ij")
-            )
-
             # combine dE / d(r_{j->i}) and dE / d(r_{i->j})
-            forces = torch.squeeze(
-                g.ndata["forces_ji"] - rg.ndata["forces_ij"]
-            )
+            forces = torch.squeeze(reduce_pair_forces(g, pair_forces))
             if self.config.remove_torque:
                 # print('forces1',forces,forces.shape)
                 # print('natoms',natoms,natoms.shape)
@@ -413,26 +401,9 @@ class eALIGNNAtomWise(nn.Module):
                 # print('forces2',forces,forces.shape)
 
             if self.config.stresswise_weight != 0:
-                stresses = []
-                count_edge = 0
-                count_node = 0
-                for graph_id in range(g.batch_size):
-                    num_edges = g.batch_num_edges()[graph_id]
-                    num_nodes = 0
-                    st = -1 * (
-                        160.21766208
-                        * torch.matmul(
-                            r[count_edge : count_edge + num_edges].T,
-                            pair_forces[count_edge : count_edge + num_edges],
-                        )
-                        / g.ndata["V"][count_node + num_nodes]
-                    )
-
-                    count_edge = count_edge + num_edges
-                    num_nodes = g.batch_num_nodes()[graph_id]
-                    count_node = count_node + num_nodes
-                    stresses.append(st)
-                stress = self.config.stress_multiplier * torch.stack(stresses)
+                stress = self.config.stress_multiplier * compute_batch_stress(
+                    g, r, pair_forces
+                )
         if self.classification:
             out = self.softmax(out)
         # print('out',out)
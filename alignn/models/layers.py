@@ -0,0 +1,179 @@
+"""Model components that only depend on PyTorch.
+
+These work on plain tensors (edge index, segment lengths) and are shared
+by the DGL models and the DGL-free ALIGNNAtomWiseTorch.
+"""
+
+from typing import Optional, List, Tuple
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from alignn.segment import segment_sum
+
+
+class RBFExpansion(nn.Module):
+    """Expand interatomic distances with radial basis functions."""
+
+    def __init__(
+        self,
+        vmin: float = 0,
+        vmax: float = 8,
+        bins: int = 40,
+        lengthscale: Optional[float] = None,
+    ):
+        """Register torch parameters for RBF expansion."""
+        super().__init__()
+        self.vmin = vmin
+        self.vmax = vmax
+        self.bins = bins
+        self.register_buffer(
+            "centers", torch.linspace(self.vmin, self.vmax, self.bins)
+        )
+
+        if lengthscale is None:
+            # SchNet-style
+            # set lengthscales relative to granularity of RBF expansion
+            self.lengthscale = np.diff(self.centers).mean()
+            self.gamma = 1 / self.lengthscale
+
+        else:
+            self.lengthscale = lengthscale
+            self.gamma = 1 / (lengthscale**2)
+
+    def forward(self, distance: torch.Tensor) -> torch.Tensor:
+        """Apply RBF expansion to interatomic distance tensor."""
+        return torch.exp(
+            -self.gamma * (distance.unsqueeze(1) - self.centers) ** 2
+        )
+
+
+class MLPLayer(nn.Module):
+    """Multilayer perceptron layer helper."""
+
+    def __init__(self, in_features: int, out_features: int):
+        """Linear, Batchnorm, SiLU layer."""
+        super().__init__()
+        self.layer = nn.Sequential(
+            nn.Linear(in_features, out_features),
+            nn.LayerNorm(out_features),
+            nn.SiLU(),
+        )
+
+    def forward(self, x):
+        """Linear, Batchnorm, silu layer."""
+        # print('xtype',x.dtype)
+        return self.layer(x)
+
+
+def cutoff_function_based_edges(
+    r: torch.Tensor, inner_cutoff: float = 4, exponent: int = 3
+):
+    """Apply smooth cutoff to pairwise interactions
+
+    r: bond lengths
+    inner_cutoff: cutoff radius
+
+    inside cutoff radius, apply smooth cutoff envelope
+    outside cutoff radius: hard zeros
+    """
+    ratio = r / inner_cutoff
+    c1 = -(exponent + 1) * (exponent + 2) / 2
+    c2 = exponent * (exponent + 2)
+    c3 = -exponent * (exponent + 1) / 2
+    envelope = (
+        1
+        + c1 * ratio**exponent
+        + c2 * ratio ** (exponent + 1)
+        + c3 * ratio ** (exponent + 2)
+    )
+    # r_cut = inner_cutoff
+    # r_on = inner_cutoff+1
+
+    # r_sq = r * r
+    # r_on_sq = r_on * r_on
+    # r_cut_sq = r_cut * r_cut
+    # envelope = (r_cut_sq - r_sq)
+    # ** 2 * (r_cut_sq + 2 * r_sq - 3 * r_on_sq)/ (r_cut_sq - r_on_sq) ** 3
+    return torch.where(r <= inner_cutoff, envelope, torch.zeros_like(r))
+
+
+def stack_linear(
+    layers: List[nn.Linear],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Stack the weights and biases of linear layers with equal inputs."""
+    weight = torch.cat([layer.weight for layer in layers], dim=0)
+    bias = torch.cat([layer.bias for layer in layers], dim=0)
+    return weight, bias
+
+
+def edge_gated_graph_conv_index(
+    src: torch.Tensor,
+    dst: torch.Tensor,
+    node_feats: torch.Tensor,
+    edge_feats: torch.Tensor,
+    node_weight: torch.Tensor,
+    node_bias: torch.Tensor,
+    edge_weight: torch.Tensor,
+    edge_bias: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Edge-gated graph convolution on edge index tensors, without DGL.
+
+    node_weight and node_bias stack the src_gate, dst_gate, dst_update and
+    src_update layers (see stack_linear). Edge end points are gathered
+    with index_select and sum_{j->i} sigma_ij * Bh_j and sum_{j->i}
+    sigma_ij are aggregated with index_add. Returns the node update and
+    the edge gate logits, before normalization and activation. Plain
+    tensor ops only, so it can be scripted or compiled.
+    """
+    e_src, e_dst, bh, x = F.linear(node_feats, node_weight, node_bias).chunk(
+        4, dim=1
+    )
+    m = (
+        e_src.index_select(0, src)
+        + e_dst.index_select(0, dst)
+        + F.linear(edge_feats, edge_weight, edge_bias)
+    )
+    sigma = torch.sigmoid(m)
+    zeros = torch.zeros_like(x)
+    sum_sigma_h = zeros.index_add(0, dst, bh.index_select(0, src) * sigma)
+    sum_sigma = zeros.index_add(0, dst, sigma)
+    return x + sum_sigma_h / (sum_sigma + 1e-6), m
+
+
+def reduce_pair_forces_index(
+    src: torch.Tensor,
+    dst: torch.Tensor,
+    pair_forces: torch.Tensor,
+    num_nodes: int,
+    add_reverse_forces: bool = True,
+) -> torch.Tensor:
+    """Reduce pair forces dE / d{r_{i->j}} over bonds to atom forces.
+
+    Atom i gets the pair forces of its in edges r_{j->i} and, with
+    add_reverse_forces, minus those of its out edges r_{i->j}. Both are
+    accumulated into one tensor with index_add_ over the edge end points.
+    """
+    forces = pair_forces.new_zeros(
+        [num_nodes] + list(pair_forces.shape[1:])
+    ).index_add_(0, dst, pair_forces)
+    if add_reverse_forces:
+        forces = forces.index_add_(0, src, pair_forces, alpha=-1)
+    return forces
+
+
+def virial_stress(
+    r: torch.Tensor,
+    pair_forces: torch.Tensor,
+    num_edges: torch.Tensor,
+    volume: torch.Tensor,
+) -> torch.Tensor:
+    """Calculate the virial stress of every graph of a batch in GPa.
+
+    The outer products of bond vectors and pair forces are summed per
+    graph with one index_add_ and divided by the volume of the graph,
+    giving a (batch_size, 3, 3) tensor.
+    """
+    virial = segment_sum(r.unsqueeze(2) * pair_forces.unsqueeze(1), num_edges)
+    # 1 eV/Angstrom3 = 160.21766208 GPa
+    return -160.21766208 * virial / volume.view(-1, 1, 1)
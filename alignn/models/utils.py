@@ -1,47 +1,49 @@
 """Shared model-building components."""
 
-from typing import Optional, Callable
-import numpy as np
+from typing import Callable
 import torch
-import torch.nn as nn
+from torch.nn import functional as F
 import dgl
 from typing import Tuple
+from alignn.segment import segment_first, segment_ids, segment_sum
+from alignn.models.layers import (  # noqa: F401
+    MLPLayer,
+    RBFExpansion,
+    cutoff_function_based_edges,
+    edge_gated_graph_conv_index,
+    reduce_pair_forces_index,
+    stack_linear,
+    virial_stress,
+)
+
+
+def edge_gated_graph_conv(
+    g: dgl.DGLGraph,
+    node_feats: torch.Tensor,
+    edge_feats: torch.Tensor,
+    node_weight: torch.Tensor,
+    node_bias: torch.Tensor,
+    edge_weight: torch.Tensor,
+    edge_bias: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Edge-gated graph convolution with DGL sparse kernels.
 
-
-class RBFExpansion(nn.Module):
-    """Expand interatomic distances with radial basis functions."""
-
-    def __init__(
-        self,
-        vmin: float = 0,
-        vmax: float = 8,
-        bins: int = 40,
-        lengthscale: Optional[float] = None,
-    ):
-        """Register torch parameters for RBF expansion."""
-        super().__init__()
-        self.vmin = vmin
-        self.vmax = vmax
-        self.bins = bins
-        self.register_buffer(
-            "centers", torch.linspace(self.vmin, self.vmax, self.bins)
-        )
-
-        if lengthscale is None:
-            # SchNet-style
-            # set lengthscales relative to granularity of RBF expansion
-            self.lengthscale = np.diff(self.centers).mean()
-            self.gamma = 1 / self.lengthscale
-
-        else:
-            self.lengthscale = lengthscale
-            self.gamma = 1 / (lengthscale**2)
-
-    def forward(self, distance: torch.Tensor) -> torch.Tensor:
-        """Apply RBF expansion to interatomic distance tensor."""
-        return torch.exp(
-            -self.gamma * (distance.unsqueeze(1) - self.centers) ** 2
-        )
+    node_weight and node_bias stack the src_gate, dst_gate, dst_update and
+    src_update layers, so the node features take one matrix multiply.
+    Nothing is stored on the graph. Returns the node update and the edge
+    gate logits, before normalization and activation.
+    """
+    e_src, e_dst, bh, x = F.linear(node_feats, node_weight, node_bias).chunk(
+        4, dim=1
+    )
+    m = dgl.ops.u_add_v(g, e_src, e_dst) + F.linear(
+        edge_feats, edge_weight, edge_bias
+    )
+    sigma = torch.sigmoid(m)
+    h = dgl.ops.u_mul_e_sum(g, bh, sigma) / (
+        dgl.ops.copy_e_sum(g, sigma) + 1e-6
+    )
+    return x + h, m
 
 
 def compute_pair_vector_and_distance(g: dgl.DGLGraph):
@@ -55,34 +57,32 @@ def compute_pair_vector_and_distance(g: dgl.DGLGraph):
     return bond_vec, bond_dist
 
 
-def cutoff_function_based_edges(r, inner_cutoff=4, exponent=3):
-    """Apply smooth cutoff to pairwise interactions
+def reduce_pair_forces(
+    g: dgl.DGLGraph, pair_forces: torch.Tensor, add_reverse_forces=True
+):
+    """Reduce pair forces dE / d{r_{i->j}} over bonds to atom forces.
 
-    r: bond lengths
-    inner_cutoff: cutoff radius
-
-    inside cutoff radius, apply smooth cutoff envelope
-    outside cutoff radius: hard zeros
+    See reduce_pair_forces_index, no reversed copy of the graph is made.
     """
-    ratio = r / inner_cutoff
-    c1 = -(exponent + 1) * (exponent + 2) / 2
-    c2 = exponent * (exponent + 2)
-    c3 = -exponent * (exponent + 1) / 2
-    envelope = (
-        1
-        + c1 * ratio**exponent
-        + c2 * ratio ** (exponent + 1)
-        + c3 * ratio ** (exponent + 2)
+    src, dst = g.edges()
+    return reduce_pair_forces_index(
+        src, dst, pair_forces, g.num_nodes(), add_reverse_forces
     )
-    # r_cut = inner_cutoff
-    # r_on = inner_cutoff+1
 
-    # r_sq = r * r
-    # r_on_sq = r_on * r_on
-    # r_cut_sq = r_cut * r_cut
-    # envelope = (r_cut_sq - r_sq)
-    # ** 2 * (r_cut_sq + 2 * r_sq - 3 * r_on_sq)/ (r_cut_sq - r_on_sq) ** 3
-    return torch.where(r <= inner_cutoff, envelope, torch.zeros_like(r))
+
+def compute_batch_stress(
+    g: dgl.DGLGraph, r: torch.Tensor, pair_forces: torch.Tensor
+):
+    """Calculate the virial stress of every graph of a batch in GPa.
+
+    The volume V is read from the first node of every graph.
+    """
+    return virial_stress(
+        r,
+        pair_forces,
+        g.batch_num_edges(),
+        segment_first(g.ndata["V"], g.batch_num_nodes()),
+    )
 
 
 def compute_cartesian_coordinates(g, lattice, dtype=torch.float32):
@@ -107,10 +107,7 @@ def compute_cartesian_coordinates(g, lattice, dtype=torch.float32):
         lattice = lattice.to(dtype)
 
     # Generate batch indices to map nodes to their corresponding graph
-    batch_indices = torch.repeat_interleave(
-        torch.arange(len(lattice), device=frac_coords.device),
-        g.batch_num_nodes(),
-    )
+    batch_indices = segment_ids(g.batch_num_nodes()).to(frac_coords.device)
 
     # Expand lattice matrices based on batch indices to match node count
     expanded_lattice = lattice[batch_indices]  # Shape: (N, 3, 3)
@@ -142,84 +139,40 @@ def lightweight_line_graph(
     Returns:
         New DGL graph with filtered edges preserving original node ordering
     """
-    # Check if graph is batched
-    is_batched = (
-        hasattr(input_graph, "batch_size") and input_graph.batch_size > 1
+    # Filter all graphs of a batch at once, edges stay grouped by graph
+    active_edges = torch.logical_not(
+        filter_condition(input_graph.edata[feature_name])
     )
 
-    if is_batched:
-        # Get the batch size and number of nodes per graph
-        # batch_size = input_graph.batch_size
-        graph_list = dgl.unbatch(input_graph)
-        processed_graphs = []
-
-        # Process each graph individually
-        for g in graph_list:
-            # Get active edges for this graph
-            g_active_edges = torch.logical_not(
-                filter_condition(g.edata[feature_name])
-            )
-
-            # Get filtered edges
-            g_src, g_dst = g.edges()
-            g_src = g_src[g_active_edges]
-            g_dst = g_dst[g_active_edges]
-
-            # Get edge IDs for active edges
-            g_edge_ids = g_active_edges.nonzero().squeeze()
-
-            # Create new graph with same number of nodes
-            new_g = dgl.graph(
-                (g_src, g_dst),
-                num_nodes=g.num_nodes(),
-                device=input_graph.device,
-            )
-
-            # Copy edge IDs
-            new_g.edata["edge_ids"] = g_edge_ids
-
-            # Copy node features
-            for node_feature, node_value in g.ndata.items():
-                new_g.ndata[node_feature] = node_value
-
-            # Copy filtered edge features
-            for edge_feature, edge_value in g.edata.items():
-                new_g.edata[edge_feature] = edge_value[g_active_edges]
-
-            processed_graphs.append(new_g)
-
-        # Batch the processed graphs back together
-        return dgl.batch(processed_graphs)
-
-    else:
-        # Handle single graph case (original implementation)
-        active_edges = torch.logical_not(
-            filter_condition(input_graph.edata[feature_name])
-        )
-
-        source_nodes, destination_nodes = input_graph.edges()
-        source_nodes, destination_nodes = (
-            source_nodes[active_edges],
-            destination_nodes[active_edges],
-        )
-
-        edge_ids = active_edges.nonzero().squeeze()
-
-        new_graph = dgl.graph(
-            (source_nodes, destination_nodes),
-            num_nodes=input_graph.num_nodes(),
-            device=input_graph.device,
-        )
+    source_nodes, destination_nodes = input_graph.edges()
+    source_nodes, destination_nodes = (
+        source_nodes[active_edges],
+        destination_nodes[active_edges],
+    )
 
-        new_graph.edata["edge_ids"] = edge_ids
+    new_graph = dgl.graph(
+        (source_nodes, destination_nodes),
+        num_nodes=input_graph.num_nodes(),
+        device=input_graph.device,
+    )
+    num_edges = input_graph.batch_num_edges()
+    new_graph.set_batch_num_nodes(input_graph.batch_num_nodes())
+    new_graph.set_batch_num_edges(segment_sum(active_edges.long(), num_edges))
+
+    # edge ids are counted within each graph of the batch
+    edge_ids = active_edges.nonzero().view(-1)
+    edge_offsets = torch.cumsum(num_edges, 0) - num_edges
+    new_graph.edata["edge_ids"] = (
+        edge_ids - edge_offsets[segment_ids(num_edges)[edge_ids]]
+    )
 
-        for node_feature, node_value in input_graph.ndata.items():
-            new_graph.ndata[node_feature] = node_value
+    for node_feature, node_value in input_graph.ndata.items():
+        new_graph.ndata[node_feature] = node_value
 
-        for edge_feature, edge_value in input_graph.edata.items():
-            new_graph.edata[edge_feature] = edge_value[active_edges]
+    for edge_feature, edge_value in input_graph.edata.items():
+        new_graph.edata[edge_feature] = edge_value[active_edges]
 
-        return new_graph
+    return new_graph
 
 
 def lightweight_line_graph1(
@@ -274,24 +227,6 @@ def lightweight_line_graph1(
     return new_graph
 
 
-class MLPLayer(nn.Module):
-    """Multilayer perceptron layer helper."""
-
-    def __init__(self, in_features: int, out_features: int):
-        """Linear, Batchnorm, SiLU layer."""
-        super().__init__()
-        self.layer = nn.Sequential(
-            nn.Linear(in_features, out_features),
-            nn.LayerNorm(out_features),
-            nn.SiLU(),
-        )
-
-    def forward(self, x):
-        """Linear, Batchnorm, silu layer."""
-        # print('xtype',x.dtype)
-        return self.layer(x)
-
-
 def compute_net_torque(
     positions: torch.Tensor, forces: torch.Tensor, n_nodes: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -347,12 +282,7 @@ def remove_net_torque(
     r_squared = torch.sum(r**2, dim=1)  # Shape: (N,)
 
     # Sum over nodes to aggregate r_squared for each graph
-    s = torch.zeros(n_nodes.size(0), device=positions.device)
-    start_idx = 0
-    for i, num_nodes in enumerate(n_nodes):
-        end_idx = start_idx + num_nodes
-        s[i] = torch.sum(r_squared[start_idx:end_idx])
-        start_idx = end_idx
+    s = segment_sum(r_squared, n_nodes)
 
     # Step 3: Compute matrix S per graph: sum_i outer(r_i, r_i)
     r_unsqueezed = r.unsqueeze(2)  # Shape: (N, 3, 1)
@@ -360,12 +290,7 @@ def remove_net_torque(
     outer_products = r_unsqueezed @ r_T_unsqueezed  # Shape: (N, 3, 3)
 
     # Aggregate outer products for each graph
-    S = torch.zeros(n_nodes.size(0), 3, 3, device=positions.device)
-    start_idx = 0
-    for i, num_nodes in enumerate(n_nodes):
-        end_idx = start_idx + num_nodes
-        S[i] = torch.sum(outer_products[start_idx:end_idx], dim=0)
-        start_idx = end_idx
+    S = segment_sum(outer_products, n_nodes)
 
     # Step 4: Compute M = S - sI
     Imat = (
@@ -0,0 +1,35 @@
+"""Module for per-graph reductions over the nodes or edges of a batch.
+
+A batched graph stores the nodes (and edges) of its graphs contiguously,
+so per-graph reductions are segment reductions with the segment lengths
+given by `g.batch_num_nodes()` or `g.batch_num_edges()`. These work on
+plain tensors without unbatching the graph.
+"""
+
+import torch
+
+
+def segment_ids(lengths: torch.Tensor):
+    """Get the segment index of every row, e.g. [2, 1] -> [0, 0, 1]."""
+    return torch.repeat_interleave(
+        torch.arange(len(lengths), device=lengths.device), lengths
+    )
+
+
+def segment_sum(x: torch.Tensor, lengths: torch.Tensor):
+    """Sum the rows of x per segment."""
+    out = torch.zeros(
+        (len(lengths),) + x.shape[1:], dtype=x.dtype, device=x.device
+    )
+    return out.index_add_(0, segment_ids(lengths).to(x.device), x)
+
+
+def segment_mean(x: torch.Tensor, lengths: torch.Tensor):
+    """Average the rows of x per segment, empty segments give zeros."""
+    counts = lengths.clamp(min=1).to(x.device, x.dtype)
+    return segment_sum(x, lengths) / counts.view((-1,) + (1,) * (x.dim() - 1))
+
+
+def segment_first(x: torch.Tensor, lengths: torch.Tensor):
+    """Get the first row of every segment, segments must not be empty."""
+    return x[torch.cumsum(lengths, 0) - lengths]
@@ -0,0 +1,97 @@
+"""Module to stream datasets from files without loading them in memory.
+
+The readers are generators of sample dicts that can be passed to
+`alignn.lmdb_dataset.get_torch_dataset`, which writes them to LMDB as
+they come. Samples are assigned to the train, val and test sets by
+hashing their ids with `hash_split`, so every split is known without
+holding the dataset.
+"""
+
+import csv
+import gzip
+import hashlib
+import json
+from jarvis.core.atoms import Atoms
+
+
+def read_structure(file_path="POSCAR", file_format="poscar"):
+    """Read a structure file as Atoms."""
+    if file_format == "poscar":
+        return Atoms.from_poscar(file_path)
+    elif file_format == "cif":
+        return Atoms.from_cif(file_path)
+    elif file_format == "xyz":
+        return Atoms.from_xyz(file_path, box_size=500)
+    elif file_format == "pdb":
+        # Note using 500 angstrom as box size
+        # Recommended install pytraj
+        # conda install -c ambermd pytraj
+        return Atoms.from_pdb(file_path, max_lat=500)
+    raise NotImplementedError("File format not implemented", file_format)
+
+
+def iter_json_lines(filename="id_prop.jsonl"):
+    """Iterate the samples of a JSON lines file, gzipped if .gz."""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_csv_rows(filename="id_prop.csv"):
+    """Iterate the rows of a CSV file."""
+    with open(filename, "r") as f:
+        for row in csv.reader(f):
+            yield row
+
+
+def hash_split(
+    id="",
+    split_seed=123,
+    train_ratio=None,
+    val_ratio=0.1,
+    test_ratio=0.1,
+):
+    """Assign a sample id to "train", "val" or "test".
+
+    The id is hashed with split_seed into [0, 1), so the split of a
+    sample does not depend on the rest of the dataset. Returns None
+    for samples left out when the ratios sum to less than 1.
+    """
+    if train_ratio is None:
+        train_ratio = 1 - val_ratio - test_ratio
+    if train_ratio + val_ratio + test_ratio > 1 + 1e-9:
+        raise ValueError(
+            "Check split ratios.", train_ratio, val_ratio, test_ratio
+        )
+    key = (str(split_seed) + ":" + str(id)).encode()
+    x = int.from_bytes(hashlib.sha256(key).digest()[:8], "big") / 2**64
+    if x < test_ratio:
+        return "test"
+    if x < test_ratio + val_ratio:
+        return "val"
+    if x < test_ratio + val_ratio + train_ratio:
+        return "train"
+    return None
+
+
+def split_filter(split="train", **split_kwargs):
+    """Get a predicate on sample ids selecting one split.
+
+    split_kwargs go to hash_split. Streams can test ids with it before
+    parsing a sample, so structures of other splits are not read.
+    """
+
+    def select(id=""):
+        return hash_split(id, **split_kwargs) == split
+
+    return select
+
+
+def split_stream(samples=[], split="train", id_tag="jid", **split_kwargs):
+    """Iterate the samples of one split, split_kwargs go to hash_split."""
+    select = split_filter(split, **split_kwargs)
+    for sample in samples:
+        if select(sample[id_tag]):
+            yield sample
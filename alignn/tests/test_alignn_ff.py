@@ -6,8 +6,40 @@ from alignn.ff.ff import (
     ForceField,
     get_figshare_model_ff,
 )
-from alignn.graphs import Graph, radius_graph_jarvis, radius_graph_old
+from alignn.graphs import (
+    Graph,
+    StructureDataset,
+    build_undirected_edgedata,
+    build_undirected_edge_arrays,
+    compact_graph,
+    compute_bond_cosines,
+    cutoff_extensions,
+    expand_graph,
+    get_attribute_lookup,
+    nearest_neighbor_edges,
+    nearest_neighbor_edge_arrays,
+    radius_graph,
+    radius_graph_jarvis,
+    radius_graph_old,
+    triplet_line_graph,
+    triplet_line_graphs,
+)
 from alignn.ff.ff import phonons, ase_phonon
+from alignn.lmdb_dataset import TorchLMDBDataset
+from alignn.benchmark_graphs import run_benchmark
+from alignn.models.alignn import EdgeGatedGraphConv
+from alignn.models.alignn_atomwise import (
+    ALIGNNAtomWise,
+    ALIGNNAtomWiseConfig,
+)
+from alignn.models.alignn_atomwise_torch import (
+    ALIGNNAtomWiseTorch,
+    graph_inputs,
+)
+from alignn.models.utils import (
+    edge_gated_graph_conv_index,
+    stack_linear,
+)
 from jarvis.core.atoms import ase_to_atoms
 from jarvis.db.figshare import get_jid_data
 from jarvis.core.atoms import Atoms
@@ -20,6 +52,11 @@ from alignn.ff.ff import (
 from jarvis.io.vasp.inputs import Poscar
 from alignn.ff.ff import get_figshare_model_prop, get_figshare_model_ff
 import os
+import numpy as np
+import torch
+from torch.nn import functional as F
+import dgl
+from ase import Atoms as AseAtoms
 
 # JVASP-25139
 pos = """Rb8
@@ -74,6 +111,313 @@ def test_graph_builder():
     g = radius_graph_old(atoms)
 
 
+def test_attribute_lookup():
+    lookup = StructureDataset._get_attribute_lookup("cgcnn")
+    lookup[:] = 0
+    assert get_attribute_lookup("cgcnn").abs().sum() > 0
+
+
+def test_radius_graph_cell_list():
+    atoms = Poscar.from_string(pos).atoms.make_supercell_matrix([2, 2, 2])
+    u, v, r, images = radius_graph(atoms, cutoff=5)
+    uc, vc, rc, imagesc = radius_graph(atoms, cutoff=5, use_cell_list=True)
+    assert torch.equal(u, uc)
+    assert torch.equal(v, vc)
+    assert torch.allclose(r, rc)
+    assert torch.equal(images, imagesc)
+
+
+def test_nearest_neighbor_edge_arrays():
+    atoms = Poscar.from_string(pos).atoms
+    for use_canonize in [True, False]:
+        edges, _ = nearest_neighbor_edges(
+            atoms=atoms, cutoff=8, max_neighbors=12, use_canonize=use_canonize
+        )
+        u, v, r, images = build_undirected_edgedata(atoms, edges)
+        src_ids, dst_ids, dst_images = nearest_neighbor_edge_arrays(
+            atoms=atoms, cutoff=8, max_neighbors=12, use_canonize=use_canonize
+        )
+        ua, va, ra, imagesa = build_undirected_edge_arrays(
+            atoms, src_ids, dst_ids, dst_images
+        )
+        assert torch.equal(u, ua)
+        assert torch.equal(v, va)
+        assert torch.allclose(r, ra)
+        assert torch.equal(images, imagesa)
+
+
+def test_cutoff_extension():
+    atoms = Poscar.from_string(pos).atoms
+    count = cutoff_extensions["radius_graph"]
+    # Si nearest neighbor is at 2.38 A: 1.0 + 3 * 0.5
+    u, v, r, images = radius_graph(atoms, cutoff=1.0, cutoff_extra=0.5)
+    ue, ve, re, imagese = radius_graph(atoms, cutoff=2.5)
+    assert cutoff_extensions["radius_graph"] == count + 1
+    assert torch.equal(u, ue)
+    assert torch.equal(v, ve)
+    edges, _ = nearest_neighbor_edges(atoms=atoms, cutoff=1.0)
+    edges_ref, _ = nearest_neighbor_edges(atoms=atoms, cutoff=8.0)
+    assert edges == edges_ref
+
+
+def test_triplet_line_graph():
+    atoms = Poscar.from_string(pos).atoms
+    g = Graph.atom_dgl_multigraph(atoms, compute_line_graph=False)
+    lg = triplet_line_graph(g)
+    ref = g.line_graph(shared=True)
+    ref.apply_edges(compute_bond_cosines)
+    assert torch.equal(lg.edges()[0].long(), ref.edges()[0])
+    assert torch.equal(lg.edges()[1].long(), ref.edges()[1])
+    assert torch.equal(lg.edata["h"], ref.edata["h"])
+    lg = triplet_line_graph(g, backtracking=False)
+    ref = g.line_graph(backtracking=False)
+    assert torch.equal(lg.edges()[0].long(), ref.edges()[0])
+    assert torch.equal(lg.edges()[1].long(), ref.edges()[1])
+
+
+def test_graph_builder_batch():
+    atoms = Poscar.from_string(pos).atoms
+    atoms_list = [atoms, atoms.make_supercell_matrix([1, 1, 2])]
+    for neighbor_strategy in ["k-nearest", "radius_graph"]:
+        g, lg = Graph.atom_dgl_multigraph_batch(
+            atoms_list, neighbor_strategy=neighbor_strategy
+        )
+        graphs = [
+            Graph.atom_dgl_multigraph(
+                atoms, neighbor_strategy=neighbor_strategy
+            )
+            for atoms in atoms_list
+        ]
+        bg = dgl.batch([i[0] for i in graphs])
+        blg = dgl.batch([i[1] for i in graphs])
+        assert torch.equal(g.edges()[0], bg.edges()[0])
+        assert torch.equal(g.edges()[1], bg.edges()[1])
+        assert torch.allclose(g.edata["r"], bg.edata["r"])
+        assert torch.equal(g.batch_num_nodes(), bg.batch_num_nodes())
+        assert torch.equal(lg.batch_num_nodes(), blg.batch_num_nodes())
+        assert torch.equal(lg.batch_num_edges(), blg.batch_num_edges())
+        assert torch.allclose(lg.edata["h"], blg.edata["h"])
+
+
+def test_compact_graph():
+    atoms = Poscar.from_string(pos).atoms
+    g = Graph.atom_dgl_multigraph(atoms, compute_line_graph=False)
+    for store_r in [True, False]:
+        record = compact_graph(
+            g,
+            atomic_numbers=atoms.atomic_numbers,
+            lattice_mat=atoms.lattice_mat,
+            graph_data={"stress": [[1.0, 0, 0], [0, 1.0, 0], [0, 0, 1.0]]},
+            store_r=store_r,
+        )
+        assert record["edata"]["images"].dtype == "int8"
+        assert ("r" in record["edata"]) == store_r
+        ge = expand_graph(record)
+        assert torch.equal(g.edges()[0], ge.edges()[0])
+        assert torch.equal(g.ndata["atom_features"], ge.ndata["atom_features"])
+        assert torch.equal(g.ndata["V"], ge.ndata["V"])
+        assert torch.equal(g.edata["images"], ge.edata["images"])
+        assert torch.allclose(g.edata["r"], ge.edata["r"], atol=1e-5)
+        assert ge.ndata["stress"].shape == (atoms.num_atoms, 3, 3)
+
+
+def test_benchmark_graphs():
+    results = run_benchmark(
+        sizes=[2], strategies=["k-nearest"], repeats=1, isolate=False
+    )
+    assert len(results) == 2
+    assert results[1]["line_graph_edges"] > 0
+    assert results[0]["edges_per_sec"] > 0
+
+
+def assert_same_bonds(g, ref):
+    bonds = []
+    for graph in [g, ref]:
+        u, v = graph.edges()
+        r = graph.edata["r"].double().numpy()
+        order = np.lexsort(np.column_stack([u, v, r]).T)
+        bonds.append((u[order], v[order], r[order]))
+    assert torch.equal(bonds[0][0], bonds[1][0])
+    assert torch.equal(bonds[0][1], bonds[1][1])
+    assert np.allclose(bonds[0][2], bonds[1][2], atol=1e-4)
+
+
+def test_verlet_skin():
+    config = {
+        "neighbor_strategy": "radius_graph",
+        "cutoff": 4.0,
+        "max_neighbors": 12,
+        "atom_features": "cgcnn",
+        "use_canonize": True,
+        "batch_size": 1,
+        "model": {
+            "name": "alignn_atomwise",
+            "atom_input_features": 92,
+            "alignn_layers": 1,
+            "gcn_layers": 1,
+            "hidden_features": 16,
+            "embedding_features": 16,
+            "stresswise_weight": 1.0,
+        },
+    }
+    model = ALIGNNAtomWise(ALIGNNAtomWiseConfig(**config["model"])).eval()
+    calcs = [
+        AlignnAtomwiseCalculator(model=model, config=config, skin=skin)
+        for skin in [None, 1.0]
+    ]
+    atoms = Poscar.from_string(pos).atoms.ase_converter()
+    rng = np.random.default_rng(0)
+    cell = np.array(atoms.cell)
+    for step in range(6):
+        atoms.positions += rng.normal(scale=0.05, size=(len(atoms), 3))
+        # strain the cell as NPT or a cell filter would
+        strain = np.eye(3) + rng.normal(scale=0.01, size=(3, 3))
+        atoms.set_cell(cell @ strain, scale_atoms=True)
+        if step == 3:
+            atoms.wrap()
+        graphs = [calc.get_graph(atoms)[0] for calc in calcs]
+        assert_same_bonds(*graphs)
+        results = []
+        for calc in calcs:
+            calc.calculate(atoms)
+            results.append(calc.results)
+        for key in ["energy", "forces", "stress"]:
+            assert np.allclose(
+                results[0][key], results[1][key], rtol=1e-4, atol=1e-5
+            )
+    # the list was reused across the cell changes
+    assert calcs[1].neighbor_cache["graph"].num_edges() > graphs[1].num_edges()
+
+
+def test_verlet_skin_sparse():
+    # no atom has a neighbor within cutoff, fresh builds extend it
+    config = {
+        "neighbor_strategy": "radius_graph",
+        "cutoff": 4.0,
+        "max_neighbors": 12,
+        "atom_features": "cgcnn",
+        "use_canonize": True,
+        "model": {"name": "alignn_atomwise"},
+    }
+    model = ALIGNNAtomWise(ALIGNNAtomWiseConfig(**config["model"]))
+    calc = AlignnAtomwiseCalculator(model=model, config=config, skin=1.0)
+    atoms = AseAtoms(
+        "Ar2", positions=[[0, 0, 0], [4.5, 0.5, 0.2]], cell=9 * np.eye(3)
+    )
+    rng = np.random.default_rng(0)
+    for step in range(4):
+        atoms.positions += rng.normal(scale=0.05, size=(len(atoms), 3))
+        g = calc.get_graph(atoms)[0]
+        ref = Graph.atom_dgl_multigraph(
+            ase_to_atoms(atoms),
+            neighbor_strategy="radius_graph",
+            cutoff=4.0,
+            max_neighbors=12,
+            atom_features="cgcnn",
+            compute_line_graph=False,
+        )
+        assert g.num_edges() > 0
+        assert_same_bonds(g, ref)
+        if step == 0:
+            cache = calc.neighbor_cache
+    # the list was reused with the extended cutoff
+    assert calc.neighbor_cache is cache
+
+
+def test_triplet_line_graphs():
+    atoms = Poscar.from_string(pos).atoms
+    graphs = [
+        Graph.atom_dgl_multigraph(
+            atoms.make_supercell_matrix([1, 1, i]), compute_line_graph=False
+        )
+        for i in [1, 2, 1]
+    ]
+    for g, lgb in zip(graphs, triplet_line_graphs(graphs, chunk_size=2)):
+        lg = triplet_line_graph(g)
+        assert torch.equal(lg.edges()[0], lgb.edges()[0])
+        assert torch.equal(lg.edges()[1], lgb.edges()[1])
+        assert torch.equal(lg.edata["h"], lgb.edata["h"])
+        assert lgb.ndata["r"] is g.edata["r"]
+
+
+def test_edge_gated_graph_conv():
+    atoms = Poscar.from_string(pos).atoms
+    g, lg = Graph.atom_dgl_multigraph(atoms)
+    conv = EdgeGatedGraphConv(16, 16).eval()
+    x = torch.randn(lg.num_nodes(), 16)
+    y = torch.randn(lg.num_edges(), 16)
+    xb, yb = conv(lg, x, y)
+    # reference with dgl message passing
+    lg.ndata["e_src"] = conv.src_gate(x)
+    lg.ndata["e_dst"] = conv.dst_gate(x)
+    lg.apply_edges(dgl.function.u_add_v("e_src", "e_dst", "e_nodes"))
+    m = lg.edata.pop("e_nodes") + conv.edge_gate(y)
+    lg.edata["sigma"] = torch.sigmoid(m)
+    lg.ndata["Bh"] = conv.dst_update(x)
+    lg.update_all(
+        dgl.function.u_mul_e("Bh", "sigma", "m"),
+        dgl.function.sum("m", "sum_sigma_h"),
+    )
+    lg.update_all(
+        dgl.function.copy_e("sigma", "m"), dgl.function.sum("m", "sum_sigma")
+    )
+    h = lg.ndata["sum_sigma_h"] / (lg.ndata["sum_sigma"] + 1e-6)
+    x_ref = conv.src_update(x) + h
+    assert torch.allclose(x + F.silu(conv.bn_nodes(x_ref)), xb, atol=1e-5)
+    assert torch.allclose(y + F.silu(conv.bn_edges(m)), yb, atol=1e-5)
+    # edge index variant, scripted
+    src, dst = lg.edges()
+    x_index, m_index = torch.jit.script(edge_gated_graph_conv_index)(
+        src,
+        dst,
+        x,
+        y,
+        *stack_linear(
+            [conv.src_gate, conv.dst_gate, conv.dst_update, conv.src_update]
+        ),
+        conv.edge_gate.weight,
+        conv.edge_gate.bias,
+    )
+    assert torch.allclose(x_index, x_ref, atol=1e-5)
+    assert torch.allclose(m_index, m, atol=1e-5)
+
+
+def test_alignn_atomwise_torch():
+    atoms = Poscar.from_string(pos).atoms
+    samples = []
+    for atoms in [atoms, atoms.make_supercell_matrix([1, 1, 2])]:
+        g, lg = Graph.atom_dgl_multigraph(atoms)
+        lat = torch.tensor(atoms.lattice_mat).float()
+        samples.append((g, lg, lat, torch.tensor(0.0)))
+    g, lg, lat, _ = TorchLMDBDataset.collate_line_graph(samples)
+    config = ALIGNNAtomWiseConfig(
+        name="alignn_atomwise",
+        atom_input_features=92,
+        stresswise_weight=1.0,
+        use_cutoff_function=True,
+    )
+    model = ALIGNNAtomWise(config).eval()
+    torch_model = ALIGNNAtomWiseTorch(config).eval()
+    torch_model.load_state_dict(model.state_dict())
+    result = model([g, lg, lat])
+    for m in [torch_model, torch.jit.script(torch_model)]:
+        torch_result = m(**graph_inputs(g, lg))
+        for key in ["out", "grad", "stresses"]:
+            assert torch.allclose(
+                result[key], torch_result[key], rtol=1e-4, atol=1e-5
+            )
+    # unsupported options fail before any weights are loaded
+    config = {"model": {"name": "alignn_atomwise", "extra_features": 2}}
+    try:
+        AlignnAtomwiseCalculator(
+            config=config, path="missing", backend="torch"
+        )
+    except ValueError as exp:
+        assert "extra_features" in exp.args[0]
+    else:
+        assert False
+
+
 def test_ev():
     atoms = Poscar.from_string(pos).atoms
     model_path = get_figshare_model_ff(
@@ -0,0 +1,13 @@
+import numpy as np
+from alignn.data import BucketBatchSampler
+
+
+def test_bucket_batch_sampler():
+    sizes = np.random.default_rng(0).integers(1, 200, 1000)
+    sampler = BucketBatchSampler(sizes, budget=2000)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(sum(batches, [])) == list(range(1000))
+    loads = [sizes[i].sum() for i in batches]
+    assert max(loads) - min(loads) < sizes.max()
+    assert batches != list(sampler)
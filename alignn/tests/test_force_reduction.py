@@ -9,6 +9,7 @@ import dgl.function as fn
 from dgl.nn import SumPooling
 
 from alignn.models.alignn import EdgeGatedGraphConv
+from alignn.models.utils import compute_batch_stress, reduce_pair_forces
 
 # double precision for gradient checking
 torch.set_default_dtype(torch.float64)
@@ -269,3 +270,66 @@ def test_compare_forces_finite_difference():
 
     # reset floating point precision for other test suites
     torch.set_default_dtype(default_dtype)
+
+
+def test_reduce_pair_forces():
+    """Check fused force reduction against reversed graph reduction."""
+    positions = torch.from_numpy(at.cart_coords)
+    g = dgl.batch(
+        [dgl.radius_graph(positions, 5), dgl.radius_graph(positions, 4)]
+    )
+    pair_forces = torch.randn(
+        g.num_edges(), 3, dtype=torch.float64, requires_grad=True
+    )
+
+    g.edata["pair_forces"] = pair_forces
+    g.update_all(fn.copy_e("pair_forces", "m"), fn.sum("m", "forces_ji"))
+    rg = dgl.reverse(g, copy_edata=True)
+    rg.update_all(fn.copy_e("pair_forces", "m"), fn.sum("m", "forces_ij"))
+    forces = g.ndata["forces_ji"] - rg.ndata["forces_ij"]
+
+    fused = reduce_pair_forces(g, pair_forces)
+    assert torch.allclose(forces, fused)
+    assert torch.allclose(
+        g.ndata["forces_ji"],
+        reduce_pair_forces(g, pair_forces, add_reverse_forces=False),
+    )
+
+    # gradients of a force loss match too
+    w = torch.randn_like(forces)
+    (grad,) = torch.autograd.grad((forces * w).sum(), pair_forces)
+    (fused_grad,) = torch.autograd.grad((fused * w).sum(), pair_forces)
+    assert torch.allclose(grad, fused_grad)
+
+
+def test_compute_batch_stress():
+    """Check batched virial stress against a loop over the graphs."""
+    positions = torch.from_numpy(at.cart_coords)
+    graphs = []
+    for n, cutoff, volume in [(len(positions), 5, 1000.0), (6, 4, 250.0)]:
+        g = dgl.radius_graph(positions[:n], cutoff)
+        g.ndata["V"] = torch.full(
+            (g.num_nodes(),), volume, dtype=torch.float64
+        )
+        graphs.append(g)
+    g = dgl.batch(graphs + graphs[:1])
+    r = torch.randn(g.num_edges(), 3, dtype=torch.float64)
+    pair_forces = torch.randn(g.num_edges(), 3, dtype=torch.float64)
+
+    stresses = []
+    count_edge = 0
+    count_node = 0
+    for graph_id in range(g.batch_size):
+        end = count_edge + g.batch_num_edges()[graph_id]
+        st = -1 * (
+            160.21766208
+            * torch.matmul(r[count_edge:end].T, pair_forces[count_edge:end])
+            / g.ndata["V"][count_node]
+        )
+        count_edge = end
+        count_node = count_node + g.batch_num_nodes()[graph_id]
+        stresses.append(st)
+
+    assert torch.allclose(
+        torch.stack(stresses), compute_batch_stress(g, r, pair_forces)
+    )
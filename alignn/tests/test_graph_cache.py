@@ -0,0 +1,47 @@
+import torch
+from jarvis.io.vasp.inputs import Poscar
+from alignn.graphs import Graph
+from alignn.graph_cache import GraphCache, structure_hash
+
+pos = """System
+1.0
+5.49363 0.0 0.0
+-0.0 5.49363 0.0
+0.0 0.0 5.49363
+Si
+8
+direct
+0.25 0.75 0.25 Si
+0.0 0.0 0.5 Si
+0.25 0.25 0.75 Si
+0.0 0.5 0.0 Si
+0.75 0.75 0.75 Si
+0.5 0.0 0.0 Si
+0.75 0.25 0.25 Si
+0.5 0.5 0.5 Si
+"""
+
+
+def test_graph_cache(tmp_path):
+    atoms = Poscar.from_string(pos).atoms
+    cache = GraphCache(str(tmp_path))
+    g, lg = cache.get_graph(atoms, cutoff=6.0)
+    gc, lgc = cache.get_graph(atoms, cutoff=6.0)
+    ref, ref_lg = Graph.atom_dgl_multigraph(atoms, cutoff=6.0)
+    assert len(cache.files()) == 1
+    assert torch.equal(gc.edata["r"], ref.edata["r"])
+    assert torch.equal(lgc.edata["h"], ref_lg.edata["h"])
+    cache.get_graph(atoms, cutoff=5.0)
+    assert len(cache.files()) == 2
+    # graphs built with another default dtype get other keys
+    key = structure_hash(atoms, cutoff=6.0)
+    default_dtype = torch.get_default_dtype()
+    other = torch.float32 if default_dtype == torch.float64 else torch.float64
+    torch.set_default_dtype(other)
+    try:
+        assert structure_hash(atoms, cutoff=6.0) != key
+    finally:
+        torch.set_default_dtype(default_dtype)
+    cache.max_size = 1
+    cache.evict()
+    assert len(cache.files()) == 0
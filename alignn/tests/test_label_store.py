@@ -0,0 +1,62 @@
+import os
+import numpy as np
+from jarvis.io.vasp.inputs import Poscar
+from alignn.lmdb_dataset import deserialize_graphs, get_torch_dataset
+
+pos = """System
+1.0
+5.49363 0.0 0.0
+-0.0 5.49363 0.0
+0.0 0.0 5.49363
+Si
+8
+direct
+0.25 0.75 0.25 Si
+0.0 0.0 0.5 Si
+0.25 0.25 0.75 Si
+0.0 0.5 0.0 Si
+0.75 0.75 0.75 Si
+0.5 0.0 0.0 Si
+0.75 0.25 0.25 Si
+0.5 0.5 0.5 Si
+"""
+
+
+def test_label_store(tmp_path):
+    atoms = Poscar.from_string(pos).atoms
+    rng = np.random.default_rng(0)
+    dataset = [
+        {
+            "jid": str(i),
+            "atoms": atoms.make_supercell_matrix([1, 1, 1 + i % 2]).to_dict(),
+            "target": float(i),
+            "t2": [float(i), -float(i)],
+            "forces": rng.random((atoms.num_atoms * (1 + i % 2), 3)),
+            "stresses": rng.random((3, 3)),
+        }
+        for i in range(6)
+    ]
+    kwargs = dict(
+        target_grad="forces",
+        target_stress="stresses",
+        output_dir=str(tmp_path),
+        tmp_name=str(tmp_path / "data"),
+        label_store=True,
+    )
+    lmdb_dataset = get_torch_dataset(
+        dataset=dataset, target="target", **kwargs
+    )
+    samples = lmdb_dataset.__getitems__([3, 0])
+    for idx, (g, lg, lattice, label) in zip([3, 0], samples):
+        assert float(label) == dataset[idx]["target"]
+        assert np.allclose(g.ndata["forces"], dataset[idx]["forces"])
+        assert g.ndata["stresses"].shape == (g.num_nodes(), 3, 3)
+        assert np.allclose(g.ndata["stresses"][-1], dataset[idx]["stresses"])
+    with lmdb_dataset.env.begin() as txn:
+        assert deserialize_graphs(txn.get(b"0"))[-1] is None
+    lmdb_dataset.close()
+    mtime = os.path.getmtime(tmp_path / "data" / "data.mdb")
+    lmdb_dataset = get_torch_dataset(dataset=dataset, target="t2", **kwargs)
+    assert os.path.getmtime(tmp_path / "data" / "data.mdb") == mtime
+    assert lmdb_dataset[5][-1].tolist() == [5.0, -5.0]
+    lmdb_dataset.close()
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import torch
+from jarvis.io.vasp.inputs import Poscar
+from alignn.graphs import Graph
+from alignn.lmdb_dataset import (
+    TorchLMDBDataset,
+    decode_header,
+    decode_record,
+    deserialize_graphs,
+    get_torch_dataset,
+    record_sizes,
+    serialize_graphs,
+)
+
+pos = """System
+1.0
+5.49363 0.0 0.0
+-0.0 5.49363 0.0
+0.0 0.0 5.49363
+Si
+8
+direct
+0.25 0.75 0.25 Si
+0.0 0.0 0.5 Si
+0.25 0.25 0.75 Si
+0.0 0.5 0.0 Si
+0.75 0.75 0.75 Si
+0.5 0.0 0.0 Si
+0.75 0.25 0.25 Si
+0.5 0.5 0.5 Si
+"""
+
+
+def test_binary_record():
+    atoms = Poscar.from_string(pos).atoms
+    g, lg = Graph.atom_dgl_multigraph(atoms)
+    lattice = torch.tensor(atoms.lattice_mat).float()
+    buf = serialize_graphs(g, lg, lattice, torch.tensor(1.0))
+    gd, lgd, latticed, label = deserialize_graphs(buf)
+    assert torch.equal(g.edges()[1], gd.edges()[1])
+    assert torch.equal(g.ndata["atom_features"], gd.ndata["atom_features"])
+    assert torch.equal(g.edata["r"], gd.edata["r"])
+    assert torch.equal(lg.edges()[0], lgd.edges()[0])
+    assert torch.equal(lg.edata["h"], lgd.edata["h"])
+    assert torch.equal(lattice, latticed)
+    assert float(label) == 1.0
+    # graph sizes are read from the header
+    sizes = (g.num_nodes(), g.num_edges(), lg.num_edges())
+    assert tuple(decode_header(buf)[0]["meta"]["sizes"]) == sizes
+    assert record_sizes(serialize_graphs(g, None, lattice)) == sizes
+    # arrays are views into the buffer, graphs own copies
+    buf = bytearray(buf)
+    arrays, meta = decode_record(memoryview(buf))
+    assert np.shares_memory(arrays["g/edata/r"], np.frombuffer(buf, np.uint8))
+    gd = deserialize_graphs(memoryview(buf))[0]
+    buf[:] = bytes(len(buf))
+    assert torch.equal(g.edata["r"], gd.edata["r"])
+
+
+def test_collate_line_graph():
+    atoms = Poscar.from_string(pos).atoms
+    atoms_list = [atoms, atoms.make_supercell_matrix([1, 1, 2])]
+    samples = []
+    for atoms in atoms_list:
+        g, lg = Graph.atom_dgl_multigraph(atoms)
+        samples.append((g, lg, torch.eye(3), torch.tensor(1.0)))
+    g, lg, _, _ = TorchLMDBDataset.collate_line_graph(samples)
+    gb, lgb, _, _ = TorchLMDBDataset.collate_line_graph(
+        [(i[0], None, i[2], i[3]) for i in samples]
+    )
+    assert torch.equal(lg.edges()[0], lgb.edges()[0])
+    assert torch.equal(lg.edges()[1], lgb.edges()[1])
+    assert torch.equal(lg.edata["h"], lgb.edata["h"])
+    assert torch.equal(lg.batch_num_nodes(), lgb.batch_num_nodes())
+    assert torch.equal(lg.batch_num_edges(), lgb.batch_num_edges())
+
+
+def test_lmdb_batched_reads(tmp_path):
+    atoms = Poscar.from_string(pos).atoms
+    dataset = [
+        {"jid": str(i), "atoms": atoms.to_dict(), "target": float(i)}
+        for i in range(12)
+    ]
+    lmdb_dataset = get_torch_dataset(
+        dataset=dataset,
+        target="target",
+        output_dir=str(tmp_path),
+        tmp_name=str(tmp_path / "data"),
+    )
+    idxs = [11, 2, 10, 2]
+    samples = lmdb_dataset.__getitems__(idxs)
+    for idx, sample in zip(idxs, samples):
+        assert float(sample[-1]) == float(idx)
+        assert torch.equal(
+            sample[0].edata["r"], lmdb_dataset[idx][0].edata["r"]
+        )
+    lmdb_dataset.close()
+    # without graph_params.json the LMDB is incomplete and rebuilt
+    os.remove(str(tmp_path / "data" / "graph_params.json"))
+    rebuilt = get_torch_dataset(
+        dataset=dataset[:4],
+        target="target",
+        output_dir=str(tmp_path),
+        tmp_name=str(tmp_path / "data"),
+    )
+    assert len(rebuilt) == 4
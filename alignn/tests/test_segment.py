@@ -0,0 +1,58 @@
+import torch
+import dgl
+from jarvis.io.vasp.inputs import Poscar
+from alignn.graphs import Graph
+from alignn.models.utils import lightweight_line_graph
+from alignn.segment import segment_first, segment_mean, segment_sum
+
+pos = """System
+1.0
+5.49363 0.0 0.0
+-0.0 5.49363 0.0
+0.0 0.0 5.49363
+Si
+8
+direct
+0.25 0.75 0.25 Si
+0.0 0.0 0.5 Si
+0.25 0.25 0.75 Si
+0.0 0.5 0.0 Si
+0.75 0.75 0.75 Si
+0.5 0.0 0.0 Si
+0.75 0.25 0.25 Si
+0.5 0.5 0.5 Si
+"""
+
+
+def test_segment_ops():
+    atoms = Poscar.from_string(pos).atoms
+    graphs = [
+        Graph.atom_dgl_multigraph(
+            atoms.make_supercell_matrix([1, 1, i]), compute_line_graph=False
+        )
+        for i in [1, 2, 1]
+    ]
+    g = dgl.batch(graphs)
+    num_nodes = g.batch_num_nodes()
+    x = g.ndata["frac_coords"]
+    assert torch.allclose(
+        segment_sum(x, num_nodes),
+        torch.stack([i.ndata["frac_coords"].sum(0) for i in graphs]),
+    )
+    assert torch.allclose(
+        segment_mean(x, num_nodes),
+        torch.stack([i.ndata["frac_coords"].mean(0) for i in graphs]),
+    )
+    assert torch.equal(
+        segment_first(x, num_nodes),
+        torch.stack([i.ndata["frac_coords"][0] for i in graphs]),
+    )
+    g.edata["d"] = torch.norm(g.edata["r"], dim=1)
+    cutoff = g.edata["d"].median()
+    lg = lightweight_line_graph(g, "d", lambda d: torch.ge(d, cutoff))
+    for gg, lgb in zip(graphs, dgl.unbatch(lg)):
+        gg.edata["d"] = torch.norm(gg.edata["r"], dim=1)
+        ref = lightweight_line_graph(gg, "d", lambda d: torch.ge(d, cutoff))
+        assert torch.equal(ref.edges()[0], lgb.edges()[0])
+        assert torch.equal(ref.edata["edge_ids"], lgb.edata["edge_ids"])
+    assert 0 < lg.num_edges() < g.num_edges()
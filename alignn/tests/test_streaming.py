@@ -0,0 +1,76 @@
+import json
+from jarvis.io.vasp.inputs import Poscar
+from alignn.data import get_train_val_loaders
+from alignn.lmdb_dataset import get_torch_dataset
+from alignn.streaming import hash_split, iter_json_lines, split_stream
+
+pos = """System
+1.0
+5.49363 0.0 0.0
+-0.0 5.49363 0.0
+0.0 0.0 5.49363
+Si
+8
+direct
+0.25 0.75 0.25 Si
+0.0 0.0 0.5 Si
+0.25 0.25 0.75 Si
+0.0 0.5 0.0 Si
+0.75 0.75 0.75 Si
+0.5 0.0 0.0 Si
+0.75 0.25 0.25 Si
+0.5 0.5 0.5 Si
+"""
+
+
+def test_streaming(tmp_path):
+    atoms = Poscar.from_string(pos).atoms
+    filename = str(tmp_path / "id_prop.jsonl")
+    with open(filename, "w") as f:
+        for i in range(20):
+            sample = {"jid": str(i), "atoms": atoms.to_dict(), "target": i}
+            f.write(json.dumps(sample) + "\n")
+    splits = [hash_split(str(i)) for i in range(1000)]
+    assert splits == [hash_split(str(i)) for i in range(1000)]
+    assert 700 < splits.count("train") < 900
+    lmdb_dataset = get_torch_dataset(
+        dataset=split_stream(iter_json_lines(filename), split="train"),
+        target="target",
+        output_dir=str(tmp_path),
+        tmp_name=str(tmp_path / "data"),
+        write_batch_size=4,
+    )
+    ids = [str(i) for i in range(20) if splits[i] == "train"]
+    assert lmdb_dataset.ids == ids
+    assert float(lmdb_dataset[1][-1]) == float(ids[1])
+    lmdb_dataset.close()
+    reread = get_torch_dataset(
+        dataset=iter([]),
+        target="target",
+        output_dir=str(tmp_path),
+        tmp_name=str(tmp_path / "data"),
+    )
+    assert reread.ids == ids
+
+    # each split pass only parses the samples of its split
+    parsed = []
+
+    def dataset_stream(select):
+        for i in range(20):
+            if select(str(i)):
+                parsed.append(i)
+                sample = {"jid": str(i), "atoms": atoms.to_dict()}
+                yield dict(sample, target=float(i))
+
+    train_loader, val_loader, test_loader, _ = get_train_val_loaders(
+        dataset_stream=dataset_stream,
+        target="target",
+        batch_size=2,
+        line_graph=True,
+        use_lmdb=True,
+        output_dir=str(tmp_path / "stream"),
+        filename=str(tmp_path / "stream"),
+        pin_memory=False,
+    )
+    assert sorted(parsed) == list(range(20))
+    assert len(train_loader.dataset) == len(ids)
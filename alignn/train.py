@@ -11,6 +11,7 @@ import numpy as np
 from torch import nn
 from alignn.data import get_train_val_loaders
 from alignn.config import TrainingConfig
+from alignn.segment import segment_first
 from alignn.models.alignn_atomwise import ALIGNNAtomWise
 from alignn.models.ealignn_atomwise import eALIGNNAtomWise
 from alignn.models.alignn import ALIGNN
@@ -29,7 +30,6 @@ from alignn.utils import (
     setup_optimizer,
     print_train_val_loss,
 )
-import dgl
 
 # from sklearn.metrics import log_loss
 
@@ -46,6 +46,11 @@ figlet_alignn = """
 """
 
 
+def graph_labels(g, key=""):
+    """Get per-graph labels of a batch, stored on every node of a graph."""
+    return segment_first(g.ndata[key], g.batch_num_nodes())
+
+
 def train_dgl(
     config: Union[TrainingConfig, Dict[str, Any]],
     model: nn.Module = None,
@@ -143,6 +148,17 @@ def train_dgl(
             keep_data_order=config.keep_data_order,
             output_dir=config.output_dir,
             use_lmdb=config.use_lmdb,
+            compact_graphs=config.compact_graphs,
+            store_r=config.store_r,
+            store_line_graph=config.store_line_graph,
+            lmdb_readahead=config.lmdb_readahead,
+            lmdb_max_readers=config.lmdb_max_readers,
+            batch_budget=config.batch_budget,
+            batch_budget_key=config.batch_budget_key,
+            preprocess_workers=config.preprocess_workers,
+            label_store=config.label_store,
+            graph_cache_dir=config.graph_cache_dir,
+            graph_cache_size=config.graph_cache_size,
             dtype=config.dtype,
         )
     else:
@@ -333,14 +349,7 @@ def train_dgl(
                     )
                     running_loss3 += loss3.item()
                 if config.model.stresswise_weight != 0:
-                    # print('unbatch',dgl.unbatch(dats[0]))
-
-                    targ_stress = torch.stack(
-                        [
-                            gg.ndata["stresses"][0]
-                            for gg in dgl.unbatch(dats[0])
-                        ]
-                    ).to(device)
+                    targ_stress = graph_labels(dats[0], "stresses").to(device)
                     pred_stress = result["stresses"]
                     # print('targ_stress',targ_stress,targ_stress.shape)
                     # print('pred_stress',pred_stress,pred_stress.shape)
@@ -359,13 +368,9 @@ def train_dgl(
                     )
                     running_loss4 += loss4.item()
                 if config.model.additional_output_weight != 0:
-                    # print('unbatch',dgl.unbatch(dats[0]))
-                    additional_dat = [
-                        gg.ndata["additional"][0]
-                        for gg in dgl.unbatch(dats[0])
-                    ]
+                    additional_dat = graph_labels(dats[0], "additional")
                     # print('additional_dat',additional_dat,len(additional_dat))
-                    targ = torch.stack(additional_dat).to(device)
+                    targ = additional_dat.to(device)
                     # targ=torch.tensor(additional_dat).to( dats[0].device)
                     # print('result["additional"]',result["additional"],result["additional"].shape)
                     # print('targ',targ,targ.shape)
@@ -494,12 +499,7 @@ def train_dgl(
                     #    dats[0].ndata["stresses"][0].to(device),
                     # )
 
-                    targ_stress = torch.stack(
-                        [
-                            gg.ndata["stresses"][0]
-                            for gg in dgl.unbatch(dats[0])
-                        ]
-                    ).to(device)
+                    targ_stress = graph_labels(dats[0], "stresses").to(device)
                     pred_stress = result["stresses"]
                     # print('targ_stress',targ_stress,targ_stress.shape)
                     # print('pred_stress',pred_stress,pred_stress.shape)
@@ -519,12 +519,9 @@ def train_dgl(
 
                     val_loss4 += loss4.item()
                 if config.model.additional_output_weight != 0:
-                    additional_dat = [
-                        gg.ndata["additional"][0]
-                        for gg in dgl.unbatch(dats[0])
-                    ]
+                    additional_dat = graph_labels(dats[0], "additional")
                     # print('additional_dat',additional_dat,len(additional_dat))
-                    targ = torch.stack(additional_dat).to(device)
+                    targ = additional_dat.to(device)
                     # targ=torch.tensor(additional_dat).to( dats[0].device)
                     # print('result["additional"]',result["additional"],result["additional"].shape)
                     # print('targ',targ,targ.shape)
@@ -676,12 +673,7 @@ def train_dgl(
                     )
                 if config.model.stresswise_weight != 0:
 
-                    targ_stress = torch.stack(
-                        [
-                            gg.ndata["stresses"][0]
-                            for gg in dgl.unbatch(dats[0])
-                        ]
-                    ).to(device)
+                    targ_stress = graph_labels(dats[0], "stresses").to(device)
                     pred_stress = result["stresses"]
                     # print('targ_stress',targ_stress,targ_stress.shape)
                     # print('pred_stress',pred_stress,pred_stress.shape)
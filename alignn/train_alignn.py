@@ -3,7 +3,6 @@
 """Module to train for a folder with formatted dataset."""
 import os
 import torch.distributed as dist
-import csv
 import sys
 import json
 import zipfile
@@ -11,11 +10,11 @@ from alignn.data import get_train_val_loaders
 from alignn.train import train_dgl
 from alignn.config import TrainingConfig
 from jarvis.db.jsonutils import loadjson
+from alignn.streaming import iter_csv_rows, iter_json_lines, read_structure
 import argparse
 from alignn.models.alignn_atomwise import ALIGNNAtomWise, ALIGNNAtomWiseConfig
 import torch
 import time
-from jarvis.core.atoms import Atoms
 import random
 from ase.stress import voigt_6_to_full_3x3_stress
 
@@ -166,24 +165,49 @@ def train_for_folder(
     print("root_dir", root_dir)
     id_prop_json = os.path.join(root_dir, "id_prop.json")
     id_prop_json_zip = os.path.join(root_dir, "id_prop.json.zip")
+    id_prop_jsonl = os.path.join(root_dir, "id_prop.jsonl")
     id_prop_csv = os.path.join(root_dir, "id_prop.csv")
     id_prop_csv_file = False
     multioutput = False
     # lists_length_equal = True
-    if os.path.exists(id_prop_json_zip):
-        dat = json.loads(
-            zipfile.ZipFile(id_prop_json_zip).read("id_prop.json")
-        )
-    elif os.path.exists(id_prop_json):
-        dat = loadjson(os.path.join(root_dir, "id_prop.json"))
-    elif os.path.exists(id_prop_csv):
+    if os.path.exists(id_prop_csv) and not (
+        os.path.exists(id_prop_json_zip)
+        or os.path.exists(id_prop_jsonl)
+        or os.path.exists(id_prop_json)
+    ):
         id_prop_csv_file = True
-        with open(id_prop_csv, "r") as f:
-            reader = csv.reader(f)
-            dat = [row for row in reader]
         print("id_prop_csv_file exists", id_prop_csv_file)
-    else:
-        print("Check dataset file.")
+
+    json_dat = []
+
+    def load_json_dat(load):
+        """Parse the JSON array once, keep it for the later passes."""
+        if not json_dat:
+            json_dat.extend(load())
+        return json_dat
+
+    def iter_dat():
+        """Iterate the raw samples in root_dir.
+
+        id_prop.jsonl and id_prop.csv are read one sample at a time. The
+        JSON array in id_prop.json(.zip) is parsed once and kept in
+        memory.
+        """
+        if os.path.exists(id_prop_json_zip):
+            yield from load_json_dat(
+                lambda: json.loads(
+                    zipfile.ZipFile(id_prop_json_zip).read("id_prop.json")
+                )
+            )
+        elif os.path.exists(id_prop_jsonl):
+            yield from iter_json_lines(id_prop_jsonl)
+        elif os.path.exists(id_prop_json):
+            yield from load_json_dat(lambda: loadjson(id_prop_json))
+        elif id_prop_csv_file:
+            yield from iter_csv_rows(id_prop_csv)
+        else:
+            raise ValueError("Check dataset file.", root_dir)
+
     config_dict = loadjson(config_name)
     config = TrainingConfig(**config_dict)
     if type(config) is dict:
@@ -245,50 +269,40 @@ def train_for_folder(
     target_grad = None  # "atomwise_grad"
     target_stress = None  # "stresses"
     target_additional_output = None  # "stresses"
+    if train_atom:
+        target_atomwise = "atomwise_target"
+    if train_grad:
+        target_grad = "atomwise_grad"
+    if train_stress:
+        target_stress = "stresses"
+    if train_additional_output:
+        target_additional_output = "additional"
+
+    def get_target(i):
+        """Get the target of a raw sample."""
+        if id_prop_csv_file:
+            tmp = [float(j) for j in i[1:]]  # float(i[1])
+            if len(tmp) == 1:
+                tmp = tmp[0]
+            return tmp
+        return i[target_key]
 
-    # mem = []
-    # enp = []
-    n_outputs = []
-    dataset = []
-    for i in dat:
+    def get_info(i):
+        """Convert a raw sample to a dataset entry."""
         info = {}
+        info["target"] = get_target(i)
         if id_prop_csv_file:
             file_name = i[0]
-            tmp = [float(j) for j in i[1:]]  # float(i[1])
             info["jid"] = file_name
-
-            if len(tmp) == 1:
-                tmp = tmp[0]
-            else:
-                multioutput = True
-                n_outputs.append(tmp)
-            info["target"] = tmp
             file_path = os.path.join(root_dir, file_name)
-            if file_format == "poscar":
-                atoms = Atoms.from_poscar(file_path)
-            elif file_format == "cif":
-                atoms = Atoms.from_cif(file_path)
-            elif file_format == "xyz":
-                atoms = Atoms.from_xyz(file_path, box_size=500)
-            elif file_format == "pdb":
-                # Note using 500 angstrom as box size
-                # Recommended install pytraj
-                # conda install -c ambermd pytraj
-                atoms = Atoms.from_pdb(file_path, max_lat=500)
-            else:
-                raise NotImplementedError(
-                    "File format not implemented", file_format
-                )
+            atoms = read_structure(file_path, file_format)
             info["atoms"] = atoms.to_dict()
         else:
-            info["target"] = i[target_key]
             info["atoms"] = i["atoms"]
             info["jid"] = i[id_key]
         if train_atom:
-            target_atomwise = "atomwise_target"
             info["atomwise_target"] = i[atomwise_key]  # such as charges
         if train_grad:
-            target_grad = "atomwise_grad"
             info["atomwise_grad"] = i[gradwise_key]  # - mean_force
         if train_stress:
             if len(i[stresswise_key]) == 6:
@@ -297,17 +311,41 @@ def train_for_folder(
             else:
                 stress = i[stresswise_key]
             info["stresses"] = stress  # - mean_force
-            target_stress = "stresses"
 
         if train_additional_output:
-            target_additional_output = "additional"
             info["additional"] = i[additional_output_key]  # - mean_force
         if "extra_features" in i:
             info["extra_features"] = i["extra_features"]
-        dataset.append(info)
-    print("len dataset", len(dataset))
+        return info
+
+    def iter_dataset(select=None):
+        """Iterate the dataset entries, reading one sample at a time.
+
+        Only samples whose id passes select(id) are converted, so their
+        structure files are the only ones read.
+        """
+        for i in iter_dat():
+            sample_id = i[0] if id_prop_csv_file else i[id_key]
+            if select is None or select(sample_id):
+                yield get_info(i)
+
+    # mem = []
+    # enp = []
+    if config.stream_data:
+        # the LMDB datasets are written straight from iter_dataset
+        dataset = None
+        # one pass over the targets only, no structures are read
+        targets = [get_target(i) for i in iter_dat()]
+        if not targets:
+            raise ValueError("No samples found in", root_dir)
+    else:
+        dataset = list(iter_dataset())
+        targets = [i["target"] for i in dataset]
+        print("len dataset", len(dataset))
+    n_outputs = [i for i in targets if isinstance(i, list)]
+    if id_prop_csv_file and n_outputs:
+        multioutput = True
     print("train_stress", train_stress)
-    del dat
     # multioutput = False
     lists_length_equal = True
     line_graph = False
@@ -372,6 +410,7 @@ def train_for_folder(
         prepare_batch,
     ) = get_train_val_loaders(
         dataset_array=dataset,
+        dataset_stream=iter_dataset if config.stream_data else None,
         target="target",
         target_atomwise=target_atomwise,
         target_grad=target_grad,
@@ -404,6 +443,17 @@ def train_for_folder(
         keep_data_order=config.keep_data_order,
         output_dir=config.output_dir,
         use_lmdb=config.use_lmdb,
+        compact_graphs=config.compact_graphs,
+        store_r=config.store_r,
+        store_line_graph=config.store_line_graph,
+        lmdb_readahead=config.lmdb_readahead,
+        lmdb_max_readers=config.lmdb_max_readers,
+        batch_budget=config.batch_budget,
+        batch_budget_key=config.batch_budget_key,
+        preprocess_workers=config.preprocess_workers,
+        label_store=config.label_store,
+        graph_cache_dir=config.graph_cache_dir,
+        graph_cache_size=config.graph_cache_size,
         dtype=config.dtype,
     )
     # print("dataset", dataset[0])
@@ -40,6 +40,7 @@ setuptools.setup(
         "alignn/pretrained.py",
         "alignn/train_alignn.py",
         "alignn/run_alignn_ff.py",
+        "alignn/benchmark_graphs.py",
     ],
     long_description=long_description,
     long_description_content_type="text/markdown",